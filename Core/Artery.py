@@ -11,6 +11,7 @@ class Artery:
         self.combined_transform = OrderedDict()
         self.vtu_dataset = None
         self.vtp_dataset = None
+        self.volume_template = None
 
     def create_centerline(self, centerline_polydata):
         self.centerline = Centerline(centerline_polydata)
@@ -66,11 +67,15 @@ class Artery:
 
     def set_registration_matrix(self, matrix):
         self.combined_transform = matrix
+        self.volume_template = None
 
     def get_clipper_points_vectors(self, variation_rate):
         clipper_points, clipper_vectors = self.centerline.find_clipper_points_and_vectors(variation_rate)
         return clipper_points, clipper_vectors
 
+    def get_clipper_point_ids(self, variation_rates):
+        return self.centerline.get_clipper_point_ids(variation_rates)
+
     def get_cutpoints_vectors(self):
         cut_points, cut_vectors = self.centerline.find_cut_points_and_vectors()
         return cut_points, cut_vectors
@@ -92,3 +97,9 @@ class Artery:
 
     def get_vtp_dataset(self):
         return self.vtp_dataset
+
+    def set_volume_template(self, volume_template):
+        self.volume_template = volume_template
+
+    def get_volume_template(self):
+        return self.volume_template
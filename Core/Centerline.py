@@ -9,7 +9,10 @@ class Centerline:
     def __init__(self, smooth_centerline_polydata):
         self.centerline_polydata = smooth_centerline_polydata
         self.point_coords = None
+        self.offsets = None
         self.connectivity = None
+        self.radius_array = None
+        self.point_radius = None
         self.bf_point = None
         self.end_points = dict()
         self.clipper_points = dict()
@@ -20,44 +23,55 @@ class Centerline:
         self.labeled_line = OrderedDict()
 
     def analyzing_centerline(self):
-        point_coords, connectivity = VTK.get_coords_and_connectivity(self.centerline_polydata)
+        point_coords, offsets, connectivity = VTK.get_coords_and_connectivity(self.centerline_polydata)
         self.point_coords = point_coords
+        self.offsets = offsets
         self.connectivity = connectivity
+        self.build_radius_index()
         bf_pt_id, bifurcation_coords = self.find_bifurcation_point(point_coords, connectivity)
-        self.find_endpoints(bf_pt_id, point_coords, connectivity)
+        self.find_endpoints(bf_pt_id, point_coords, offsets, connectivity)
+
+    def build_radius_index(self):
+        # Points sharing coordinates share the radius of the first point at them
+        coord_ids = {}
+        first_ids = np.fromiter((coord_ids.setdefault(coord, point_id)
+                                 for point_id, coord in enumerate(map(tuple, self.point_coords.tolist()))),
+                                dtype=np.int64, count=len(self.point_coords))
+        self.radius_array = np.asarray(VTK.get_radius_list(self.centerline_polydata), dtype=np.float64)
+        self.point_radius = self.radius_array[first_ids]
+
+    def get_radius(self, point_id):
+        return float(self.point_radius[point_id])
+
+    def get_lines(self):
+        # Point ids of every line, as views of the connectivity array
+        return np.split(self.connectivity, self.offsets[1:-1])
 
     def find_bifurcation_point(self, point_coords, connectivity):
         # Identify the bifurcation point (the point that is common in 3 lines)
-        point_usage = {}
-        for line in connectivity:
-            for pt_id in line:
-                if pt_id in point_usage:
-                    point_usage[pt_id] += 1
-                else:
-                    point_usage[pt_id] = 1
-
-        # The bifurcation point should be the one used in exactly 3 lines
-        bifurcation_pt_id = [pt_id for pt_id, count in point_usage.items() if count == 3]
-        bifurcation_coords = point_coords[bifurcation_pt_id[0]] if bifurcation_pt_id else None
+        point_ids, first_uses, point_usage = np.unique(connectivity, return_index=True, return_counts=True)
+
+        # The bifurcation point should be the one used in exactly 3 lines, the first met along the lines
+        shared = point_usage == 3
+        bifurcation_pt_id = point_ids[shared][np.argsort(first_uses[shared])]
+        bifurcation_coords = point_coords[bifurcation_pt_id[0]] if len(bifurcation_pt_id) else None
 
         # Verbose output for debugging
         print(f"Bifurcation point coordinates: {bifurcation_coords} (ID: {bifurcation_pt_id[0]})")
         point_id = self.centerline_polydata.FindPoint(bifurcation_coords)
         # print(str(point_id))
         self.bf_point = Point(point_id, bifurcation_coords[0], bifurcation_coords[1], bifurcation_coords[2])
-        self.bf_point.set_radius(VTK.get_radius_for_coord(self.centerline_polydata, bifurcation_coords))
+        self.bf_point.set_radius(self.get_radius(bifurcation_pt_id[0]))
         return bifurcation_pt_id, bifurcation_coords
 
-    def find_endpoints(self, bifurcation_pt_id, point_coords, connectivity):
-        true_end_points = []
-        for line in connectivity:
-            endpoints = [line[0], line[-1]]  # First and last points in the line
-            for pt_id in endpoints:
-                if pt_id not in bifurcation_pt_id:
-                    true_end_points.append(pt_id)
+    def find_endpoints(self, bifurcation_pt_id, point_coords, offsets, connectivity):
+        # First and last points of the non-empty lines
+        starts = offsets[:-1][np.diff(offsets) > 0]
+        ends = offsets[1:][np.diff(offsets) > 0] - 1
+        endpoints = np.concatenate((connectivity[starts], connectivity[ends]))
 
         # Ensure we have exactly 3 unique true endpoints
-        true_end_points = list(set(true_end_points))
+        true_end_points = np.unique(endpoints[~np.isin(endpoints, bifurcation_pt_id)]).tolist()
 
         if len(true_end_points) != 3:
             raise ValueError("Error: Expected exactly 3 true end points, found {}".format(len(true_end_points)))
@@ -66,7 +80,7 @@ class Centerline:
         true_end_points_coords = point_coords[true_end_points]
 
         # Label the CCA branch (the line with the lowest Z value)
-        cca_idx = np.argmin([point_coords[pt][2] for pt in true_end_points])  # Z is the third component
+        cca_idx = np.argmin(true_end_points_coords[:, 2])  # Z is the third component
         cca_pt = true_end_points[cca_idx]
 
         # Remove the CCA point from the remaining points for ICA and ECA labeling
@@ -92,47 +106,69 @@ class Centerline:
         self.end_points["ica"] = Point(ica_pt, point_coords[ica_pt][0], point_coords[ica_pt][1],
                                        point_coords[ica_pt][2])
 
-        self.end_points["cca"].set_radius(VTK.get_radius_for_coord(self.centerline_polydata, point_coords[cca_pt]))
-        self.end_points["eca"].set_radius(VTK.get_radius_for_coord(self.centerline_polydata, point_coords[eca_pt]))
-        self.end_points["ica"].set_radius(VTK.get_radius_for_coord(self.centerline_polydata, point_coords[ica_pt]))
+        for k in self.end_points:
+            self.end_points[k].set_radius(self.get_radius(self.end_points[k].get_id()))
 
     def find_clipper_points_and_vectors(self, variation_rate):
+        """
+        Clipper point and vector of every branch at variation_rate. A sequence of rates gives a list of
+        (clipper_points, clipper_vector) pairs, one per rate, and leaves the stored ones unchanged.
+        """
+        clipper_ids = self.get_clipper_point_ids(variation_rate)
+        sweep = []
+        for i in range(np.size(variation_rate)):
+            clipper_points, clipper_vector = self.clipper_points.copy(), self.clipper_vector.copy()
+            for k in clipper_ids:
+                point_id = int(clipper_ids[k][i])
+                if point_id < 0:
+                    continue
+                point_coords = self.point_coords[point_id].tolist()
+                clipper_points[k] = Point(point_id, point_coords[0], point_coords[1], point_coords[2])
+                clipper_points[k].set_radius(float(self.radius_array[point_id]))
+                if int(self.end_points[k].get_id()) not in (0, 1):
+                    # ---------------------- Vector-------------------------------------
+                    clipper_vector[k] = (self.point_coords[point_id + 1] - self.point_coords[point_id]).tolist()
+            sweep.append((clipper_points, clipper_vector))
+
+        if np.ndim(variation_rate) > 0:
+            return sweep
+        for k in clipper_ids:
+            if clipper_ids[k][0] < 0 and int(self.end_points[k].get_id()) not in (0, 1):
+                raise ValueError(f"No {k} clipper point within variation rate {variation_rate}.")
+        self.clipper_points.update(sweep[0][0])
+        self.clipper_vector.update(sweep[0][1])
+        return self.clipper_points.copy(), self.clipper_vector.copy()
+
+    def get_clipper_point_ids(self, variation_rates):
+        """
+        Clipper point id of every branch for each variation rate, -1 where none is within the band.
+        From endpoints 0 and 1 the search goes forward for the first radius within the band of the endpoint
+        radius; from the other endpoints it goes back, from 5 points before the end, for the first point
+        within the band of the radius of the point after it.
+        """
+        variation_rates = np.atleast_1d(np.asarray(variation_rates, dtype=np.float64))[:, None]
+        clipper_ids = OrderedDict()
         for k in self.end_points:
             endpoint_id = int(self.end_points[k].get_id())
-            radius = self.end_points[k].get_radius()
             if endpoint_id == 0 or endpoint_id == 1:
-                for j in range(endpoint_id + 1, self.centerline_polydata.GetNumberOfPoints()):
-                    current_radius = VTK.get_radius_by_point_id(self.centerline_polydata, j)
-                    if (1 + variation_rate) * radius > current_radius > (1 - variation_rate) * radius:
-                        point_coords = self.centerline_polydata.GetPoint(j)
-                        self.clipper_points[k] = Point(j, point_coords[0], point_coords[1], point_coords[2])
-                        self.clipper_points[k].set_radius(current_radius)
-                        break
+                radius = self.end_points[k].get_radius()
+                candidate_ids = np.arange(endpoint_id + 1, len(self.radius_array))
+                current_radius = self.radius_array[candidate_ids]
+                in_band = ((1 + variation_rates) * radius > current_radius) & \
+                          (current_radius > (1 - variation_rates) * radius)
             else:
-                current_id = int(endpoint_id - 5)
-                while True:
-                    current_radius = VTK.get_radius_by_point_id(self.centerline_polydata,
-                                                                current_id)  # centerline_points[current_id + 3][4]
-                    previous_radius = VTK.get_radius_by_point_id(self.centerline_polydata, int(current_id - 1))
-                    if current_radius * (1 + variation_rate) > previous_radius > current_radius * (1 - variation_rate):
-                        point_coords = self.centerline_polydata.GetPoint(current_id - 1)
-                        self.clipper_points[k] = Point(int(current_id - 1), point_coords[0], point_coords[1],
-                                                       point_coords[2])
-                        self.clipper_points[k].set_radius(VTK.get_radius_by_point_id(self.centerline_polydata,
-                                                                                     int(current_id - 1)))
-                        # ---------------------- Vector-------------------------------------
-                        destination_coord = self.centerline_polydata.GetPoint(current_id)
-                        origin_coord = self.centerline_polydata.GetPoint(int(current_id - 1))
-                        x_normalize = destination_coord[0] - origin_coord[0]
-                        y_normalize = destination_coord[1] - origin_coord[1]
-                        z_normalize = destination_coord[2] - origin_coord[2]
-                        normalize_vector_item = [x_normalize, y_normalize, z_normalize]
-                        self.clipper_vector[k] = normalize_vector_item
-                        break
-                    else:
-                        current_id = current_id - 1
-
-        return self.clipper_points.copy(), self.clipper_vector.copy()
+                candidate_ids = np.arange(endpoint_id - 6, -1, -1)
+                current_radius = self.radius_array[candidate_ids + 1]
+                previous_radius = self.radius_array[candidate_ids]
+                in_band = (current_radius * (1 + variation_rates) > previous_radius) & \
+                          (previous_radius > current_radius * (1 - variation_rates))
+
+            if len(candidate_ids) == 0:
+                clipper_ids[k] = np.full(len(variation_rates), -1)
+                continue
+            first = np.argmax(in_band, axis=1)
+            clipper_ids[k] = np.where(in_band[np.arange(len(first)), first], candidate_ids[first], -1)
+        return clipper_ids
 
     def find_cut_points_and_vectors(self):
         self.set_lines_label()
@@ -145,7 +181,7 @@ class Centerline:
         ica_line = None
         eca_line = None
 
-        for line in self.connectivity:
+        for line in self.get_lines():
             if self.clipper_points["cca"].get_id() in line and self.bf_point.get_id() in line:
                 cca_line = self.label_line_segment(line, self.bf_point.get_id(), self.clipper_points["cca"].get_id())
             if self.clipper_points["ica"].get_id() in line and self.bf_point.get_id() in line:
@@ -171,9 +207,10 @@ class Centerline:
         Extract the part of the line from bifurcation point to the endpoint.
         We assume the bifurcation point is on the line, so we split the line at the bifurcation.
         """
+        line = np.asarray(line)
         if bifurcation_pt_id in line and end_pt_id in line:
-            bifurcation_idx = line.index(bifurcation_pt_id)
-            end_pt_idx = line.index(end_pt_id)
+            bifurcation_idx = np.flatnonzero(line == bifurcation_pt_id)[0]
+            end_pt_idx = np.flatnonzero(line == end_pt_id)[0]
 
             # Extract the segment from bifurcation to the end point
             if bifurcation_idx < end_pt_idx:
@@ -190,7 +227,7 @@ class Centerline:
             for idx in cut_point_indices[k]:
                 pnt_coord = self.point_coords[idx]
                 point = Point(idx, pnt_coord[0], pnt_coord[1], pnt_coord[2])
-                point.set_radius(VTK.get_radius_for_coord(self.centerline_polydata, pnt_coord))
+                point.set_radius(self.get_radius(idx))
                 points_list.append(point)
             self.cut_points[k] = points_list.copy()
             points_list.clear()
@@ -218,7 +255,7 @@ class Centerline:
         dividing_indices = [int(round(i * (len(line) - 1) / num_parts)) for i in range(1, num_parts)]
 
         # Select the points corresponding to the indices
-        selected_points_indices = [line[idx] for idx in dividing_indices]
+        selected_points_indices = np.asarray(line)[dividing_indices].tolist()
 
         return selected_points_indices
 
@@ -0,0 +1,101 @@
+import os
+import numpy as np
+from vtkmodules.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+from VTKModule.VTKReader import VTKReader as vtkRdr
+from VTKModule.VTKUtils import VTKUtils as vtkUtl
+from VTKModule.VTKConvertor import VTKConvertor as vtkCnvrt
+
+
+class ExtractionIndex:
+    """
+    Carotid arteries selection of the CFD full domain, computed once per case.
+    The mesh is the same at every time step, so the kept points, kept cells and the renumbered
+    connectivity found at time step 0 are reused and only the flow array is gathered per step.
+    source_stamp identifies the time-step file the selection was made from.
+    """
+    def __init__(self, fingerprint, kept_point_ids, kept_cell_ids=None, offsets=None, connectivity=None,
+                 cell_types=None, source_stamp=None):
+        self.fingerprint = fingerprint
+        self.source_stamp = source_stamp
+        self.kept_point_ids = kept_point_ids
+        self.kept_cell_ids = kept_cell_ids
+        self.offsets = offsets
+        self.connectivity = connectivity
+        self.cell_types = cell_types
+
+    @classmethod
+    def build(cls, full_domain_output, fingerprint=None):
+        if fingerprint is None:
+            fingerprint = vtkUtl.get_mesh_fingerprint(full_domain_output)
+        kept_point_ids = vtkRdr.get_flow_point_ids(full_domain_output)
+        if not vtkRdr.has_linear_cell_arrays(full_domain_output):
+            return cls(fingerprint, kept_point_ids)
+
+        kept_point_ids, kept_cell_ids, offsets, connectivity, cell_types = \
+            vtkRdr.get_extraction_arrays(full_domain_output, kept_point_ids)
+        return cls(fingerprint, kept_point_ids, kept_cell_ids, offsets, connectivity, cell_types)
+
+    @classmethod
+    def build_from_raw_domain(cls, raw_domain):
+        kept_point_ids = vtkRdr.get_flow_point_ids_from_array(raw_domain["flow"])
+        kept_point_ids, kept_cell_ids, offsets, connectivity, cell_types = \
+            vtkRdr.get_extraction_arrays_from_cells(len(raw_domain["points"]), raw_domain["offsets"],
+                                                    raw_domain["connectivity"], raw_domain["cell_types"],
+                                                    kept_point_ids)
+        return cls(raw_domain["fingerprint"], kept_point_ids, kept_cell_ids, offsets, connectivity, cell_types)
+
+    @classmethod
+    def load(cls, pathName):
+        if not os.path.exists(pathName):
+            return None
+        try:
+            with np.load(pathName) as data:
+                source_stamp = str(data["source_stamp"]) if "source_stamp" in data else None
+                if "offsets" not in data:
+                    return cls(str(data["fingerprint"]), data["kept_point_ids"], source_stamp=source_stamp)
+                return cls(str(data["fingerprint"]), data["kept_point_ids"], data["kept_cell_ids"],
+                           data["offsets"], data["connectivity"], data["cell_types"], source_stamp)
+        except Exception as e:
+            print(f"Extraction index could not be read: {e}")
+            return None
+
+    def save(self, pathName):
+        arrays = {"fingerprint": np.array(self.fingerprint), "kept_point_ids": self.kept_point_ids}
+        if self.source_stamp is not None:
+            arrays["source_stamp"] = np.array(self.source_stamp)
+        if self.offsets is not None:
+            arrays.update(kept_cell_ids=self.kept_cell_ids, offsets=self.offsets, connectivity=self.connectivity,
+                          cell_types=self.cell_types)
+        # Written aside and renamed, so time-step workers never read a partial file
+        temp_pathName = f"{pathName}.{os.getpid()}.tmp"
+        with open(temp_pathName, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(temp_pathName, pathName)
+
+    def matches(self, fingerprint):
+        return self.fingerprint == fingerprint
+
+    def apply(self, full_domain_output):
+        if self.offsets is None:
+            carotid_arteries_grid = vtkRdr.filter_cells_by_point_ids(full_domain_output, self.kept_point_ids)
+        else:
+            original_points = vtk_to_numpy(full_domain_output.GetPoints().GetData())
+            carotid_arteries_grid = vtkCnvrt.numpy_to_vtk_unstructured_grid(original_points[self.kept_point_ids],
+                                                                            self.offsets, self.connectivity,
+                                                                            self.cell_types)
+
+        flow_data = vtk_to_numpy(full_domain_output.GetPointData().GetArray("flow"))
+        flow_array = numpy_to_vtk(flow_data[self.kept_point_ids])
+        flow_array.SetName("flow")
+        carotid_arteries_grid.GetPointData().AddArray(flow_array)
+        return carotid_arteries_grid
+
+    def apply_to_raw_domain(self, raw_domain):
+        # Only the kept rows of the memory-mapped points and flow are read
+        carotid_arteries_grid = vtkCnvrt.numpy_to_vtk_unstructured_grid(raw_domain["points"][self.kept_point_ids],
+                                                                        self.offsets, self.connectivity,
+                                                                        self.cell_types)
+        flow_array = numpy_to_vtk(np.ascontiguousarray(raw_domain["flow"][self.kept_point_ids]), deep=True)
+        flow_array.SetName("flow")
+        carotid_arteries_grid.GetPointData().AddArray(flow_array)
+        return carotid_arteries_grid
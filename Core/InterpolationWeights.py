@@ -0,0 +1,50 @@
+import os
+import numpy as np
+from scipy.sparse import csr_matrix
+from VTKModule.VTKUtils import VTKUtils as vtkUtl
+
+
+class InterpolationWeights:
+    """
+    Kernel weights of the flow interpolation from a section onto a target dataset.
+    The source section and the target keep their geometry over the time steps, so the neighbour search
+    and the kernel are evaluated once and each step is one sparse product per point array.
+    """
+    def __init__(self, fingerprint, weights):
+        self.fingerprint = fingerprint
+        self.weights = weights
+
+    @classmethod
+    def get_fingerprint(cls, source_polydata, target):
+        return vtkUtl.get_mesh_fingerprint(source_polydata) + vtkUtl.get_mesh_fingerprint(target)
+
+    @classmethod
+    def build(cls, source_polydata, target, fingerprint=None):
+        if fingerprint is None:
+            fingerprint = cls.get_fingerprint(source_polydata, target)
+        return cls(fingerprint, vtkUtl.get_interpolation_weights(source_polydata, target))
+
+    @classmethod
+    def load(cls, pathName):
+        if not os.path.exists(pathName):
+            return None
+        try:
+            with np.load(pathName) as data:
+                weights = csr_matrix((data["data"], data["indices"], data["indptr"]), shape=tuple(data["shape"]))
+                return cls(str(data["fingerprint"]), weights)
+        except Exception as e:
+            print(f"Interpolation weights could not be read: {e}")
+            return None
+
+    def save(self, pathName):
+        temp_pathName = f"{pathName}.{os.getpid()}.tmp"
+        with open(temp_pathName, 'wb') as file:
+            np.savez(file, fingerprint=np.array(self.fingerprint), data=self.weights.data,
+                     indices=self.weights.indices, indptr=self.weights.indptr, shape=np.array(self.weights.shape))
+        os.replace(temp_pathName, pathName)
+
+    def matches(self, fingerprint):
+        return self.fingerprint == fingerprint
+
+    def apply(self, source_polydata, target):
+        return vtkUtl.get_interpolated_dataset(source_polydata, target, self.weights)
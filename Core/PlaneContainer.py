@@ -2,18 +2,38 @@ import pyvista as pv
 from VTKModule.VTKUtils import VTKUtils as vtkUtl
 from VTKModule.VTKReader import VTKReader as vtkRdr
 from Core.Plane import Plane
+from Core.PlaneSection import PlaneSection
+from Core.SpatialIndex import SpatialIndex
+from Core.WriteBehindQueue import WriteBehindQueue
+from Core.InterpolationWeights import InterpolationWeights
 from VTKModule.Writer import Writer
 import numpy as np
 from collections import OrderedDict
 import os
-import time
 
 
 class PlaneContainer:
+    flow_rate_dtype = np.dtype([("branch", "U8"), ("index", np.int32), ("flow_rate", np.float64),
+                                ("area", np.float64), ("mean_velocity", np.float64), ("n_cells", np.int64)])
+
     def __init__(self):
         self.clipper_planes = OrderedDict()
         self.cut_planes = OrderedDict()
         self.flow_rate_dict = OrderedDict()
+        self.plane_sections = OrderedDict()
+        self.interpolation_weights = OrderedDict()
+        self.section_backend = "vtk"
+        self.spatial_indexes = OrderedDict()
+        self.surfaces = OrderedDict()
+        self.surface_caps = OrderedDict()
+
+    def get_worker_copy(self):
+        """The planes and settings alone, for a time-step worker; caches are rebuilt there as needed."""
+        plane_container = PlaneContainer()
+        plane_container.clipper_planes = self.clipper_planes.copy()
+        plane_container.cut_planes = OrderedDict((k, list(planes)) for k, planes in self.cut_planes.items())
+        plane_container.section_backend = self.section_backend
+        return plane_container
 
     @classmethod
     def get_divider_plane(cls, clip_origin, normal):
@@ -26,6 +46,7 @@ class PlaneContainer:
         return artery_surface
 
     def create_clipper_planes(self, clipper_points, clipper_vectors, planes_path, pyvista_plane_size_1):  # *
+        self.plane_sections.clear()
         for k in clipper_points:
             if clipper_points[k].get_radius() < 1.1:
                 i_size = pyvista_plane_size_1
@@ -43,62 +64,72 @@ class PlaneContainer:
 
             self.clipper_planes[k] = Plane(clipper_points[k], clipper_vectors[k], pyvista_plane)
 
-            plane_file_path = f"{planes_path}{k}_plane.stl"
-            pyvista_plane.save(plane_file_path, binary=False)
+            Writer.write_pyvista_plane(pyvista_plane, k, planes_path, natural_scale=True)
 
-            with open(plane_file_path, 'r+') as file:
-                lines = file.readlines()
-                lines[0] = f'solid {k}\n'
-                lines[-1] = f'endsolid {k}\n'
-                file.seek(0)
-                file.writelines(lines)
-                file.truncate()
+    def get_surface(self, surface_path):
+        """Parsed STL surface, kept in memory while the file is unchanged."""
+        file_stat = os.stat(surface_path)
+        file_key = (file_stat.st_mtime_ns, file_stat.st_size)
+        surface = self.surfaces.get(surface_path)
+        if surface is None or surface[0] != file_key:
+            surface = (file_key, pv.wrap(vtkRdr.read_stl_file(surface_path).GetOutput()))
+            self.surfaces[surface_path] = surface
+        return surface[1]
 
-            Writer.write_natural_scale_surface(plane_file_path)
+    def get_surface_caps(self):
+        return self.surface_caps
 
-    def clip_surface(self, clipped_surface, clipper_points, artery_path, geometry_dir, sphere_radius_coef):
+    def clip_surface(self, clipped_surface, clipper_points, artery_path, sphere_radius_coef):
+        """Clips the surface at every clipper plane; the caps stay in memory until write_surface_caps."""
         i = 0
         final_result = None
+        self.surface_caps.clear()
 
         for k in self.clipper_planes:
             center = np.array([clipper_points[k].get_x(), clipper_points[k].get_y(), clipper_points[k].get_z()])
-            distances = np.linalg.norm(clipped_surface.points - center, axis=1)
             if clipper_points[k].get_radius() < 1.4 and k != "ica" and k != "eca":
                 sphere_radius = 7.5
             else:
                 sphere_radius = clipper_points[k].get_radius() * sphere_radius_coef
-            mask = distances <= sphere_radius
+            # Only the points of the sphere are visited, through the index of the surface left by the last clip
+            mask = np.zeros(clipped_surface.n_points, dtype=bool)
+            mask[self.get_spatial_index(clipped_surface).get_point_ids_in_sphere(center, sphere_radius)] = True
             cut_plane = self.clipper_planes[k].get_pyvista_plane()
             plane_normal = -cut_plane.compute_normals().cell_normals[0]
             plane_point = cut_plane.center
-            mesh = self.calculate_surface_intersection(artery_path, plane_point, cut_plane, sphere_radius)
-
-            Writer.write_surface_intersection(mesh, geometry_dir + k + '.stl', k)
-            Writer.write_natural_scale_surface(geometry_dir + k + '.stl')
+            self.surface_caps[k] = self.calculate_surface_intersection(artery_path, plane_point, cut_plane,
+                                                                       sphere_radius)
             points_to_clip = clipped_surface.extract_points(mask)
             clipped = points_to_clip.clip(normal=plane_normal, origin=plane_point, invert=False)
             remaining_points = clipped_surface.extract_points(~mask)
             merged_polydata = remaining_points.merge(clipped).clean()
-            connected_polydata = merged_polydata.connectivity(extraction_mode='largest')
+            connected_polydata = vtkUtl.get_connected_region(merged_polydata)
             clipped_surface = connected_polydata
             if i == 2:
                 final_result = clipped_surface.extract_surface()
             i += 1
         return final_result
 
-    @classmethod
-    def calculate_surface_intersection(cls, surface_path, center, pyvista_plane, sphere_radius):
-        main_surface = vtkRdr.read_stl_file(surface_path)
+    def write_surface_caps(self, geometry_dir):
+        for k in self.surface_caps:
+            Writer.write_surface_intersection(self.surface_caps[k], geometry_dir + k + '.stl', k, natural_scale=True)
 
-        extracted_cells = vtkUtl.get_extracted_cells(main_surface, center, sphere_radius)
+    def calculate_surface_intersection(self, surface_path, center, pyvista_plane, sphere_radius):
+        main_surface = self.get_surface(surface_path)
+
+        cell_ids = self.get_spatial_index(main_surface).get_cell_ids_in_sphere(center, sphere_radius)
+        extracted_cells = vtkUtl.get_extracted_cells(main_surface, center, sphere_radius, cell_ids)
         cutter_polydata = vtkUtl.get_polydata_cutter(extracted_cells, pyvista_plane)
+        # Only the contour around the centerline point is triangulated
+        contour = vtkUtl.get_connected_region(cutter_polydata, 'closest', center)
 
-        mesh = pv.wrap(vtkUtl.apply_Delaunay2D(cutter_polydata))
-        connected_mesh = mesh.connectivity(extraction_mode='largest')
+        mesh = pv.wrap(vtkUtl.apply_Delaunay2D(contour))
+        connected_mesh = vtkUtl.get_connected_region(mesh)
 
         return connected_mesh
 
     def create_cut_planes(self, cutpoints, vectors, cut_planes_dir, const_plane_size, coef_cutplane_size):
+        self.plane_sections.clear()
         plane_list = []
         i_size = 0
         j_size = 0
@@ -121,18 +152,7 @@ class PlaneContainer:
                 new_plane = Plane(point, vectors[k][i], pyvista_plane)
                 plane_list.append(new_plane)
 
-                plane_file_path = f"{cut_planes_dir}{k}{i}_plane.stl"
-                pyvista_plane.save(plane_file_path, binary=False)
-
-                with open(plane_file_path, 'r+') as file:
-                    lines = file.readlines()
-                    lines[0] = f'solid {k}\n'
-                    lines[-1] = f'endsolid {k}\n'
-                    file.seek(0)
-                    file.writelines(lines)
-                    file.truncate()
-
-                Writer.write_natural_scale_surface(plane_file_path)
+                Writer.write_named_stl(pyvista_plane, k, f"{cut_planes_dir}{k}{i}_plane.stl", natural_scale=True)
                 i = i + 1
             self.cut_planes[k] = plane_list.copy()
             plane_list.clear()
@@ -145,76 +165,157 @@ class PlaneContainer:
                 else:
                     continue
 
-    def cut_volume(self, artery_volume, output_dir, natural_scale_dir,
-                   sphere_radius_coef, cut_planes_dir, start_name, scale=1):
-        flow_rate_cca = 0  # start name = flow_ or vtu_intersection_
+    def get_active_cut_planes(self, cut_planes_dir):
+        """(branch, index, plane) of the cut planes kept by customize_cut_planes and saved in cut_planes_dir."""
+        active_cut_planes = []
         for k in self.cut_planes:
-            i = 0
-            for plane in self.cut_planes[k]:
-                plane_file_path = f"{cut_planes_dir}{k}{i}_plane.stl"
-                if not os.path.exists(plane_file_path):
-                    i += 1
-                    continue
-                if plane is None:
-                    i += 1
-                    continue
-                pyvista_plane = plane.get_pyvista_plane()
-                if not scale == 1:
-                    pyvista_plane.scale([scale, scale, scale], inplace=True)
-                    sphere_radius = plane.get_point().get_radius() * sphere_radius_coef * scale
-                else:
-                    sphere_radius = plane.get_point().get_radius() * sphere_radius_coef
-                plane_point = pyvista_plane.center
-                start_time_intersection = time.time()
-                mesh = self.calculate_volume_intersection(artery_volume, plane_point, sphere_radius, pyvista_plane)
-                end_time_intersection = time.time()
-                elapsed_time_intersection = end_time_intersection - start_time_intersection
-                if elapsed_time_intersection >= 1.0:
-                    print(f"calculate_intersection {elapsed_time_intersection:.2f} seconds.\n")
-                    print("\n")
-
-                if start_name == "flow_":
-                    mesh.save(output_dir + start_name + k + str(i) + '.vtk', binary=False)
-                    Writer.write_natural_scale_volume(output_dir + start_name + k + str(i) + '.vtk')
-                else:
-                    mesh.save(output_dir + start_name + k + str(i) + '.vtk', binary=False)
-                    # Writer.write_natural_scale_volume(output_dir + start_name + k + str(i) + '.vtk', scale_factor=1.0)
+            for i, plane in enumerate(self.cut_planes[k]):
+                if plane is not None and os.path.exists(f"{cut_planes_dir}{k}{i}_plane.stl"):
+                    active_cut_planes.append((k, i, plane))
+        return active_cut_planes
 
-                    source_dataset = vtkRdr.read_vtk_dataset(natural_scale_dir + "flow_" + k + str(i) + '.vtk')
-                    target_dataset = vtkRdr.read_vtk_dataset(output_dir + start_name + k + str(i) + '.vtk')
-
-                    interpolator = vtkUtl.get_interpolator(source_dataset.GetOutput(), target_dataset.GetOutput())
-                    Writer.write_vtk_dataset(interpolator, natural_scale_dir + 'interpolated_' + k + str(i) + '.vtk')
+    @classmethod
+    def get_flow_rate_record(cls, branch, index, interpolated_dataset):
+        flow_rate, area, n_cells = vtkUtl.get_section_flow_rate(interpolated_dataset)
+        mean_velocity = flow_rate / area if area > 0 else 0.0
+        return branch, index, flow_rate, area, mean_velocity, n_cells
 
-                    interpolated_flow_rate = vtkUtl.calculate_flow_rate(interpolator)
-                    self.flow_rate_dict[k + str(i)] = interpolated_flow_rate
+    @classmethod
+    def get_flow_rate_mapping(cls, flow_rates):
+        """Plane name ("cca", "ica0", ...) to flow rate, the form used by MathFun.filter_and_average_flow_rates."""
+        flow_rate_mapping = OrderedDict()
+        for record in flow_rates:
+            name = record["branch"] if record["index"] < 0 else record["branch"] + str(record["index"])
+            flow_rate_mapping[name] = float(record["flow_rate"])
+        return flow_rate_mapping
+
+    def calculate_flow_rates(self, artery_volume, target_volume, sphere_radius_coef, target_sphere_radius_coef,
+                             cut_planes_dir, scale=0.001, weights_dir=None, output_dir=None, natural_scale_dir=None,
+                             write_queue=None):
+        """
+        Flow rate of every active cut plane in one pass: the artery_volume section is scaled in memory,
+        interpolated onto the target_volume section (at natural scale) and integrated. The planes stay at
+        imaging scale; a scaled copy cuts the target volume.
+        The flow array of artery_volume is read once for all planes. With output_dir and natural_scale_dir
+        the artery and target sections and the interpolated section are written too, through write_queue when
+        given. Returns an array of flow_rate_dtype.
+        """
+        flow_data = vtkUtl.get_point_array(artery_volume)
+        # Each volume geometry is hashed once for all planes
+        artery_key = PlaneSection.get_volume_key(artery_volume)
+        target_key = PlaneSection.get_volume_key(target_volume)
+        records = []
+        for k, i, plane in self.get_active_cut_planes(cut_planes_dir):
+            pyvista_plane = plane.get_pyvista_plane()
+            radius = plane.get_point().get_radius()
+            mesh = self.get_volume_section("flow_" + k + str(i), artery_volume, pyvista_plane.center,
+                                           radius * sphere_radius_coef, pyvista_plane, flow_data, artery_key)
+            source_dataset = vtkUtl.get_scaled_volume(mesh, scale)
+
+            scaled_plane = pyvista_plane.scale([scale, scale, scale], inplace=False)
+            target_mesh = self.get_volume_section("vtu_intersection_" + k + str(i), target_volume,
+                                                  scaled_plane.center, radius * target_sphere_radius_coef * scale,
+                                                  scaled_plane, volume_key=target_key)
+
+            interpolator = self.get_interpolated_flow(k + str(i), source_dataset, target_mesh, weights_dir)
+            records.append(self.get_flow_rate_record(k, i, interpolator))
+            self.flow_rate_dict[k + str(i)] = records[-1][2]
+            print(k + str(i) + ": " + str(records[-1][2]))
+
+            if output_dir is not None and natural_scale_dir is not None:
+                flow_pathName = output_dir + "flow_" + k + str(i) + '.vtk'
+                WriteBehindQueue.write(write_queue, flow_pathName, mesh.save, flow_pathName, binary=False)
+                WriteBehindQueue.export_natural_scale_volume(write_queue, flow_pathName)
+                target_pathName = output_dir + "vtu_intersection_" + k + str(i) + '.vtk'
+                WriteBehindQueue.write(write_queue, target_pathName, target_mesh.save, target_pathName, binary=False)
+                interpolated_pathName = natural_scale_dir + 'interpolated_' + k + str(i) + '.vtk'
+                WriteBehindQueue.write(write_queue, interpolated_pathName, Writer.write_vtk_dataset, interpolator,
+                                       interpolated_pathName)
+        print('\n')
+        return np.array(records, dtype=self.flow_rate_dtype)
 
-                    print(k + str(i) + ": " + str(interpolated_flow_rate))
+    def set_section_backend(self, section_backend):
+        self.section_backend = section_backend
 
-                if not scale == 1:
-                    self.rescale_pyvista_plane(pyvista_plane)
-                i += 1
-        print('\n')
-    @classmethod
-    def rescale_pyvista_plane(cls, pyvista_plane, scale=1000.0):
-        pyvista_plane.scale([scale, scale, scale], inplace=True)
+    def get_spatial_index(self, dataset, volume_key=None):
+        """Spatial index of the dataset geometry, shared by every plane and time step using it."""
+        if volume_key is None:
+            volume_key = SpatialIndex.get_volume_key(dataset)
+        spatial_index = self.spatial_indexes.get(volume_key)
+        if spatial_index is None:
+            spatial_index = SpatialIndex.build(dataset, volume_key)
+            self.spatial_indexes[volume_key] = spatial_index
+        return spatial_index
 
     @classmethod
-    def calculate_volume_intersection(cls, volume, center, sphere_radius, pyvista_plane):
-        extracted_cells = vtkUtl.get_extracted_cells(volume, center, sphere_radius)
-        cutter_polydata = vtkUtl.get_polydata_cutter(extracted_cells, pyvista_plane)
+    def calculate_volume_intersection(cls, volume, center, sphere_radius, pyvista_plane, section_backend="vtk",
+                                      spatial_index=None):
+        cell_ids = None
+        if spatial_index is not None:
+            cell_ids = spatial_index.get_cell_ids_in_sphere(center, sphere_radius)
+        cutter_polydata = None
+        if section_backend == "numpy":
+            # Falls back to VTK for grids with other than linear 3D cells
+            cutter_polydata = vtkUtl.get_numpy_section(volume, center, sphere_radius, pyvista_plane, cell_ids)
+            if cutter_polydata is not None:
+                cutter_polydata = vtkUtl.get_section_in_plane_extent(cutter_polydata, pyvista_plane)
+        if cutter_polydata is None:
+            extracted_cells = vtkUtl.get_extracted_cells(volume, center, sphere_radius, cell_ids)
+            cutter_polydata = vtkUtl.get_polydata_cutter(extracted_cells, pyvista_plane)
         if cutter_polydata.GetNumberOfPoints() == 0 or cutter_polydata.GetNumberOfCells() == 0:
             print("Error: Empty or invalid polydata!")
             exit(1)
 
         mesh = pv.wrap(cutter_polydata)
         try:
-            connected_mesh = mesh.connectivity(extraction_mode='largest')
+            connected_mesh = vtkUtl.get_connected_region(mesh, 'closest', center)
         except Exception as e:
             print(f"Error occurred for calculate_volume_intersection: {e}")
 
         return connected_mesh
 
+    def get_volume_section(self, section_name, volume, center, sphere_radius, pyvista_plane, flow_data=None,
+                           volume_key=None):
+        if volume_key is None:
+            volume_key = PlaneSection.get_volume_key(volume)
+        plane_section = self.plane_sections.get(section_name)
+        if plane_section is not None and plane_section.matches(volume_key, center, sphere_radius):
+            return plane_section.apply(volume, flow_data)
+
+        mesh = self.calculate_volume_intersection(volume, center, sphere_radius, pyvista_plane, self.section_backend,
+                                                  self.get_spatial_index(volume, volume_key))
+        self.set_plane_section(section_name, volume_key, volume, center, sphere_radius, pyvista_plane, mesh,
+                               volume_key)
+        return mesh
+
+    def set_plane_section(self, section_name, volume_key, section_volume, center, sphere_radius, pyvista_plane, mesh,
+                          section_volume_key=None):
+        # section_volume has the points of the volume of volume_key, at the scale of center and sphere_radius
+        cell_ids = self.get_spatial_index(section_volume, section_volume_key).get_cell_ids_in_sphere(
+            center, sphere_radius * (1.0 + 1e-6))
+        weights = vtkUtl.get_section_weights(section_volume, mesh.points, center, sphere_radius, pyvista_plane,
+                                             cell_ids=cell_ids)
+        if weights is None:
+            self.plane_sections.pop(section_name, None)
+            return
+        self.plane_sections[section_name] = PlaneSection(volume_key, center, sphere_radius,
+                                                         mesh, weights)
+
+    def get_interpolated_flow(self, weights_name, source_polydata, target, weights_dir=None):
+        fingerprint = InterpolationWeights.get_fingerprint(source_polydata, target)
+        interpolation_weights = self.interpolation_weights.get(weights_name)
+        if interpolation_weights is None or not interpolation_weights.matches(fingerprint):
+            weights_pathName = None if weights_dir is None else weights_dir + weights_name + "_weights.npz"
+            if weights_pathName is not None:
+                interpolation_weights = InterpolationWeights.load(weights_pathName)
+            if interpolation_weights is None or not interpolation_weights.matches(fingerprint):
+                interpolation_weights = InterpolationWeights.build(source_polydata, target, fingerprint)
+                if weights_pathName is not None:
+                    interpolation_weights.save(weights_pathName)
+            self.interpolation_weights[weights_name] = interpolation_weights
+
+        return interpolation_weights.apply(source_polydata, target)
+
     def get_cut_planes_dict(self):
         return self.cut_planes
 
@@ -224,22 +325,35 @@ class PlaneContainer:
     def get_flow_rate_dict(self):
         return self.flow_rate_dict
 
-    def calculate_cca_flow_rate(self, artery_volume, output_dir, natural_scale_dir, sphere_radius_coef, target_dataset):
-        scaled_artery_volume = vtkUtl.get_scaled_volume(artery_volume)
+    def calculate_cca_flow_rate(self, artery_volume, natural_scale_dir, sphere_radius_coef, target_dataset,
+                                weights_dir=None, write_queue=None):
         plane = self.clipper_planes["cca"]
-        pyvista_plane = plane.get_pyvista_plane()
-        self.rescale_pyvista_plane(pyvista_plane, 0.001)
+        # The section is cut at natural scale, by a scaled copy of the imaging-scale plane
+        pyvista_plane = plane.get_pyvista_plane().scale([0.001, 0.001, 0.001], inplace=False)
         sphere_radius = plane.get_point().get_radius() * sphere_radius_coef
         plane_point = pyvista_plane.center
-        mesh = self.calculate_volume_intersection(scaled_artery_volume, plane_point, sphere_radius, pyvista_plane)
-
-        mesh.save(output_dir + "flow_cca.vtk", binary=False)
-        Writer.write_natural_scale_volume(output_dir + "flow_cca.vtk", 1)
-
-        source_dataset = vtkRdr.read_vtk_dataset(natural_scale_dir + "flow_cca.vtk")
-
-        interpolator = vtkUtl.get_interpolator(source_dataset.GetOutput(), target_dataset)
-        Writer.write_vtk_dataset(interpolator, natural_scale_dir + "cca_interpolated.vtk")
-        interpolated_flow_rate = vtkUtl.calculate_flow_rate(interpolator)
-        self.flow_rate_dict["cca"] = interpolated_flow_rate
-        self.rescale_pyvista_plane(pyvista_plane)
+        plane_section = self.plane_sections.get("cca")
+        artery_key = PlaneSection.get_volume_key(artery_volume)
+        if plane_section is not None and plane_section.matches(artery_key, plane_point, sphere_radius):
+            mesh = plane_section.apply(artery_volume)
+        else:
+            scaled_artery_volume = vtkUtl.get_scaled_volume(artery_volume)
+            scaled_key = SpatialIndex.get_volume_key(scaled_artery_volume)
+            mesh = self.calculate_volume_intersection(scaled_artery_volume, plane_point, sphere_radius, pyvista_plane,
+                                                      self.section_backend,
+                                                      self.get_spatial_index(scaled_artery_volume, scaled_key))
+            self.set_plane_section("cca", artery_key, scaled_artery_volume, plane_point, sphere_radius,
+                                   pyvista_plane, mesh, scaled_key)
+
+        # Natural-scale export, read for the OpenFOAM inlet files
+        if not os.path.exists(natural_scale_dir):
+            os.makedirs(natural_scale_dir)
+        WriteBehindQueue.write(write_queue, natural_scale_dir + "flow_cca.vtk", mesh.save,
+                               natural_scale_dir + "flow_cca.vtk", binary=False)
+
+        interpolator = self.get_interpolated_flow("cca", mesh, target_dataset, weights_dir)
+        WriteBehindQueue.write(write_queue, natural_scale_dir + "cca_interpolated.vtk", Writer.write_vtk_dataset,
+                               interpolator, natural_scale_dir + "cca_interpolated.vtk")
+        record = self.get_flow_rate_record("cca", -1, interpolator)
+        self.flow_rate_dict["cca"] = record[2]
+        return np.array([record], dtype=self.flow_rate_dtype)
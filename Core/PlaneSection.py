@@ -0,0 +1,35 @@
+import numpy as np
+from VTKModule.VTKUtils import VTKUtils as vtkUtl
+
+
+class PlaneSection:
+    """
+    Section of a volume by one cut plane, kept while the volume geometry does not change.
+    The sphere extraction, the cut polygons and the largest-region selection are done once;
+    a new time step only maps the flow of the volume points onto the section points.
+    """
+    def __init__(self, volume_key, center, sphere_radius, mesh, weights):
+        self.volume_key = volume_key
+        self.center = np.array(center, dtype=np.float64)
+        self.sphere_radius = sphere_radius
+        self.mesh = mesh
+        self.weights = weights
+
+    @classmethod
+    def get_volume_key(cls, volume):
+        return vtkUtl.get_mesh_fingerprint(volume)
+
+    def matches(self, volume_key, center, sphere_radius):
+        # Centers of scaled plane copies may differ by round-off, hence the tolerance
+        return self.volume_key == volume_key and \
+            np.allclose(self.center, center, rtol=1e-9, atol=0.0) and \
+            np.isclose(self.sphere_radius, sphere_radius, rtol=1e-9, atol=0.0)
+
+    def apply(self, volume, flow_data=None):
+        # flow_data lets a caller cutting many planes read the volume flow array once
+        mesh = self.mesh.copy(deep=False)
+        if flow_data is None and volume.GetPointData().GetArray("flow") is not None:
+            flow_data = vtkUtl.get_point_array(volume)
+        if flow_data is not None:
+            mesh.point_data["flow"] = (self.weights @ flow_data).astype(flow_data.dtype)
+        return mesh
@@ -0,0 +1,63 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+from vtkmodules.util.numpy_support import vtk_to_numpy
+from VTKModule.VTKUtils import VTKUtils as vtkUtl
+
+
+class SpatialIndex:
+    """
+    KD-tree over the points of a surface or volume, with the cells using each point, built once per geometry.
+    Sphere queries give the cells entirely inside the sphere, as kept by vtkExtractGeometry, by visiting only
+    the points and cells of the selected region. Flow changes between time steps do not touch the index.
+    """
+    def __init__(self, volume_key, tree, cell_sizes, point_offsets, point_cell_ids):
+        self.volume_key = volume_key
+        self.tree = tree
+        self.cell_sizes = cell_sizes
+        self.point_offsets = point_offsets
+        self.point_cell_ids = point_cell_ids
+
+    @classmethod
+    def get_volume_key(cls, dataset):
+        return vtkUtl.get_mesh_fingerprint(dataset)
+
+    @classmethod
+    def get_cell_arrays(cls, dataset):
+        if hasattr(dataset, "GetPolys"):
+            return vtkUtl.get_polydata_cell_arrays(dataset)
+        cells = dataset.GetCells()
+        return vtk_to_numpy(cells.GetOffsetsArray()), vtk_to_numpy(cells.GetConnectivityArray())
+
+    @classmethod
+    def build(cls, dataset, volume_key=None):
+        if volume_key is None:
+            volume_key = cls.get_volume_key(dataset)
+        points = vtk_to_numpy(dataset.GetPoints().GetData()).astype(np.float64)
+        offsets, connectivity = cls.get_cell_arrays(dataset)
+        # The transposed cell-point matrix lists the cells of every point, in the offsets + ids layout
+        point_cells = csr_matrix((np.ones(len(connectivity), dtype=bool), connectivity, offsets),
+                                 shape=(len(offsets) - 1, len(points))).tocsc()
+        return cls(volume_key, cKDTree(points), np.diff(offsets), point_cells.indptr,
+                   point_cells.indices)
+
+    def matches(self, volume_key):
+        return self.volume_key == volume_key
+
+    def get_point_ids_in_sphere(self, center, sphere_radius):
+        """Sorted ids of the points strictly inside the sphere, with the vtkSphere function value."""
+        center = np.asarray(center, dtype=np.float64)
+        point_ids = np.asarray(self.tree.query_ball_point(center, sphere_radius * (1.0 + 1e-9) + 1e-12,
+                                                          return_sorted=True), dtype=np.int64)
+        inside = np.sum((self.tree.data[point_ids] - center) ** 2, axis=1) - sphere_radius ** 2 < 0.0
+        return point_ids[inside]
+
+    def get_cell_ids_in_sphere(self, center, sphere_radius):
+        """Sorted ids of the cells with every point strictly inside the sphere."""
+        point_ids = self.get_point_ids_in_sphere(center, sphere_radius)
+        # A cell is inside when all its point uses are among the cells of the inside points
+        sizes = self.point_offsets[point_ids + 1] - self.point_offsets[point_ids]
+        positions = np.arange(np.sum(sizes)) - np.repeat(np.cumsum(sizes) - sizes - self.point_offsets[point_ids],
+                                                         sizes)
+        inside_counts = np.bincount(self.point_cell_ids[positions], minlength=len(self.cell_sizes))
+        return np.flatnonzero(inside_counts == self.cell_sizes)
@@ -0,0 +1,77 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class TimeStepEngine:
+    """
+    Runs independent CFD time steps in worker processes. Every worker rebuilds a Stage from the state
+    of the prepared one and keeps it, with its caches, for all the steps it gets. The extraction index is
+    only loaded there, as built from time step 0 before the run. Flow rates come back in time-step order.
+    """
+    stage = None
+
+    def __init__(self, stage_state, max_workers, memory_limit=0):
+        self.stage_state = stage_state
+        self.max_workers = max_workers
+        self.memory_limit = memory_limit
+
+    @classmethod
+    def get_worker_count(cls, requested_workers, memory_limit=0):
+        """Requested workers, at most one per CPU and no more than fit in physical memory at memory_limit MB."""
+        worker_count = max(1, min(requested_workers, os.cpu_count() or 1))
+        if memory_limit > 0 and hasattr(os, "sysconf"):
+            try:
+                physical_memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+                worker_count = max(1, min(worker_count, physical_memory // (memory_limit * 1024 * 1024)))
+            except (ValueError, OSError):
+                pass
+        return worker_count
+
+    @classmethod
+    def set_memory_limit(cls, memory_limit):
+        if resource is None:
+            print("Worker memory limit is not supported on this platform")
+            return
+        limit = memory_limit * 1024 * 1024
+        # RLIMIT_DATA covers heap and anonymous mappings on Linux, where the large VTK arrays live
+        limit_kind = getattr(resource, "RLIMIT_DATA", resource.RLIMIT_AS)
+        try:
+            resource.setrlimit(limit_kind, (limit, limit))
+        except (ValueError, OSError) as e:
+            print(f"Worker memory limit could not be set: {e}")
+
+    @classmethod
+    def initialize_worker(cls, stage_state, memory_limit):
+        # Imported here: Stage imports this module
+        from FilesConfiguraiton import FilesConfiguration
+        from Stage import Stage
+
+        if memory_limit > 0:
+            cls.set_memory_limit(memory_limit)
+        files_configuration = FilesConfiguration(stage_state["case_code"], stage_state["side_chooser"])
+        cls.stage = Stage(files_configuration, stage_state["side_chooser"])
+        cls.stage.set_time_step_state(stage_state)
+        cls.stage.start_write_behind()
+
+    @classmethod
+    def process_time_step(cls, time_step):
+        try:
+            flow_rates = cls.stage.process_time_step(time_step, cls.stage.flow_input_files[time_step])
+            # The step's files are on disk before its flow rates are reported
+            cls.stage.flush_writes()
+            return time_step, flow_rates
+        except MemoryError:
+            raise MemoryError(f"Time step {time_step} exceeded the worker memory limit")
+
+    def run(self, time_steps):
+        # Spawned, not forked: the pool is started from a worker thread of a process running Qt and VTK threads
+        with ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=self.initialize_worker,
+                                 initargs=(self.stage_state, self.memory_limit)) as executor:
+            for time_step, flow_rates in executor.map(self.process_time_step, time_steps):
+                yield time_step, flow_rates
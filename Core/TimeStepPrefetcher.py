@@ -0,0 +1,77 @@
+import queue
+import threading
+
+
+class TimeStepPrefetcher:
+    """
+    Loads upcoming time steps in a background thread, at most `depth` ahead of the consumer.
+    With a memory budget (MB), the thread also waits while the grids already queued, plus one more of
+    the last loaded size, would not fit. A single queued grid is always allowed so the loop never stalls.
+    Iterating yields (time_step, grid) in order; a loading error is raised in the consumer.
+    """
+    def __init__(self, load_time_step, time_steps, depth, memory_budget=0):
+        self.load_time_step = load_time_step
+        self.time_steps = time_steps
+        self.memory_budget = memory_budget * 1024 * 1024
+        self.prefetched = queue.Queue(maxsize=depth)
+        self.queued_bytes = 0
+        self.last_grid_bytes = 0
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.prefetch, daemon=True)
+
+    @classmethod
+    def get_memory_size(cls, dataset):
+        if dataset is None:
+            return 0
+        return dataset.GetActualMemorySize() * 1024
+
+    def has_room(self):
+        return self.stopped.is_set() or self.memory_budget <= 0 or self.queued_bytes == 0 or \
+            self.queued_bytes + self.last_grid_bytes <= self.memory_budget
+
+    def prefetch(self):
+        for time_step, vtk_file in self.time_steps:
+            with self.condition:
+                self.condition.wait_for(self.has_room)
+            if self.stopped.is_set():
+                return
+
+            try:
+                grid = self.load_time_step(time_step, vtk_file)
+            except Exception as e:
+                self.put((time_step, None, 0, e))
+                return
+
+            grid_bytes = self.get_memory_size(grid)
+            with self.condition:
+                self.queued_bytes += grid_bytes
+                self.last_grid_bytes = grid_bytes
+            self.put((time_step, grid, grid_bytes, None))
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.prefetched.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def stop(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+
+    def __iter__(self):
+        self.thread.start()
+        try:
+            for _ in self.time_steps:
+                time_step, grid, grid_bytes, error = self.prefetched.get()
+                with self.condition:
+                    self.queued_bytes -= grid_bytes
+                    self.condition.notify_all()
+                if error is not None:
+                    raise error
+                yield time_step, grid
+        finally:
+            self.stop()
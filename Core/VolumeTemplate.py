@@ -0,0 +1,112 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from vtkmodules.util.numpy_support import vtk_to_numpy
+from VTKModule.VTKReader import VTKReader as vtkRdr
+from VTKModule.VTKUtils import VTKUtils as vtkUtl
+from VTKModule.VTKConvertor import VTKConvertor as vtkCnvrt
+
+
+class VolumeTemplate:
+    """
+    One artery side of the carotid grid, clipped and registered once.
+    Clipped points that are grid points take their flow directly from the grid. Points created on the
+    clip plane take it from re-clipping only the cells cut by the plane, which gives the same values as
+    clipping the whole grid. Each time step then only rotates the flow and injects it into the
+    registered geometry. The template holds while the grid geometry and the clip plane are unchanged.
+    """
+    def __init__(self, grid_key, clipper_plane, transformation_matrix_np, clipped_volume, registered_volume,
+                 grid_rows, grid_point_ids, cut_rows=None, cut_point_ids=None, cut_grid=None, cut_output_ids=None):
+        self.grid_key = grid_key
+        self.clipper_plane = clipper_plane
+        self.clipper_key = self.get_clipper_key(clipper_plane)
+        self.transformation_matrix_np = transformation_matrix_np
+        self.clipped_volume = clipped_volume
+        self.registered_volume = registered_volume
+        self.grid_rows = grid_rows
+        self.grid_point_ids = grid_point_ids
+        self.cut_rows = cut_rows
+        self.cut_point_ids = cut_point_ids
+        self.cut_grid = cut_grid
+        self.cut_output_ids = cut_output_ids
+
+    @classmethod
+    def get_grid_key(cls, carotid_arteries_grid):
+        return vtkUtl.get_mesh_fingerprint(carotid_arteries_grid)
+
+    @classmethod
+    def get_clipper_key(cls, clipper_plane):
+        return tuple(clipper_plane.GetOrigin()), tuple(clipper_plane.GetNormal())
+
+    @classmethod
+    def build(cls, carotid_arteries_grid, clipper_plane, transformation_matrix_np):
+        if not vtkRdr.has_linear_cell_arrays(carotid_arteries_grid):
+            return None
+
+        clipped_volume = vtkUtl.get_divided_dataset(clipper_plane, carotid_arteries_grid)
+        if clipped_volume is None:
+            return None
+        registered_volume = vtkUtl.apply_transformation_to_volume(clipped_volume, transformation_matrix_np)
+        if registered_volume is None:
+            return None
+
+        grid_points = vtk_to_numpy(carotid_arteries_grid.GetPoints().GetData())
+        clipped_points = vtk_to_numpy(clipped_volume.GetPoints().GetData())
+        distances, nearest_ids = cKDTree(grid_points).query(clipped_points)
+        on_grid = distances == 0.0
+        grid_rows = np.flatnonzero(on_grid)
+        grid_point_ids = nearest_ids[on_grid]
+        if on_grid.all():
+            return cls(cls.get_grid_key(carotid_arteries_grid), clipper_plane, transformation_matrix_np,
+                       clipped_volume, registered_volume, grid_rows, grid_point_ids)
+
+        # Cells with points on both sides of the plane are the only ones producing new points
+        cells = carotid_arteries_grid.GetCells()
+        offsets = vtk_to_numpy(cells.GetOffsetsArray())
+        connectivity = vtk_to_numpy(cells.GetConnectivityArray())
+        plane_values = (grid_points - np.array(clipper_plane.GetOrigin())) @ np.array(clipper_plane.GetNormal())
+        connectivity_values = plane_values[connectivity]
+        cut_cells = (np.minimum.reduceat(connectivity_values, offsets[:-1]) <= 0.0) & \
+                    (np.maximum.reduceat(connectivity_values, offsets[:-1]) >= 0.0)
+        cut_cell_point_ids = np.unique(connectivity[np.repeat(cut_cells, np.diff(offsets))])
+
+        cut_point_ids, _, cut_offsets, cut_connectivity, cut_cell_types = \
+            vtkRdr.get_extraction_arrays(carotid_arteries_grid, cut_cell_point_ids)
+        cut_grid = vtkCnvrt.numpy_to_vtk_unstructured_grid(grid_points[cut_point_ids], cut_offsets,
+                                                           cut_connectivity, cut_cell_types)
+        cut_rows = np.flatnonzero(~on_grid)
+        cut_clipped_volume = vtkUtl.get_divided_dataset(
+            clipper_plane, vtkUtl.get_volume_with_flow(cut_grid, np.zeros((len(cut_point_ids), 3))))
+        if cut_clipped_volume is None:
+            return None
+        distances, cut_output_ids = cKDTree(vtk_to_numpy(cut_clipped_volume.GetPoints().GetData())).query(
+            clipped_points[cut_rows])
+        if np.any(distances != 0.0):
+            print("Clipped volume could not be matched to its cut cells, clipping every time step")
+            return None
+
+        return cls(cls.get_grid_key(carotid_arteries_grid), clipper_plane, transformation_matrix_np,
+                   clipped_volume, registered_volume, grid_rows, grid_point_ids, cut_rows, cut_point_ids, cut_grid,
+                   cut_output_ids)
+
+    def matches(self, carotid_arteries_grid, clipper_plane):
+        return self.clipper_key == self.get_clipper_key(clipper_plane) and \
+            self.grid_key == self.get_grid_key(carotid_arteries_grid)
+
+    def get_clipped_flow(self, carotid_arteries_grid):
+        flow_data = vtkUtl.get_point_array(carotid_arteries_grid)
+        clipped_flow = np.empty((self.clipped_volume.GetNumberOfPoints(), flow_data.shape[1]), dtype=flow_data.dtype)
+        clipped_flow[self.grid_rows] = flow_data[self.grid_point_ids]
+        if self.cut_rows is not None:
+            cut_volume = vtkUtl.get_volume_with_flow(self.cut_grid, flow_data[self.cut_point_ids])
+            cut_clipped_volume = vtkUtl.get_divided_dataset(self.clipper_plane, cut_volume)
+            clipped_flow[self.cut_rows] = vtkUtl.get_point_array(cut_clipped_volume)[self.cut_output_ids]
+        return clipped_flow
+
+    def apply(self, carotid_arteries_grid):
+        """Clipped and registered volumes of a time step; only the flow arrays are new."""
+        clipped_flow = self.get_clipped_flow(carotid_arteries_grid)
+        rotation_matrix_np = self.transformation_matrix_np[:3, :3]
+        clipped_volume = vtkUtl.get_volume_with_flow(self.clipped_volume, clipped_flow)
+        registered_volume = vtkUtl.get_volume_with_flow(self.registered_volume,
+                                                         np.dot(clipped_flow, rotation_matrix_np.T))
+        return clipped_volume, registered_volume
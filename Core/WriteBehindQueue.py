@@ -0,0 +1,131 @@
+import os
+import queue
+import threading
+import zlib
+from VTKModule.Writer import Writer
+
+
+class WriteBehindQueue:
+    """
+    Runs Writer calls in background threads while the caller goes on computing.
+    Writes with the same ordering key (the written path unless given) always go to the same thread, in
+    submission order, so a file written and then read back, rewritten or mirrored keeps the order of the
+    synchronous code. Each thread holds at most `depth` pending writes; submit blocks beyond that. The first
+    write error is raised in the caller by the next submit, wait_for or flush. queue_depth counts the writes
+    not done yet; files_written and bytes_written count only the writes that changed their file, by its size.
+    close stops the threads once the queued writes are done.
+    """
+    def __init__(self, workers, depth=16):
+        self.queues = [queue.Queue(maxsize=depth) for _ in range(workers)]
+        self.pending = {}
+        self.queue_depth = 0
+        self.bytes_written = 0
+        self.files_written = 0
+        self.error = None
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self.drain, args=(write_queue,), daemon=True)
+                        for write_queue in self.queues]
+        for thread in self.threads:
+            thread.start()
+
+    def get_queue(self, order_key):
+        return self.queues[zlib.crc32(order_key.encode()) % len(self.queues)]
+
+    def submit(self, pathName, write, *args, order_key=None, **kwargs):
+        """Queues write(*args, **kwargs), which writes pathName, after the queued writes of order_key."""
+        self.raise_error()
+        with self.condition:
+            self.pending[pathName] = self.pending.get(pathName, 0) + 1
+            self.queue_depth += 1
+        self.get_queue(pathName if order_key is None else order_key).put((pathName, write, args, kwargs))
+
+    @classmethod
+    def get_file_stamp(cls, pathName):
+        try:
+            file_stat = os.stat(pathName)
+        except OSError:
+            return None
+        return file_stat.st_size, file_stat.st_mtime_ns
+
+    def drain(self, write_queue):
+        while True:
+            item = write_queue.get()
+            if item is None:
+                write_queue.task_done()
+                return
+            pathName, write, args, kwargs = item
+            file_stamp = self.get_file_stamp(pathName)
+            written_bytes = 0
+            written = False
+            try:
+                write(*args, **kwargs)
+                new_file_stamp = self.get_file_stamp(pathName)
+                written = new_file_stamp is not None and new_file_stamp != file_stamp
+                if written:
+                    # Writers replace whole files, so the new size is what this write put on disk
+                    written_bytes = new_file_stamp[0]
+            except Exception as e:
+                with self.condition:
+                    if self.error is None:
+                        self.error = (pathName, e)
+            finally:
+                with self.condition:
+                    self.pending[pathName] -= 1
+                    if self.pending[pathName] == 0:
+                        del self.pending[pathName]
+                    self.queue_depth -= 1
+                    if written:
+                        self.bytes_written += written_bytes
+                        self.files_written += 1
+                    self.condition.notify_all()
+                write_queue.task_done()
+
+    def raise_error(self):
+        with self.condition:
+            error = self.error
+            self.error = None
+        if error is not None:
+            pathName, e = error
+            raise RuntimeError(f"Writing {pathName} failed: {e}") from e
+
+    def wait_for(self, pathName):
+        """Blocks until the queued writes of pathName are on disk."""
+        with self.condition:
+            self.condition.wait_for(lambda: pathName not in self.pending)
+        self.raise_error()
+
+    def flush(self, raise_error=True):
+        """Barrier: blocks until every queued write is on disk. Without raise_error a failed write is printed."""
+        for write_queue in self.queues:
+            write_queue.join()
+        if raise_error:
+            self.raise_error()
+            return
+        try:
+            self.raise_error()
+        except RuntimeError as e:
+            print(e)
+
+    def close(self):
+        """Stops the threads after the queued writes; the queue takes no more writes."""
+        for write_queue in self.queues:
+            write_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.raise_error()
+
+    @classmethod
+    def write(cls, write_queue, pathName, write, *args, order_key=None, **kwargs):
+        """write(*args, **kwargs) through write_queue, or right away without one."""
+        if write_queue is None:
+            write(*args, **kwargs)
+            return
+        write_queue.submit(pathName, write, *args, order_key=order_key, **kwargs)
+
+    @classmethod
+    def export_natural_scale_volume(cls, write_queue, pathName, compression="zlib"):
+        """Writer.export_natural_scale_volume of pathName, after the queued writes of pathName."""
+        if not Writer.natural_scale_export:
+            return
+        cls.write(write_queue, Writer.get_natural_scale_pathName(pathName), Writer.export_natural_scale_volume,
+                  pathName, order_key=pathName, compression=compression)
@@ -181,6 +181,12 @@ class FilesConfiguration:
         self.imaging_scale_flow_output_dir = self.current_imaging_scale_dir + "flow\\"
         self.subject_flow_input_dir = self.subject_input_dir + 'flow\\'
 
+    def get_current_imaging_scale_dir(self):
+        return self.current_imaging_scale_dir
+
+    def get_current_natural_scale_dir(self):
+        return self.current_natural_scale_dir
+
     def get_input_dir(self):
         return self.inputs_dir
 
@@ -316,16 +322,35 @@ class FilesConfiguration:
             os.makedirs(right_time_step_dir)
         return right_time_step_dir
 
+    def get_left_interpolation_weights_dir(self):
+        left_weights_dir = self.imaging_scale_flow_output_dir + 'interpolation_weights\\' + 'left\\'
+        os.makedirs(left_weights_dir, exist_ok=True)
+        return left_weights_dir
+
+    def get_right_interpolation_weights_dir(self):
+        right_weights_dir = self.imaging_scale_flow_output_dir + 'interpolation_weights\\' + 'right\\'
+        os.makedirs(right_weights_dir, exist_ok=True)
+        return right_weights_dir
+
     def get_current_full_domain_pathName(self):
         pass
 
+    def get_extraction_index_pathName(self):
+        return self.imaging_scale_flow_output_dir + 'extraction_index.npz'
+
+    def get_raw_input_dir(self, full_domain_pathName):
+        raw_inputs_dir = self.imaging_scale_flow_output_dir + 'raw_inputs\\'
+        os.makedirs(raw_inputs_dir, exist_ok=True)
+        # The step directory itself is created by Writer.write_raw_domain once the conversion is complete
+        return raw_inputs_dir + os.path.splitext(os.path.basename(full_domain_pathName))[0] + '\\'
+
     def get_carotid_arteries_volume_pathName(self, counter):
         path = self.imaging_scale_flow_output_dir + 'time_steps\\' + str(counter) + "\\"
         if not os.path.exists(path):
             os.makedirs(path)
 
         pathName = path + self.project_config.get('Names', 'carotid_arteries')
-        return pathName
+        return self.get_intermediate_pathName(pathName)
 
     def get_left_artery_volume_pathName(self, counter):
         path = self.imaging_scale_flow_output_dir + 'time_steps\\' + str(counter) + "\\" + "left\\"
@@ -333,7 +358,7 @@ class FilesConfiguration:
             os.makedirs(path)
 
         pathName = path + self.project_config.get('Names', 'flow_artery')
-        return pathName
+        return self.get_intermediate_pathName(pathName)
 
     def get_right_artery_volume_pathName(self, counter):
         path = self.imaging_scale_flow_output_dir + 'time_steps\\' + str(counter) + "\\" + "right\\"
@@ -341,7 +366,7 @@ class FilesConfiguration:
             os.makedirs(path)
 
         pathName = path + self.project_config.get('Names', 'flow_artery')
-        return pathName
+        return self.get_intermediate_pathName(pathName)
 
     def get_left_aligned_artery_volume_pathName(self, counter):
         path = self.imaging_scale_flow_output_dir + 'time_steps\\' + str(counter) + "\\" + "left\\"
@@ -349,7 +374,7 @@ class FilesConfiguration:
             os.makedirs(path)
 
         pathName = path + self.project_config.get('Names', 'registration_result')
-        return pathName
+        return self.get_intermediate_pathName(pathName)
 
     def get_right_aligned_artery_volume_pathName(self, counter):
         path = self.imaging_scale_flow_output_dir + 'time_steps\\' + str(counter) + "\\" + "right\\"
@@ -357,7 +382,7 @@ class FilesConfiguration:
             os.makedirs(path)
 
         pathName = path + self.project_config.get('Names', 'registration_result')
-        return pathName
+        return self.get_intermediate_pathName(pathName)
 
     def get_right_volume_time_step_dir(self, counter):
         path = self.imaging_scale_flow_output_dir + 'time_steps\\' + str(counter) + "\\" + "right\\"
@@ -379,6 +404,63 @@ class FilesConfiguration:
     def get_sphere_radius_coef(self):
         return float(self.project_config.get('Parameters', 'sphere_radius_coef'))
 
+    def get_fields_only_time_steps(self):
+        return self.project_config.getboolean('Parameters', 'fields_only_time_steps', fallback=True)
+
+    def get_write_intermediate_volumes(self):
+        return self.project_config.getboolean('Parameters', 'write_intermediate_volumes', fallback=True)
+
+    def get_intermediate_format(self):
+        # legacy (.vtk), vtu (binary compressed XML) or npz (raw NumPy arrays)
+        return self.project_config.get('Parameters', 'intermediate_format', fallback='legacy').strip().lower()
+
+    def get_intermediate_compression(self):
+        # zlib, lz4 or none, for the vtu format
+        return self.project_config.get('Parameters', 'intermediate_compression', fallback='zlib').strip().lower()
+
+    def get_intermediate_pathName(self, pathName):
+        extension = {'vtu': '.vtu', 'npz': '.npz'}.get(self.get_intermediate_format())
+        if extension is None:
+            return pathName
+        return os.path.splitext(pathName)[0] + extension
+
+    def get_section_backend(self):
+        # vtk (extract, cutter) or numpy (bulk slicing of linear cells) for the flow sections
+        return self.project_config.get('Parameters', 'section_backend', fallback='vtk').strip().lower()
+
+    def get_binary_stl(self):
+        # Binary STL files are smaller, but keep their solid name in the header only
+        return self.project_config.getboolean('Parameters', 'binary_stl', fallback=False)
+
+    def get_natural_scale_export(self):
+        # Natural-scale (m) copies of the stored surfaces, planes, volumes and sections, which are kept in mm
+        return self.project_config.getboolean('Parameters', 'natural_scale_export', fallback=True)
+
+    def get_write_behind_workers(self):
+        # Background threads writing the per-step outputs, 0 to write them in the processing thread
+        return self.project_config.getint('Parameters', 'write_behind_workers', fallback=0)
+
+    def get_write_behind_depth(self):
+        # Pending writes per write-behind thread before the processing waits
+        return self.project_config.getint('Parameters', 'write_behind_depth', fallback=16)
+
+    def get_time_step_workers(self):
+        return self.project_config.getint('Parameters', 'time_step_workers', fallback=1)
+
+    def get_worker_memory_limit(self):
+        # Megabytes per time-step worker process, 0 for no limit
+        return self.project_config.getint('Parameters', 'worker_memory_limit', fallback=0)
+
+    def get_raw_input_cache(self):
+        return self.project_config.getboolean('Parameters', 'raw_input_cache', fallback=False)
+
+    def get_prefetch_depth(self):
+        return self.project_config.getint('Parameters', 'prefetch_depth', fallback=0)
+
+    def get_prefetch_memory_budget(self):
+        # Megabytes of prefetched grids waiting in the queue, 0 for no limit
+        return self.project_config.getint('Parameters', 'prefetch_memory_budget', fallback=0)
+
     def get_combined_left_namePath(self):
         return self.current_imaging_scale_geometry_dir + "left\\" + \
                self.project_config.get('Names', 'combined')
@@ -1,4 +1,5 @@
-from PyQt5.QtWidgets import QWidget, QPushButton, QGroupBox, QHBoxLayout, QLineEdit, QFormLayout, QDialog, QVBoxLayout
+from PyQt5.QtWidgets import QWidget, QPushButton, QGroupBox, QHBoxLayout, QLineEdit, QFormLayout, QDialog, QVBoxLayout, \
+    QLabel
 from PyQt5.QtCore import pyqtSignal
 from GUI.Styles import button_style, group_style
 
@@ -6,12 +7,14 @@ from GUI.Styles import button_style, group_style
 class ClippedSurfaceWidget(QWidget):
     confirm_clicked_signal = pyqtSignal(float)
     update_parameters_signal = pyqtSignal(float, float)
+    preview_variation_rate_signal = pyqtSignal(float)
 
     def __init__(self):
         super().__init__()
         self.sphere_radius_coef = None
         self.variation_rate = None
         self.cutplane_size_coef = None
+        self.clipper_preview_label = None
         self.confirm_clipped = QPushButton("Confirm")
         self.try_again_clipped = QPushButton("Modify")
 
@@ -73,6 +76,12 @@ class ClippedSurfaceWidget(QWidget):
         layout.addRow("Sphere Radius Coefficient", self.sphere_radius_coef_input)
         layout.addRow("Cut Planes Size Coefficient", self.cutplane_size_coef_input)
 
+        # Clipper points of the typed rate, updated while typing
+        self.clipper_preview_label = QLabel()
+        layout.addRow("Clipper Points:", self.clipper_preview_label)
+        self.variation_rate_input.textChanged.connect(self.variation_rate_edited)
+        self.variation_rate_edited(self.variation_rate_input.text())
+
         btn_layout = QHBoxLayout()
         apply_btn = QPushButton("Apply")
         apply_btn.clicked.connect(lambda: self.apply_clipped_changes(dialog))
@@ -87,6 +96,18 @@ class ClippedSurfaceWidget(QWidget):
         dialog.setLayout(layout)
         dialog.exec_()
 
+    def variation_rate_edited(self, text):
+        try:
+            variation_rate = float(text)
+        except ValueError:
+            self.set_clipper_preview("")
+            return
+        self.preview_variation_rate_signal.emit(variation_rate)
+
+    def set_clipper_preview(self, text):
+        if self.clipper_preview_label is not None:
+            self.clipper_preview_label.setText(text)
+
     def apply_clipped_changes(self, dialog):
         try:
             self.variation_rate = float(self.variation_rate_input.text())
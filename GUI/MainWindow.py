@@ -81,6 +81,7 @@ class VTKPipelineGUI(QMainWindow):
         self.clipped_surface_widget = ClippedSurfaceWidget()
         self.clipped_surface_widget.confirm_clicked_signal.connect(self.confirm_clipped_pushed)
         self.clipped_surface_widget.update_parameters_signal.connect(self.apply_clipped_changes)
+        self.clipped_surface_widget.preview_variation_rate_signal.connect(self.preview_clipped_changes)
 
         # ------------------------Cut Plane----------------------------------------
 
@@ -299,6 +300,16 @@ class VTKPipelineGUI(QMainWindow):
 
         self.cutPlane_widget.enable_buttons()
 
+    def preview_clipped_changes(self, variation_rate):
+        if self.stage is None:
+            return
+        preview = []
+        for side, clipper_ids in self.stage.get_clipper_point_ids(variation_rate).items():
+            ids = ", ".join(f"{k} {clipper_ids[k][0]}" if clipper_ids[k][0] >= 0 else f"{k} none"
+                            for k in clipper_ids)
+            preview.append(f"{side}: {ids}")
+        self.clipped_surface_widget.set_clipper_preview("\n".join(preview))
+
     def apply_clipped_changes(self, variation_rate, sphere_radius_coef):
         actor_plot_left, actor_plot_right = self.stage.get_clipped_arteries_surface(variation_rate, sphere_radius_coef)
         if actor_plot_left is not None:
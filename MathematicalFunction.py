@@ -2,7 +2,6 @@ import numpy as np
 from scipy.spatial.transform import Rotation
 import pyvista as pv
 import pandas as pd
-from collections import defaultdict
 from scipy.spatial import KDTree
 import re
 
@@ -191,23 +190,27 @@ class MathematicalFunction:
         print(f"Remeshed STL saved as {output_file}")
 
     @classmethod
-    def load_stl_points_and_boundary(cls, file_path):
-        mesh_data = mesh.Mesh.from_file(file_path)
-        points = np.vstack((mesh_data.v0, mesh_data.v1, mesh_data.v2))
-        points = np.unique(points, axis=0)
-
-        # Identify boundary edges (edges belonging to only one triangle)
-        edges = defaultdict(int)
-        for i in range(len(mesh_data.vectors)):
-            triangle = [mesh_data.v0[i], mesh_data.v1[i], mesh_data.v2[i]]
-            for j in range(3):
-                edge = tuple(sorted([tuple(triangle[j]), tuple(triangle[(j + 1) % 3])]))
-                edges[edge] += 1
+    def read_stl_triangles(cls, file_path):
+        """Vertex coordinates of the STL triangles, as an (n, 3, 3) array."""
+        surface = pv.read(file_path)
+        if not surface.is_all_triangles:
+            surface = surface.triangulate()
+        return surface.points[surface.faces.reshape(-1, 4)[:, 1:]]
 
-        boundary_edges = [edge for edge, count in edges.items() if count == 1]
-        boundary_points = np.unique([point for edge in boundary_edges for point in edge], axis=0)
+    @classmethod
+    def get_boundary_edges(cls, triangles):
+        # Vertices are matched by their exact coordinates, as in the STL file
+        points, vertex_ids = np.unique(triangles.reshape(-1, 3), axis=0, return_inverse=True)
+        vertex_ids = vertex_ids.reshape(-1, 3)
+        edges = np.sort(np.concatenate((vertex_ids[:, [0, 1]], vertex_ids[:, [1, 2]], vertex_ids[:, [2, 0]])), axis=1)
+        # Boundary edges belong to only one triangle
+        edges, counts = np.unique(edges, axis=0, return_counts=True)
+        return points, edges[counts == 1]
 
-        return points, boundary_points
+    @classmethod
+    def load_stl_points_and_boundary(cls, file_path):
+        points, boundary_edges = cls.get_boundary_edges(cls.read_stl_triangles(file_path))
+        return points, points[np.unique(boundary_edges)]
 
     @classmethod
     def find_intersection_points(cls, boundary_points1, boundary_points2, threshold=1e-3):
@@ -224,24 +227,38 @@ class MathematicalFunction:
         print(f"Intersection points saved to {output_file}")
 
     @classmethod
-    def reciprocal_closest_point(cls, df1, df2):
-        matches = []
-        for i, point_A in df1.iterrows():
-            point_A_coords = [point_A['X'], point_A['Y'], point_A['Z']]
-            distances_B = df2.apply(
-                lambda point_B: cls.distance(point_A_coords, [point_B['X'], point_B['Y'], point_B['Z']]), axis=1)
-            idx_B = distances_B.idxmin()
-            point_B_coords = [df2.loc[idx_B, 'X'], df2.loc[idx_B, 'Y'], df2.loc[idx_B, 'Z']]
+    def get_first_nearest(cls, tree, query_points):
+        # Nearest tree point of every query point; equally near points go to the lowest index, as idxmin does
+        distances, indices = tree.query(query_points, k=min(2, tree.n))
+        if distances.ndim == 1:
+            return distances, indices
+        nearest_distances, nearest_indices = distances[:, 0], indices[:, 0]
+        tied = np.flatnonzero(distances[:, 1] <= nearest_distances * (1.0 + 1e-9) + 1e-12)
+        for i in tied:
+            candidates = np.sort(tree.query_ball_point(query_points[i], nearest_distances[i] * (1.0 + 1e-9) + 1e-12))
+            candidate_distances = np.linalg.norm(tree.data[candidates] - query_points[i], axis=1)
+            nearest_indices[i] = candidates[np.argmin(candidate_distances)]
+            nearest_distances[i] = np.min(candidate_distances)
+        return nearest_distances, nearest_indices
 
-            distances_A_check = df1.apply(lambda point_A_check: cls.distance(point_B_coords,
-                                                                             [point_A_check['X'], point_A_check['Y'],
-                                                                              point_A_check['Z']]), axis=1)
-            idx_A_check = distances_A_check.idxmin()
-
-            if idx_A_check == i:
-                matches.append((i, idx_B))
-
-        return matches
+    @classmethod
+    def reciprocal_closest_point(cls, df1, df2, threshold=None):
+        """
+        Mutual nearest neighbours of the X, Y, Z points of df1 and df2, closer than threshold when given.
+        Returns the df1 and df2 index labels of the matches as two arrays, in df1 order; zipped, they are the
+        (i, idx_B) pairs of the former row-by-row search.
+        """
+        points1 = df1[['X', 'Y', 'Z']].to_numpy(dtype=np.float64)
+        points2 = df2[['X', 'Y', 'Z']].to_numpy(dtype=np.float64)
+        if len(points1) == 0 or len(points2) == 0:
+            return df1.index[:0].to_numpy(), df2.index[:0].to_numpy()
+
+        distances, nearest2 = cls.get_first_nearest(KDTree(points2), points1)
+        _, nearest1 = cls.get_first_nearest(KDTree(points1), points2)
+        mutual = nearest1[nearest2] == np.arange(len(points1))
+        if threshold is not None:
+            mutual &= distances < threshold
+        return df1.index.to_numpy()[mutual], df2.index.to_numpy()[nearest2[mutual]]
 
     @classmethod
     def distance(cls, p1, p2):
@@ -249,31 +266,47 @@ class MathematicalFunction:
 
     @classmethod
     def update_or_use_existing_values(cls, df_source, idx_source, df_target, idx_target):
-        if np.all(df_target.loc[idx_target, ['X_NEW', 'Y_NEW', 'Z_NEW']] != 0):
-            df_source.loc[idx_source, ['X_NEW', 'Y_NEW', 'Z_NEW']] = df_target.loc[
-                idx_target, ['X_NEW', 'Y_NEW', 'Z_NEW']]
-        else:
-            point_source = df_source.loc[idx_source, ['X', 'Y', 'Z']].values
-            point_target = df_target.loc[idx_target, ['X', 'Y', 'Z']].values
-            D = cls.interpolate(point_source, point_target)
-            df_source.loc[idx_source, ['X_NEW', 'Y_NEW', 'Z_NEW']] = D
-            df_target.loc[idx_target, ['X_NEW', 'Y_NEW', 'Z_NEW']] = D
+        """
+        Gives the matched points (one label or arrays of labels) a shared new position: the target's if it
+        has one already, else the midpoint of the two.
+        """
+        idx_source, idx_target = np.atleast_1d(idx_source), np.atleast_1d(idx_target)
+        new_columns = ['X_NEW', 'Y_NEW', 'Z_NEW']
+        target_new = df_target.loc[idx_target, new_columns].to_numpy(dtype=np.float64)
+        has_new = np.all(target_new != 0, axis=1)
+        D = cls.interpolate(df_source.loc[idx_source, ['X', 'Y', 'Z']].to_numpy(dtype=np.float64),
+                            df_target.loc[idx_target, ['X', 'Y', 'Z']].to_numpy(dtype=np.float64))
+        df_source.loc[idx_source, new_columns] = np.where(has_new[:, None], target_new, D)
+        df_target.loc[idx_target[~has_new], new_columns] = D[~has_new]
 
     @classmethod
     def update_remaining_points(cls, df):
-        for i, point in df.iterrows():
-            if point['X_NEW'] == 0 and point['Y_NEW'] == 0 and point['Z_NEW'] == 0:
-                point_coords = [point['X'], point['Y'], point['Z']]
-                non_zero_points = df[(df['X_NEW'] != 0) & (df['Y_NEW'] != 0) & (df['Z_NEW'] != 0)]
-                if not non_zero_points.empty:
-                    distances = non_zero_points.apply(lambda non_zero_point: cls.distance(point_coords,
-                                                                                          [non_zero_point['X'],
-                                                                                           non_zero_point['Y'],
-                                                                                           non_zero_point['Z']]),
-                                                      axis=1)
-                    nearest_idx = distances.idxmin()
-                    nearest_coords = non_zero_points.loc[nearest_idx, ['X_NEW', 'Y_NEW', 'Z_NEW']].values
-                    df.loc[i, ['X_NEW', 'Y_NEW', 'Z_NEW']] = nearest_coords
+        """Points without a new position take the one of the nearest point that has it."""
+        new_columns = ['X_NEW', 'Y_NEW', 'Z_NEW']
+        new_points = df[new_columns].to_numpy(dtype=np.float64)
+        remaining = np.flatnonzero(np.all(new_points == 0, axis=1))
+        updated = np.flatnonzero(np.all(new_points != 0, axis=1))
+        if len(remaining) == 0 or len(updated) == 0:
+            return
+
+        points = df[['X', 'Y', 'Z']].to_numpy(dtype=np.float64)
+        _, nearest = cls.get_first_nearest(KDTree(points[updated]), points[remaining])
+        df.loc[df.index[remaining], new_columns] = new_points[updated[nearest]]
+
+    @classmethod
+    def match_interface_points(cls, boundary_points1, boundary_points2, threshold=1e-3):
+        """
+        Stitches two boundaries: mutual closest points nearer than threshold move to their midpoint and the
+        other points follow their nearest matched neighbour. Returns both point sets with X_NEW, Y_NEW, Z_NEW.
+        """
+        columns = ['X', 'Y', 'Z', 'X_NEW', 'Y_NEW', 'Z_NEW']
+        df1 = pd.DataFrame(np.hstack((boundary_points1, np.zeros((len(boundary_points1), 3)))), columns=columns)
+        df2 = pd.DataFrame(np.hstack((boundary_points2, np.zeros((len(boundary_points2), 3)))), columns=columns)
+        idx1, idx2 = cls.reciprocal_closest_point(df1, df2, threshold)
+        cls.update_or_use_existing_values(df1, idx1, df2, idx2)
+        cls.update_remaining_points(df1)
+        cls.update_remaining_points(df2)
+        return df1, df2
 
     @classmethod
     def interpolate(cls, p1, p2):
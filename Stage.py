@@ -6,8 +6,12 @@ from VTKModule.VTKUtils import VTKUtils as vtkUtl
 from VTKModule.VTKConvertor import VTKConvertor as vtkCnvrt
 from Core.Artery import Artery
 from Core.PlaneContainer import PlaneContainer
+from Core.ExtractionIndex import ExtractionIndex
+from Core.VolumeTemplate import VolumeTemplate
+from Core.TimeStepEngine import TimeStepEngine
+from Core.TimeStepPrefetcher import TimeStepPrefetcher
+from Core.WriteBehindQueue import WriteBehindQueue
 from VTKModule.VTKPlot import VTKPlot as vtkplt
-import pyvista as pv
 import numpy as np
 import os
 from collections import OrderedDict
@@ -30,10 +34,18 @@ class Stage(QObject):
         self.right_artery = None
         self.left_pln_contnr = PlaneContainer()
         self.right_pln_contnr = PlaneContainer()
+        self.left_pln_contnr.set_section_backend(self.fl_confg.get_section_backend())
+        self.right_pln_contnr.set_section_backend(self.fl_confg.get_section_backend())
+        Writer.set_binary_stl(self.fl_confg.get_binary_stl())
+        Writer.set_natural_scale_export(self.fl_confg.get_natural_scale_export())
+        Writer.write_units_tag(self.fl_confg.get_current_imaging_scale_dir(), Writer.storage_units)
+        Writer.write_units_tag(self.fl_confg.get_current_natural_scale_dir(), Writer.natural_scale_units)
         self.ica_left_dict = OrderedDict()
         self.ica_right_dict = OrderedDict()
         self.eca_left_dict = OrderedDict()
         self.eca_right_dict = OrderedDict()
+        self.extraction_index = None
+        self.write_queue = None
         self.updated_variation_rate = 0
         self.updated_sphere_coef = 0
         self.updated_planes_coef = 0
@@ -42,15 +54,13 @@ class Stage(QObject):
         if os.path.exists(self.fl_confg.get_left_artery_surface_input_pathName()) and not self.side_chooser == 1:
             left_artery_surface = vtkRdr.read_stl_file(self.fl_confg.get_left_artery_surface_input_pathName())
             Writer.write_stl(left_artery_surface, 'solid left\n', 'endsolid left\n',
-                             self.fl_confg.get_left_artery_surface_path())
-            Writer.write_natural_scale_surface(self.fl_confg.get_left_artery_surface_path())
+                             self.fl_confg.get_left_artery_surface_path(), natural_scale=True)
             self.left_artery = Artery(left_artery_surface.GetOutput())
 
         if os.path.exists(self.fl_confg.get_right_artery_surface_input_pathName()) and not self.side_chooser == 0:
             right_artery_surface = vtkRdr.read_stl_file(self.fl_confg.get_right_artery_surface_input_pathName())
             Writer.write_stl(right_artery_surface, 'solid right\n', 'endsolid right\n',
-                             self.fl_confg.get_right_artery_surface_path())
-            Writer.write_natural_scale_surface(self.fl_confg.get_right_artery_surface_path())
+                             self.fl_confg.get_right_artery_surface_path(), natural_scale=True)
             self.right_artery = Artery(right_artery_surface.GetOutput())
 
         if self.right_artery is not None or self.left_artery is not None:
@@ -61,9 +71,7 @@ class Stage(QObject):
             arteries_polydata = vtkRdr.get_arteries_polydata_from_nifti(self.fl_confg.get_NIFTI_pathName())
             Writer.write_stl(arteries_polydata,
                              'solid original_geometry\n', 'endsolid original_geometry\n',
-                             self.fl_confg.get_original_geometry_namepath())
-
-            Writer.write_natural_scale_surface(self.fl_confg.get_original_geometry_namepath())
+                             self.fl_confg.get_original_geometry_namepath(), natural_scale=True)
 
             vtkUtl.apply_taubin_smoothing(self.fl_confg.get_original_geometry_namepath(),
                                           self.fl_confg.get_smooth_original_geometry_namepath())
@@ -77,7 +85,8 @@ class Stage(QObject):
         smooth_arteries_polydata = vtkRdr.read_stl_file(self.fl_confg.get_smooth_original_geometry_namepath())
         # Plot.render_two_poly_data(arteries_polydata, smooth_arteries_polydata,
         #                           "Original geometry and Smoothed geometry")
-        Writer.write_natural_scale_surface(self.fl_confg.get_smooth_original_geometry_namepath())
+        Writer.export_natural_scale_stl(smooth_arteries_polydata, 'smooth_geometry',
+                                        self.fl_confg.get_smooth_original_geometry_namepath())
         self.set_arteries_surface(smooth_arteries_polydata)
 
     def set_arteries_surface(self, smooth_arteries_polydata):
@@ -106,13 +115,11 @@ class Stage(QObject):
 
         if not self.side_chooser == 1:
             Writer.write_stl(left_artery_surface, 'solid left\n', 'endsolid left\n',
-                             self.fl_confg.get_left_artery_surface_path())
-            Writer.write_natural_scale_surface(self.fl_confg.get_left_artery_surface_path())
+                             self.fl_confg.get_left_artery_surface_path(), natural_scale=True)
 
         if not self.side_chooser == 0:
             Writer.write_stl(right_artery_surface, 'solid right\n', 'endsolid right\n',
-                             self.fl_confg.get_right_artery_surface_path())
-            Writer.write_natural_scale_surface(self.fl_confg.get_right_artery_surface_path())
+                             self.fl_confg.get_right_artery_surface_path(), natural_scale=True)
 
     def extract_arteries_centerline(self, try_again=None, side=None):
         left_centerline_actors = []
@@ -219,17 +226,17 @@ class Stage(QObject):
                                                        self.fl_confg.get_left_clipper_planes_dir(),
                                                        self.fl_confg.get_plane_size())
 
-            self.clip_artery_surface(self.left_artery, self.fl_confg.get_left_artery_surface_path(),
-                                     self.fl_confg.get_left_geometry_dir(),
-                                     self.fl_confg.get_left_clipped_surface_pathName(), self.left_pln_contnr)
+            clipped_artery_left = self.clip_artery_surface(self.left_artery,
+                                                           self.fl_confg.get_left_artery_surface_path(),
+                                                           self.fl_confg.get_left_geometry_dir(),
+                                                           self.fl_confg.get_left_clipped_surface_pathName(),
+                                                           self.left_pln_contnr)
 
-            combined_clipped_artery_left = vtkUtl.combine_stl_files(self.fl_confg.get_left_clipped_surface_pathName(),
-                                                                    self.fl_confg.get_left_geometry_dir(),
-                                                                    self.left_pln_contnr.get_clipper_planes_dict())
+            combined_clipped_artery_left = vtkUtl.combine_surfaces(
+                [clipped_artery_left] + list(self.left_pln_contnr.get_surface_caps().values()), clean=True)
 
             Writer.write_stl(combined_clipped_artery_left, 'solid combined\n', 'endsolid combined\n',
-                             self.fl_confg.get_combined_left_namePath())
-            Writer.write_natural_scale_surface(self.fl_confg.get_combined_left_namePath())
+                             self.fl_confg.get_combined_left_namePath(), natural_scale=True)
             actor_plot_left = vtkplt.render_vtkSTL_file(self.fl_confg.get_combined_left_namePath())
 
         if not self.side_chooser == 0:
@@ -237,33 +244,44 @@ class Stage(QObject):
             self.right_pln_contnr.create_clipper_planes(right_clipper_points, right_clipper_vectors,
                                                         self.fl_confg.get_right_clipper_planes_dir(),
                                                         self.fl_confg.get_plane_size())
-            self.clip_artery_surface(self.right_artery, self.fl_confg.get_right_artery_surface_path(),
-                                     self.fl_confg.get_right_geometry_dir(),
-                                     self.fl_confg.get_right_clipped_surface_pathName(), self.right_pln_contnr)
-            combined_clipped_artery_right = vtkUtl.combine_stl_files(
-                self.fl_confg.get_right_clipped_surface_pathName(),
-                self.fl_confg.get_right_geometry_dir(),
-                self.right_pln_contnr.get_clipper_planes_dict())
+            clipped_artery_right = self.clip_artery_surface(self.right_artery,
+                                                            self.fl_confg.get_right_artery_surface_path(),
+                                                            self.fl_confg.get_right_geometry_dir(),
+                                                            self.fl_confg.get_right_clipped_surface_pathName(),
+                                                            self.right_pln_contnr)
+            combined_clipped_artery_right = vtkUtl.combine_surfaces(
+                [clipped_artery_right] + list(self.right_pln_contnr.get_surface_caps().values()), clean=True)
 
             Writer.write_stl(combined_clipped_artery_right, 'solid combined\n', 'endsolid combined\n',
-                             self.fl_confg.get_combined_right_namePath())
-            Writer.write_natural_scale_surface(self.fl_confg.get_combined_right_namePath())
+                             self.fl_confg.get_combined_right_namePath(), natural_scale=True)
             actor_plot_right = vtkplt.render_vtkSTL_file(self.fl_confg.get_combined_right_namePath())
 
         return actor_plot_left, actor_plot_right
 
+    def get_clipper_point_ids(self, variation_rates):
+        """Clipper point ids per side and branch for each variation rate, without clipping anything."""
+        clipper_ids = OrderedDict()
+        if not self.side_chooser == 1:
+            clipper_ids["left"] = self.left_artery.get_clipper_point_ids(variation_rates)
+        if not self.side_chooser == 0:
+            clipper_ids["right"] = self.right_artery.get_clipper_point_ids(variation_rates)
+        return clipper_ids
+
     def clip_artery_surface(self, artery, surface_artery_pathName, geometry_dir, clipped_path, plane_container):
-        original_geometry = pv.read(surface_artery_pathName)
-        clipped_surface = original_geometry
+        # The artery surface is parsed once and kept by the plane container across tuning rounds
+        clipped_surface = plane_container.get_surface(surface_artery_pathName)
         clipper_points, clipper_vectors = artery.get_clipper_points()
 
         clipped_artery = plane_container.clip_surface(clipped_surface, clipper_points, surface_artery_pathName,
-                                                      geometry_dir, self.updated_sphere_coef)
+                                                      self.updated_sphere_coef)
 
-        Writer.write_clipped_surface(clipped_artery, clipped_path)
+        # Export of the clipping results, which the next steps read back from disk
+        plane_container.write_surface_caps(geometry_dir)
+        Writer.write_clipped_surface(clipped_artery, clipped_path, natural_scale=True)
         # vtkplt.render_vtkSTL_file(clipped_path, "Clipped Surface")
-        Writer.write_natural_scale_surface(clipped_path)
-        Writer.write_bounds_text(clipped_path, float(self.fl_confg.project_config.get('Parameters', 'bounds_criteria')))
+        Writer.write_bounds_text(clipped_path, float(self.fl_confg.project_config.get('Parameters', 'bounds_criteria')),
+                                 clipped_artery)
+        return clipped_artery
 
     def preparing_cut_planes(self, cutplane_size_coef):
         left_actors_dict = None
@@ -309,9 +327,10 @@ class Stage(QObject):
 
         # Sort the list based on the extracted numeric value
         self.flow_input_files = sorted(flow_input_files, key=MathFun.extract_number)
-        current_full_domain_path = os.path.join(current_input_flow, flow_input_files[0])
+        current_full_domain_path = os.path.join(current_input_flow, self.flow_input_files[0])
         if not os.path.exists(self.fl_confg.get_carotid_arteries_volume_pathName(0)):
-            carotid_arteries_grid, full_domain_output = vtkRdr.extract_volume_by_flow(current_full_domain_path)
+            self.prepare_extraction_index()
+            carotid_arteries_grid = self.extract_carotid_arteries_grid(current_full_domain_path)
         else:
             carotid_arteries_grid = vtkRdr.read_vtk_UnstructuredGrid(
                 self.fl_confg.get_carotid_arteries_volume_pathName(0))
@@ -346,8 +365,71 @@ class Stage(QObject):
             self.right_registration_actors_signal.emit(right_registration_actors)
             self.right_artery.set_registration_matrix(right_transform_matrix)
 
+    def start_write_behind(self):
+        write_behind_workers = self.fl_confg.get_write_behind_workers()
+        if write_behind_workers > 0 and self.write_queue is None:
+            self.write_queue = WriteBehindQueue(write_behind_workers, self.fl_confg.get_write_behind_depth())
+
+    def flush_writes(self, raise_error=True, close=False):
+        """
+        Waits for the queued outputs; a failed write is raised here, or only printed without raise_error.
+        With close, at the end of a stage, the write threads are stopped and later writes are synchronous
+        until start_write_behind.
+        """
+        write_queue = self.write_queue
+        if write_queue is None:
+            return
+        if close:
+            self.write_queue = None
+        try:
+            write_queue.flush(raise_error)
+        finally:
+            if close:
+                write_queue.close()
+        print(f"Write-behind: {write_queue.files_written} files, "
+              f"{write_queue.bytes_written / (1024 * 1024):.1f} MB written")
+
     def volume_processing(self):
-        current_input_flow = self.fl_confg.get_input_volume_dir()
+        self.load_vtu_vtp_datasets()
+        if not all(os.path.exists(self.fl_confg.get_carotid_arteries_volume_pathName(time_step))
+                   for time_step in range(len(self.flow_input_files))):
+            self.prepare_extraction_index()
+
+        time_step_workers = TimeStepEngine.get_worker_count(self.fl_confg.get_time_step_workers(),
+                                                            self.fl_confg.get_worker_memory_limit())
+        if time_step_workers > 1 and len(self.flow_input_files) > 1:
+            time_step_engine = TimeStepEngine(self.get_time_step_state(), time_step_workers,
+                                              self.fl_confg.get_worker_memory_limit())
+            for time_step, flow_rates in time_step_engine.run(range(len(self.flow_input_files))):
+                self.set_time_step_flow_rates(time_step, flow_rates)
+            return
+
+        self.start_write_behind()
+        try:
+            self.process_time_steps()
+        except BaseException:
+            # The queued writes still finish, without hiding the error already raised
+            self.flush_writes(raise_error=False, close=True)
+            raise
+        self.flush_writes(close=True)
+
+    def process_time_steps(self):
+        prefetch_depth = self.fl_confg.get_prefetch_depth()
+        if prefetch_depth > 0:
+            # Read and extract the next steps in a background thread while the current one is processed
+            time_step_prefetcher = TimeStepPrefetcher(self.load_carotid_arteries_grid,
+                                                      list(enumerate(self.flow_input_files)), prefetch_depth,
+                                                      self.fl_confg.get_prefetch_memory_budget())
+            for time_step, carotid_arteries_grid in time_step_prefetcher:
+                self.process_time_step(time_step, self.flow_input_files[time_step], carotid_arteries_grid)
+            return
+
+        i = 0
+        for vtk_file in self.flow_input_files:
+            self.process_time_step(i, vtk_file)
+            i += 1
+
+    def load_vtu_vtp_datasets(self):
         if not self.side_chooser == 1:
             vtu_left = vtkRdr.read_XMLUnstructuredGrid(self.fl_confg.get_vtu_left_pathName())
             self.left_artery.set_vtu_dataset(vtu_left.GetOutput())
@@ -360,33 +442,150 @@ class Stage(QObject):
             vtp_right = vtkRdr.read_XMLPolydata(self.fl_confg.get_vtp_right_pathName())
             self.right_artery.set_vtp_dataset(vtp_right.GetOutput())
 
-        i = 0
-        for vtk_file in self.flow_input_files:
-            current_full_domain_path = os.path.join(current_input_flow, vtk_file)
-            if not os.path.exists(self.fl_confg.get_carotid_arteries_volume_pathName(i)):
-                carotid_arteries_grid, full_domain_output = vtkRdr.extract_volume_by_flow(current_full_domain_path)
-                # carotid_arteries_grid = self.carotid_arteries_preProcessing(carotid_arteries_grid)
-
-                # if i == 0:
-                #     vtkplt.render_unstructuredGrid(carotid_arteries_grid, full_domain_output,
-                #                                    "Carotid Arteries and Full domain")
-                Writer.write_UnstructuredGrid(carotid_arteries_grid,
-                                              self.fl_confg.get_carotid_arteries_volume_pathName(i))
-                Writer.write_natural_scale_volume(self.fl_confg.get_carotid_arteries_volume_pathName(i))
-            else:
-                carotid_arteries_grid = vtkRdr.read_vtk_UnstructuredGrid(
-                    self.fl_confg.get_carotid_arteries_volume_pathName(i))
-                # Plot.render_DataSet(self.fl_confg.get_carotid_arteries_volume_pathName(i))
+    def process_time_step(self, time_step, vtk_file, carotid_arteries_grid=None):
+        if carotid_arteries_grid is None:
+            carotid_arteries_grid = self.load_carotid_arteries_grid(time_step, vtk_file)
+
+        registered_left_volume, registered_right_volume = self.split_arteries_volume(carotid_arteries_grid, time_step)
+        flow_rates = self.cut_artery_volume(time_step, registered_left_volume, registered_right_volume)
+
+        time_step_flow_rates = self.calculate_new_flow_rate(time_step, flow_rates)
+        print("==================================")
+        print(f"Process's completed for {time_step}th time")
+        print("\n")
+
+        return time_step_flow_rates
+
+    def load_carotid_arteries_grid(self, time_step, vtk_file):
+        current_full_domain_path = os.path.join(self.fl_confg.get_input_volume_dir(), vtk_file)
+        if not os.path.exists(self.fl_confg.get_carotid_arteries_volume_pathName(time_step)):
+            carotid_arteries_grid = self.extract_carotid_arteries_grid(current_full_domain_path)
+            # carotid_arteries_grid = self.carotid_arteries_preProcessing(carotid_arteries_grid)
+
+            # if i == 0:
+            #     vtkplt.render_unstructuredGrid(carotid_arteries_grid, full_domain_output,
+            #                                    "Carotid Arteries and Full domain")
+            carotid_arteries_pathName = self.fl_confg.get_carotid_arteries_volume_pathName(time_step)
+            compression = self.fl_confg.get_intermediate_compression()
+            WriteBehindQueue.write(self.write_queue, carotid_arteries_pathName, Writer.write_UnstructuredGrid,
+                                   carotid_arteries_grid, carotid_arteries_pathName, compression)
+            WriteBehindQueue.export_natural_scale_volume(self.write_queue, carotid_arteries_pathName, compression)
+        else:
+            carotid_arteries_grid = vtkRdr.read_vtk_UnstructuredGrid(
+                self.fl_confg.get_carotid_arteries_volume_pathName(time_step))
+            # Plot.render_DataSet(self.fl_confg.get_carotid_arteries_volume_pathName(i))
 
-            registered_left_volume, registered_right_volume = self.split_arteries_volume(carotid_arteries_grid, i)
-            self.cut_artery_volume(i, registered_left_volume, registered_right_volume)
+        return carotid_arteries_grid
 
-            self.calculate_new_flow_rate(i)
-            print("==================================")
-            print(f"Process's completed for {i}th time")
-            print("\n")
+    def get_time_step_flow_rates(self, time_step):
+        flow_rates = {}
+        if not self.side_chooser == 1:
+            flow_rates["ica_left"] = self.ica_left_dict[time_step]
+            flow_rates["eca_left"] = self.eca_left_dict[time_step]
+        if not self.side_chooser == 0:
+            flow_rates["ica_right"] = self.ica_right_dict[time_step]
+            flow_rates["eca_right"] = self.eca_right_dict[time_step]
+        return flow_rates
 
-            i += 1
+    def set_time_step_flow_rates(self, time_step, flow_rates):
+        if not self.side_chooser == 1:
+            self.ica_left_dict[time_step] = flow_rates["ica_left"]
+            self.eca_left_dict[time_step] = flow_rates["eca_left"]
+        if not self.side_chooser == 0:
+            self.ica_right_dict[time_step] = flow_rates["ica_right"]
+            self.eca_right_dict[time_step] = flow_rates["eca_right"]
+
+    def get_time_step_state(self):
+        """Everything a time-step worker process needs to rebuild this stage after prepare_volume_processing."""
+        state = {"case_code": self.fl_confg.current_subject_code, "side_chooser": self.side_chooser,
+                 "flow_input_files": self.flow_input_files, "updated_sphere_coef": self.updated_sphere_coef}
+        if not self.side_chooser == 1:
+            state["left_transform"] = self.left_artery.get_combined_transform()
+            state["left_pln_contnr"] = self.left_pln_contnr.get_worker_copy()
+        if not self.side_chooser == 0:
+            state["right_transform"] = self.right_artery.get_combined_transform()
+            state["right_pln_contnr"] = self.right_pln_contnr.get_worker_copy()
+        return state
+
+    def set_time_step_state(self, state):
+        self.flow_input_files = state["flow_input_files"]
+        self.updated_sphere_coef = state["updated_sphere_coef"]
+        if not self.side_chooser == 1:
+            self.left_artery = Artery(None)
+            self.left_artery.set_registration_matrix(state["left_transform"])
+            self.left_pln_contnr = state["left_pln_contnr"]
+        if not self.side_chooser == 0:
+            self.right_artery = Artery(None)
+            self.right_artery.set_registration_matrix(state["right_transform"])
+            self.right_pln_contnr = state["right_pln_contnr"]
+        self.load_vtu_vtp_datasets()
+
+    def prepare_extraction_index(self):
+        """
+        Builds the extraction index from time step 0, unless the saved one was already made from that file.
+        The time steps only load it, in this process or in the workers, so the kept points and cells never
+        depend on which step is processed first.
+        """
+        full_domain_pathName = os.path.join(self.fl_confg.get_input_volume_dir(), self.flow_input_files[0])
+        extraction_index_pathName = self.fl_confg.get_extraction_index_pathName()
+        source_stamp = vtkRdr.get_source_stamp(full_domain_pathName)
+        self.extraction_index = ExtractionIndex.load(extraction_index_pathName)
+        if self.extraction_index is not None and self.extraction_index.source_stamp == source_stamp:
+            return
+
+        print("Building extraction index")
+        self.extraction_index = None
+        if self.fl_confg.get_raw_input_cache():
+            raw_domain = self.get_raw_domain(full_domain_pathName,
+                                             ("points", "flow", "offsets", "connectivity", "cell_types"))
+            if raw_domain is not None:
+                self.extraction_index = ExtractionIndex.build_from_raw_domain(raw_domain)
+        if self.extraction_index is None:
+            self.extraction_index = ExtractionIndex.build(self.read_full_domain(full_domain_pathName))
+        self.extraction_index.source_stamp = source_stamp
+        self.extraction_index.save(extraction_index_pathName)
+
+    def get_extraction_index(self, fingerprint, full_domain_pathName):
+        if self.extraction_index is None:
+            self.extraction_index = ExtractionIndex.load(self.fl_confg.get_extraction_index_pathName())
+        if self.extraction_index is None or not self.extraction_index.matches(fingerprint):
+            raise ValueError(f"The extraction index of time step 0 is missing or does not match the mesh of "
+                             f"{full_domain_pathName}")
+        return self.extraction_index
+
+    @classmethod
+    def read_full_domain(cls, full_domain_pathName):
+        full_domain_output = vtkRdr.read_full_domain(full_domain_pathName, ("flow",))
+        if full_domain_output is None or full_domain_output.GetPoints() is None:
+            raise ValueError(f"Time step file could not be read: {full_domain_pathName}")
+        return full_domain_output
+
+    def get_raw_domain(self, full_domain_pathName, array_names):
+        """Raw arrays of a time-step file, converted first when missing or out of date; None without linear cells."""
+        raw_dir = self.fl_confg.get_raw_input_dir(full_domain_pathName)
+        if vtkRdr.read_raw_domain(raw_dir, (), full_domain_pathName) is None:
+            print("Converting flow data to raw arrays")
+            source_stamp = vtkRdr.get_source_stamp(full_domain_pathName)
+            full_domain_output = self.read_full_domain(full_domain_pathName)
+            if not vtkRdr.has_linear_cell_arrays(full_domain_output):
+                return None
+            Writer.write_raw_domain(full_domain_output, raw_dir, vtkUtl.get_mesh_fingerprint(full_domain_output),
+                                    source_stamp)
+        return vtkRdr.read_raw_domain(raw_dir, array_names, full_domain_pathName)
+
+    def extract_carotid_arteries_grid(self, full_domain_pathName):
+        if self.fl_confg.get_raw_input_cache():
+            raw_domain = self.get_raw_domain(full_domain_pathName, ("points", "flow"))
+            if raw_domain is not None:
+                print("Extracting flow data")
+                extraction_index = self.get_extraction_index(raw_domain["fingerprint"], full_domain_pathName)
+                return extraction_index.apply_to_raw_domain(raw_domain)
+
+        print("Extracting flow data")
+        full_domain_output = self.read_full_domain(full_domain_pathName)
+        extraction_index = self.get_extraction_index(vtkUtl.get_mesh_fingerprint(full_domain_output),
+                                                     full_domain_pathName)
+        return extraction_index.apply(full_domain_output)
 
     def split_arteries_volume(self, carotid_arteries_grid, time_step):
         clip_origin = MathFun.calculate_centerpoint(carotid_arteries_grid)
@@ -396,39 +595,53 @@ class Stage(QObject):
         if not self.side_chooser == 1:
             left_normal = [0.0, 1.0, 0.0]
             left_plane_clipper = vtkUtl.create_divider_plane(clip_origin, left_normal)
-            left_artery_volume = vtkUtl.get_divided_dataset(left_plane_clipper, carotid_arteries_grid)
-            Writer.write_UnstructuredGrid(left_artery_volume,
-                                          self.fl_confg.get_left_artery_volume_pathName(time_step))
-            Writer.write_natural_scale_volume(self.fl_confg.get_left_artery_volume_pathName(time_step))
-
-            registered_left_volume = vtkUtl.apply_transformation_to_volume(left_artery_volume,
-                                                                           self.left_artery.get_combined_transform())
-
-            Writer.write_UnstructuredGrid(registered_left_volume,
-                                          self.fl_confg.get_left_aligned_artery_volume_pathName(time_step))
-            Writer.write_natural_scale_volume(self.fl_confg.get_left_aligned_artery_volume_pathName(time_step))
+            registered_left_volume = self.split_artery_volume(
+                self.left_artery, carotid_arteries_grid, left_plane_clipper,
+                self.fl_confg.get_left_artery_volume_pathName(time_step),
+                self.fl_confg.get_left_aligned_artery_volume_pathName(time_step))
             print("Left Registration Matrix: " + str(self.left_artery.get_combined_transform()))
 
         if not self.side_chooser == 0:
             right_normal = [0.0, -1.0, 0.0]
             right_plane_clipper = vtkUtl.create_divider_plane(clip_origin, right_normal)
-            right_artery_volume = vtkUtl.get_divided_dataset(right_plane_clipper, carotid_arteries_grid)
-            Writer.write_UnstructuredGrid(right_artery_volume,
-                                          self.fl_confg.get_right_artery_volume_pathName(time_step))
-            Writer.write_natural_scale_volume(self.fl_confg.get_right_artery_volume_pathName(time_step))
-
-            registered_right_volume = vtkUtl.apply_transformation_to_volume(right_artery_volume,
-                                                                            self.right_artery.get_combined_transform())
-
-            Writer.write_UnstructuredGrid(registered_right_volume,
-                                          self.fl_confg.get_right_aligned_artery_volume_pathName(time_step))
-            Writer.write_natural_scale_volume(self.fl_confg.get_right_aligned_artery_volume_pathName(time_step))
+            registered_right_volume = self.split_artery_volume(
+                self.right_artery, carotid_arteries_grid, right_plane_clipper,
+                self.fl_confg.get_right_artery_volume_pathName(time_step),
+                self.fl_confg.get_right_aligned_artery_volume_pathName(time_step))
             print("Right Registration Matrix: " + str(self.right_artery.get_combined_transform()))
 
         # Plot.render_unstructuredGrid(left_artery_volume, right_artery_volume, "Left and Right Flow")
 
         return registered_left_volume, registered_right_volume
 
+    def split_artery_volume(self, artery, carotid_arteries_grid, plane_clipper, artery_volume_pathName,
+                            aligned_artery_volume_pathName):
+        artery_volume = None
+        registered_volume = None
+        if self.fl_confg.get_fields_only_time_steps():
+            # Same geometry every time step: clip and register once, then only inject the new flow
+            volume_template = artery.get_volume_template()
+            if volume_template is None or not volume_template.matches(carotid_arteries_grid, plane_clipper):
+                volume_template = VolumeTemplate.build(carotid_arteries_grid, plane_clipper,
+                                                       artery.get_combined_transform())
+                artery.set_volume_template(volume_template)
+            if volume_template is not None:
+                artery_volume, registered_volume = volume_template.apply(carotid_arteries_grid)
+
+        if registered_volume is None:
+            artery_volume = vtkUtl.get_divided_dataset(plane_clipper, carotid_arteries_grid)
+            registered_volume = vtkUtl.apply_transformation_to_volume(artery_volume, artery.get_combined_transform())
+
+        if self.fl_confg.get_write_intermediate_volumes():
+            compression = self.fl_confg.get_intermediate_compression()
+            for volume, pathName in ((artery_volume, artery_volume_pathName),
+                                     (registered_volume, aligned_artery_volume_pathName)):
+                WriteBehindQueue.write(self.write_queue, pathName, Writer.write_UnstructuredGrid, volume, pathName,
+                                       compression)
+                WriteBehindQueue.export_natural_scale_volume(self.write_queue, pathName, compression)
+
+        return registered_volume
+
     @classmethod
     def registration(cls, source_output, target, current_time_step_dir):
         surface_filter = vtkUtl.get_surface_from_volume(source_output)
@@ -466,46 +679,50 @@ class Stage(QObject):
         return combined_transform_matrix, registration_actors
 
     def cut_artery_volume(self, time_step, registered_left_volume, registered_right_volume):
+        """Flow rates of the cut planes and the CCA inlet of each processed side, as PlaneContainer.flow_rate_dtype."""
+        flow_rates = {}
         if not self.side_chooser == 1:
             left_dir = self.fl_confg.get_current_timestep_flow_left_dir(time_step)
             left_scaled_dir = self.fl_confg.get_natural_scale_dir(left_dir)
-            self.left_pln_contnr.cut_volume(registered_left_volume, left_dir, left_scaled_dir,
-                                            self.fl_confg.get_sphere_radius_coef(),
-                                            self.fl_confg.get_natural_left_cut_planes_dir(), "flow_")
-            self.left_pln_contnr.calculate_cca_flow_rate(registered_left_volume, left_dir, left_scaled_dir,
-                                                         self.updated_sphere_coef,
-                                                         self.left_artery.get_vtp_dataset())
-
             print(f"\nvtu_intersection left start {time_step}")
-            self.left_pln_contnr.cut_volume(self.left_artery.get_vtu_dataset(), left_dir, left_scaled_dir,
-                                            self.updated_sphere_coef,
-                                            self.fl_confg.get_natural_left_cut_planes_dir(), "vtu_intersection_", 0.001)
+            left_flow_rates = self.left_pln_contnr.calculate_flow_rates(
+                registered_left_volume, self.left_artery.get_vtu_dataset(), self.fl_confg.get_sphere_radius_coef(),
+                self.updated_sphere_coef, self.fl_confg.get_left_cut_planes_dir(), 0.001,
+                self.fl_confg.get_left_interpolation_weights_dir(), left_dir, left_scaled_dir, self.write_queue)
+            cca_flow_rate = self.left_pln_contnr.calculate_cca_flow_rate(
+                registered_left_volume, left_scaled_dir, self.updated_sphere_coef,
+                self.left_artery.get_vtp_dataset(), self.fl_confg.get_left_interpolation_weights_dir(),
+                self.write_queue)
+            flow_rates["left"] = np.concatenate((left_flow_rates, cca_flow_rate))
 
         if not self.side_chooser == 0:
             right_dir = self.fl_confg.get_current_timestep_flow_right_dir(time_step)
             right_scaled_dir = self.fl_confg.get_natural_scale_dir(right_dir)
-
-            self.right_pln_contnr.cut_volume(registered_right_volume, right_dir, right_scaled_dir,
-                                             self.updated_sphere_coef,
-                                             self.fl_confg.get_natural_right_cut_planes_dir(), "flow_")
-
-            self.right_pln_contnr.calculate_cca_flow_rate(registered_right_volume, right_dir, right_scaled_dir,
-                                                          self.fl_confg.get_sphere_radius_coef(),
-                                                          self.right_artery.get_vtp_dataset())
             print(f"\nvtu_intersection right start {time_step} --------------------------\n")
-
-            self.right_pln_contnr.cut_volume(self.right_artery.get_vtu_dataset(), right_dir, right_scaled_dir,
-                                             self.updated_sphere_coef,
-                                             self.fl_confg.get_natural_right_cut_planes_dir(), "vtu_intersection_",
-                                             0.001)
-
-    def calculate_new_flow_rate(self, time_step):
+            right_flow_rates = self.right_pln_contnr.calculate_flow_rates(
+                registered_right_volume, self.right_artery.get_vtu_dataset(), self.updated_sphere_coef,
+                self.updated_sphere_coef, self.fl_confg.get_right_cut_planes_dir(), 0.001,
+                self.fl_confg.get_right_interpolation_weights_dir(), right_dir, right_scaled_dir, self.write_queue)
+            cca_flow_rate = self.right_pln_contnr.calculate_cca_flow_rate(
+                registered_right_volume, right_scaled_dir, self.fl_confg.get_sphere_radius_coef(),
+                self.right_artery.get_vtp_dataset(), self.fl_confg.get_right_interpolation_weights_dir(),
+                self.write_queue)
+            flow_rates["right"] = np.concatenate((right_flow_rates, cca_flow_rate))
+        return flow_rates
+
+    def wait_for_write(self, pathName):
+        # The boundary files are made from the CCA section, read back from disk
+        if self.write_queue is not None:
+            self.write_queue.wait_for(pathName)
+
+    def calculate_new_flow_rate(self, time_step, flow_rates):
         last_time_parameter = float(self.fl_confg.project_config.get('Parameters', 'last_time'))
         if not self.side_chooser == 1:
             cca_constant_l, new_ica_l, new_eca_l = MathFun.filter_and_average_flow_rates(
-                self.left_pln_contnr.get_flow_rate_dict())
+                PlaneContainer.get_flow_rate_mapping(flow_rates["left"]))
             left_dir = self.fl_confg.get_current_timestep_flow_left_dir(time_step)
             left_scaled_dir = self.fl_confg.get_natural_scale_dir(left_dir)
+            self.wait_for_write(left_scaled_dir + "flow_cca.vtk")
             if time_step == 0:
                 Writer.write_Points_file(left_scaled_dir + "flow_cca.vtk", self.fl_confg.get_cca_left_dir())
 
@@ -516,9 +733,10 @@ class Stage(QObject):
 
         if not self.side_chooser == 0:
             cca_constant_r, new_ica_r, new_eca_r = MathFun.filter_and_average_flow_rates(
-                self.right_pln_contnr.get_flow_rate_dict())
+                PlaneContainer.get_flow_rate_mapping(flow_rates["right"]))
             right_dir = self.fl_confg.get_current_timestep_flow_right_dir(time_step)
             right_scaled_dir = self.fl_confg.get_natural_scale_dir(right_dir)
+            self.wait_for_write(right_scaled_dir + "flow_cca.vtk")
             if time_step == 0:
                 Writer.write_Points_file(right_scaled_dir + "flow_cca.vtk", self.fl_confg.get_cca_right_dir())
 
@@ -527,6 +745,8 @@ class Stage(QObject):
             self.eca_right_dict[time_step] = -new_eca_r
             Writer.write_U_file(right_scaled_dir + "flow_cca.vtk", cca_right_dir, cca_constant_r)
 
+        return self.get_time_step_flow_rates(time_step)
+
     def finalize(self):
         last_time_parameter = float(self.fl_confg.project_config.get('Parameters', 'last_time'))
 
@@ -23,6 +23,39 @@ class VTKConvertor:
             print(str(e))
             return None
 
+    @classmethod
+    def numpy_to_vtk_unstructured_grid(cls, points, offsets, connectivity, cell_types):
+        """Build a vtkUnstructuredGrid from whole point/offset/connectivity/type arrays."""
+        vtk_points = vtk.vtkPoints()
+        vtk_points.SetData(numpy_to_vtk(points, deep=True))
+
+        cell_array = vtk.vtkCellArray()
+        cell_array.SetData(numpy_to_vtk(np.asarray(offsets, dtype=np.int64), deep=True, array_type=vtk.VTK_ID_TYPE),
+                           numpy_to_vtk(np.asarray(connectivity, dtype=np.int64), deep=True,
+                                        array_type=vtk.VTK_ID_TYPE))
+        vtk_cell_types = numpy_to_vtk(np.asarray(cell_types, dtype=np.uint8), deep=True,
+                                      array_type=vtk.VTK_UNSIGNED_CHAR)
+
+        grid = vtk.vtkUnstructuredGrid()
+        grid.SetPoints(vtk_points)
+        grid.SetCells(vtk_cell_types, cell_array)
+        return grid
+
+    @classmethod
+    def numpy_to_vtk_polygons(cls, points, offsets, connectivity):
+        """Build a vtkPolyData of polygons from whole point/offset/connectivity arrays."""
+        vtk_points = vtk.vtkPoints()
+        vtk_points.SetData(numpy_to_vtk(points, deep=True))
+
+        polygons = vtk.vtkCellArray()
+        polygons.SetData(numpy_to_vtk(np.asarray(offsets, dtype=np.int64), deep=True, array_type=vtk.VTK_ID_TYPE),
+                         numpy_to_vtk(np.asarray(connectivity, dtype=np.int64), deep=True, array_type=vtk.VTK_ID_TYPE))
+
+        polydata = vtk.vtkPolyData()
+        polydata.SetPoints(vtk_points)
+        polydata.SetPolys(polygons)
+        return polydata
+
     @classmethod
     def vtk_matrix_to_numpy(cls, vtk_matrix):
         """Convert a vtkMatrix4x4 to a NumPy array."""
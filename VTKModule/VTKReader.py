@@ -1,9 +1,14 @@
 import vtk
+import os
 import numpy as np
 from vtkmodules.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+from VTKModule.VTKConvertor import VTKConvertor as vtkCnvrt
 
 
 class VTKReader:
+    # Units tags already read, by directory
+    units_tags = {}
+
     @classmethod
     def get_arteries_polydata_from_nifti(cls, nifti_file_path):
         reader = vtk.vtkNIFTIImageReader()
@@ -41,47 +46,170 @@ class VTKReader:
     def extract_volume_by_flow(cls, full_domain_pathName):
         print("Extracting flow data")
         # start_time = time.time()
+        full_domain_output = cls.read_full_domain(full_domain_pathName, ("flow",))
+        if full_domain_output is None:
+            return
+
+        flowData = vtk_to_numpy(full_domain_output.GetPointData().GetArray("flow"))
+        filteredIndices = cls.get_flow_point_ids(full_domain_output)
+
+        originalPoints = vtk_to_numpy(full_domain_output.GetPoints().GetData())
+        if cls.has_linear_cell_arrays(full_domain_output):
+            _, _, offsets, connectivity, cell_types = cls.get_extraction_arrays(full_domain_output, filteredIndices)
+            carotid_arteries_grid = vtkCnvrt.numpy_to_vtk_unstructured_grid(originalPoints[filteredIndices], offsets,
+                                                                            connectivity, cell_types)
+        else:
+            carotid_arteries_grid = cls.filter_cells_by_point_ids(full_domain_output, filteredIndices)
+
+        # Add filtered flow data
+        filteredFlowData = flowData[filteredIndices]
+        flowDataVTK = numpy_to_vtk(filteredFlowData)
+        flowDataVTK.SetName("flow")
+        carotid_arteries_grid.GetPointData().AddArray(flowDataVTK)
+
+        return carotid_arteries_grid, full_domain_output
+
+    @classmethod
+    def read_full_domain(cls, full_domain_pathName, array_names=None):
+        """Full CFD domain; with array_names only those point arrays are read, e.g. ("flow",)."""
+        if not cls.get_file_format(full_domain_pathName) == "legacy":
+            return cls.read_dataset(full_domain_pathName, array_names)
         full_domain_reader = vtk.vtkDataSetReader()
         full_domain_reader.SetFileName(full_domain_pathName)
-        full_domain_reader.ReadAllScalarsOn()
+        if array_names is None:
+            full_domain_reader.ReadAllScalarsOn()
         try:
-            full_domain_reader.Update()
+            cls.update_legacy_reader(full_domain_reader, array_names)
         except Exception as e:
             print(str(e))
             return
+        return cls.get_selected_arrays(full_domain_reader.GetOutput(), array_names)
+
+    @classmethod
+    def select_legacy_arrays(cls, legacy_reader, array_names):
+        """
+        The legacy reader only skips whole attributes: with a single wanted array it reads just the
+        SCALARS/VECTORS section of that name; with several it reads every scalar and vector array.
+        """
+        legacy_reader.ReadAllFieldsOff()
+        legacy_reader.ReadAllNormalsOff()
+        legacy_reader.ReadAllTensorsOff()
+        legacy_reader.ReadAllTCoordsOff()
+        legacy_reader.ReadAllColorScalarsOff()
+        if len(array_names) == 1:
+            legacy_reader.ReadAllScalarsOff()
+            legacy_reader.ReadAllVectorsOff()
+            legacy_reader.SetScalarsName(array_names[0])
+            legacy_reader.SetVectorsName(array_names[0])
+            legacy_reader.SetFieldDataName(array_names[0])
+        else:
+            legacy_reader.ReadAllScalarsOn()
+            legacy_reader.ReadAllVectorsOn()
 
-        full_domain_output = full_domain_reader.GetOutput()
+    @classmethod
+    def update_legacy_reader(cls, legacy_reader, array_names=None):
+        """Updates a legacy reader with only array_names selected, if given."""
+        if array_names is not None:
+            cls.select_legacy_arrays(legacy_reader, array_names)
+        legacy_reader.Update()
+        if array_names is not None and not cls.has_point_arrays(legacy_reader.GetOutput(), array_names):
+            # Wanted arrays stored in a FIELD block or under another attribute, read everything instead
+            legacy_reader.ReadAllScalarsOn()
+            legacy_reader.ReadAllVectorsOn()
+            legacy_reader.ReadAllFieldsOn()
+            legacy_reader.Update()
+
+    @classmethod
+    def select_xml_arrays(cls, xml_reader, array_names):
+        # Disabled arrays are never decoded; their appended data is skipped by offset
+        xml_reader.UpdateInformation()
+        xml_reader.GetPointDataArraySelection().DisableAllArrays()
+        xml_reader.GetCellDataArraySelection().DisableAllArrays()
+        for array_name in array_names:
+            xml_reader.SetPointArrayStatus(array_name, 1)
+
+    @classmethod
+    def has_point_arrays(cls, dataset, array_names):
+        return all(dataset.GetPointData().HasArray(array_name) for array_name in array_names)
+
+    @classmethod
+    def get_selected_arrays(cls, dataset, array_names):
+        """Drops the point and cell arrays not in array_names (all are kept for None)."""
+        if array_names is None or dataset is None:
+            return dataset
+        for attributes in (dataset.GetPointData(), dataset.GetCellData()):
+            for i in reversed(range(attributes.GetNumberOfArrays())):
+                array_name = attributes.GetArrayName(i)
+                if array_name not in array_names:
+                    attributes.RemoveArray(array_name)
+        return dataset
+
+    @classmethod
+    def get_flow_point_ids(cls, full_domain_output, threshold=0.0000001):
+        # Points of the fluid region are the ones carrying a non-zero flow vector
+        flowData = vtk_to_numpy(full_domain_output.GetPointData().GetArray("flow"))
+        return cls.get_flow_point_ids_from_array(flowData, threshold)
 
-        # Extract flow data and compute magnitude
-        flow_array = full_domain_output.GetPointData().GetArray("flow")
-        flowData = vtk_to_numpy(flow_array)
+    @classmethod
+    def get_flow_point_ids_from_array(cls, flowData, threshold=0.0000001):
         magflow = np.linalg.norm(flowData, axis=1)
-        filteredIndices = np.where(magflow > 0.0000001)[0]
+        return np.where(magflow > threshold)[0]
 
-        # Map filtered points
-        originalPoints = vtk_to_numpy(full_domain_output.GetPoints().GetData())
-        filteredPoints = originalPoints[filteredIndices]
+    @classmethod
+    def has_linear_cell_arrays(cls, dataset):
+        # Polyhedral cells keep their faces outside the connectivity array, so they need the cell by cell path
+        if not isinstance(dataset, vtk.vtkUnstructuredGrid):
+            return False
+        return vtk.VTK_POLYHEDRON not in vtk_to_numpy(dataset.GetCellTypesArray())
 
-        # Set VTK points in one operation
-        points = vtk.vtkPoints()
-        points.SetData(numpy_to_vtk(filteredPoints))
+    @classmethod
+    def get_extraction_arrays(cls, grid, kept_point_ids):
+        """
+        Select the cells of an unstructured grid whose points are all kept and renumber them.
+        Works on the whole offsets/connectivity/types arrays instead of visiting cells one by one.
+        Returns kept point ids, kept cell ids, new offsets, new connectivity and kept cell types.
+        """
+        cells = grid.GetCells()
+        return cls.get_extraction_arrays_from_cells(grid.GetNumberOfPoints(), vtk_to_numpy(cells.GetOffsetsArray()),
+                                                    vtk_to_numpy(cells.GetConnectivityArray()),
+                                                    vtk_to_numpy(grid.GetCellTypesArray()), kept_point_ids)
 
-        # Create an unstructured grid
-        carotid_arteries_grid = vtk.vtkUnstructuredGrid()
-        carotid_arteries_grid.SetPoints(points)
+    @classmethod
+    def get_extraction_arrays_from_cells(cls, number_of_points, offsets, connectivity, cell_types, kept_point_ids):
+        number_of_cells = len(offsets) - 1
+        kept_point_ids = np.asarray(kept_point_ids, dtype=np.int64)
 
-        # Add filtered flow data
-        filteredFlowData = flowData[filteredIndices]
-        flowDataVTK = numpy_to_vtk(filteredFlowData)
-        flowDataVTK.SetName("flow")
-        carotid_arteries_grid.GetPointData().AddArray(flowDataVTK)
+        point_mask = np.zeros(number_of_points, dtype=bool)
+        point_mask[kept_point_ids] = True
+
+        # A cell is kept when none of its points falls outside the point mask
+        cell_sizes = np.diff(offsets)
+        entry_cell_ids = np.repeat(np.arange(number_of_cells), cell_sizes)
+        missing_points = np.bincount(entry_cell_ids[~point_mask[connectivity]], minlength=number_of_cells)
+        kept_cell_ids = np.flatnonzero(missing_points == 0)
+
+        # Old point id -> new point id lookup
+        index_mapping = np.full(number_of_points, -1, dtype=np.int64)
+        index_mapping[kept_point_ids] = np.arange(len(kept_point_ids), dtype=np.int64)
 
-        # Index mapping
-        index_mapping = {old_index: new_index for new_index, old_index in enumerate(filteredIndices)}
+        kept_sizes = cell_sizes[kept_cell_ids]
+        new_offsets = np.zeros(len(kept_cell_ids) + 1, dtype=np.int64)
+        np.cumsum(kept_sizes, out=new_offsets[1:])
+        new_connectivity = index_mapping[connectivity[np.repeat(missing_points == 0, cell_sizes)]]
+
+        return kept_point_ids, kept_cell_ids, new_offsets, new_connectivity, cell_types[kept_cell_ids]
+
+    @classmethod
+    def filter_cells_by_point_ids(cls, dataset, kept_point_ids):
+        # Cell by cell path, kept for datasets that are not plain unstructured grids (e.g. polyhedral cells)
+        points = vtk.vtkPoints()
+        points.SetData(numpy_to_vtk(vtk_to_numpy(dataset.GetPoints().GetData())[kept_point_ids]))
+        grid = vtk.vtkUnstructuredGrid()
+        grid.SetPoints(points)
 
-        # Iterate over cells (keep your current logic for cell filtering)
-        for cell_id in range(full_domain_output.GetNumberOfCells()):
-            cell = full_domain_output.GetCell(cell_id)
+        index_mapping = {old_index: new_index for new_index, old_index in enumerate(kept_point_ids)}
+        for cell_id in range(dataset.GetNumberOfCells()):
+            cell = dataset.GetCell(cell_id)
             pointIds = cell.GetPointIds()
             new_point_ids = []
             valid_cell = True
@@ -93,9 +221,9 @@ class VTKReader:
                     valid_cell = False
                     break
             if valid_cell:
-                carotid_arteries_grid.InsertNextCell(cell.GetCellType(), len(new_point_ids), new_point_ids)
+                grid.InsertNextCell(cell.GetCellType(), len(new_point_ids), new_point_ids)
 
-        return carotid_arteries_grid, full_domain_output
+        return grid
 
     @classmethod
     def read_stl_file(cls, input_file_path):
@@ -120,15 +248,110 @@ class VTKReader:
         return PolyDataReader.GetOutput()
 
     @classmethod
-    def read_vtk_UnstructuredGrid(cls, input_file_path):
+    def get_file_format(cls, file_path):
+        """"legacy", "xml" or "npz", from the first bytes of the file (legacy for a missing file)."""
+        if not os.path.exists(file_path):
+            return "legacy"
+        with open(file_path, 'rb') as file:
+            header = file.read(64)
+        if header.startswith(b'PK'):
+            return "npz"
+        if header.lstrip().startswith(b'<'):
+            return "xml"
+        return "legacy"
+
+    @classmethod
+    def read_dataset(cls, file_path, array_names=None):
+        """Dataset of a legacy .vtk, XML .vtu/.vtp or .npz intermediate file, optionally with only array_names."""
+        dataset_reader = cls.read_vtk_dataset(file_path, array_names)
+        if dataset_reader is None:
+            return
+        return dataset_reader.GetOutput()
+
+    @classmethod
+    def read_npz_UnstructuredGrid(cls, file_path, array_names=None):
+        try:
+            # np.load is lazy per member, so unwanted arrays are never decompressed
+            with np.load(file_path) as data:
+                grid = vtkCnvrt.numpy_to_vtk_unstructured_grid(data["points"], data["offsets"], data["connectivity"],
+                                                               data["cell_types"])
+                for key in data.files:
+                    if key.startswith("point_data_") and \
+                            (array_names is None or key[len("point_data_"):] in array_names):
+                        point_array = numpy_to_vtk(data[key], deep=True)
+                        point_array.SetName(key[len("point_data_"):])
+                        grid.GetPointData().AddArray(point_array)
+        except Exception as e:
+            print(str(e))
+            return
+        return grid
+
+    @classmethod
+    def read_units(cls, pathName):
+        """Units of a stored file, from the units.txt tag (Writer.write_units_tag) nearest above it; None without one."""
+        parts = pathName.split('\\')
+        for i in range(len(parts) - 1, 0, -1):
+            directory = '\\'.join(parts[:i]) + '\\'
+            if directory not in cls.units_tags:
+                try:
+                    with open(directory + "units.txt", 'r') as file:
+                        cls.units_tags[directory] = file.read().strip()
+                except OSError:
+                    cls.units_tags[directory] = None
+            if cls.units_tags[directory] is not None:
+                return cls.units_tags[directory]
+        return None
+
+    @classmethod
+    def get_source_stamp(cls, pathName):
+        # Size and modification time of the converted file: a regenerated export does not match its cache
+        file_stat = os.stat(pathName)
+        return f"{file_stat.st_size} {file_stat.st_mtime_ns}"
+
+    @classmethod
+    def read_raw_source_stamp(cls, raw_dir):
+        try:
+            with open(raw_dir + "source.txt", 'r') as file:
+                return file.read().strip()
+        except OSError:
+            return None
+
+    @classmethod
+    def read_raw_domain(cls, raw_dir, array_names=("points", "flow", "offsets", "connectivity", "cell_types"),
+                        source_pathName=None):
+        """
+        Memory-mapped arrays of a full domain converted by Writer.write_raw_domain, plus its mesh fingerprint.
+        Only the requested arrays are mapped; pages are read on demand and shared between processes.
+        With source_pathName, None is returned unless the cache was converted from that file as it is now.
+        """
+        if not os.path.exists(raw_dir + "fingerprint.txt"):
+            return None
+        if source_pathName is not None and \
+                cls.read_raw_source_stamp(raw_dir) != cls.get_source_stamp(source_pathName):
+            print(f"Raw domain of {os.path.basename(source_pathName)} is out of date")
+            return None
+        try:
+            with open(raw_dir + "fingerprint.txt", 'r') as file:
+                raw_domain = {"fingerprint": file.read().strip()}
+            for array_name in array_names:
+                raw_domain[array_name] = np.load(raw_dir + array_name + ".npy", mmap_mode='r')
+        except Exception as e:
+            print(f"Raw domain could not be read: {e}")
+            return None
+        return raw_domain
+
+    @classmethod
+    def read_vtk_UnstructuredGrid(cls, input_file_path, array_names=None):
+        if not cls.get_file_format(input_file_path) == "legacy":
+            return cls.read_dataset(input_file_path, array_names)
         gridReader = vtk.vtkUnstructuredGridReader()
         gridReader.SetFileName(input_file_path)
         try:
-            gridReader.Update()
+            cls.update_legacy_reader(gridReader, array_names)
         except Exception as e:
             print(str(e))
             return
-        return gridReader.GetOutput()
+        return cls.get_selected_arrays(gridReader.GetOutput(), array_names)
 
     @classmethod
     def read_XMLUnstructuredGrid(cls, file_path):
@@ -153,12 +376,28 @@ class VTKReader:
         return vtp_reader
 
     @classmethod
-    def read_vtk_dataset(cls, file_path):
-        vtk_reader = vtk.vtkDataSetReader()
+    def read_vtk_dataset(cls, file_path, array_names=None):
+        file_format = cls.get_file_format(file_path)
+        if file_format == "npz":
+            # Same interface as a reader: GetOutput() and GetOutputPort()
+            grid = cls.read_npz_UnstructuredGrid(file_path, array_names)
+            if grid is None:
+                return
+            vtk_reader = vtk.vtkPassThrough()
+            vtk_reader.SetInputData(grid)
+            vtk_reader.Update()
+            return vtk_reader
+        vtk_reader = vtk.vtkXMLGenericDataObjectReader() if file_format == "xml" else vtk.vtkDataSetReader()
         vtk_reader.SetFileName(file_path)
         try:
-            vtk_reader.Update()
+            if file_format == "xml":
+                if array_names is not None:
+                    cls.select_xml_arrays(vtk_reader, array_names)
+                vtk_reader.Update()
+            else:
+                cls.update_legacy_reader(vtk_reader, array_names)
         except Exception as e:
             print(str(e))
             return
+        cls.get_selected_arrays(vtk_reader.GetOutput(), array_names)
         return vtk_reader
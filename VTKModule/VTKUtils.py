@@ -2,13 +2,20 @@ import vtk
 from vtkmodules.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 import vmtk.vmtkscripts as vmtk
 import numpy as np
+import pyvista as pv
 from VTKModule.VTKConvertor import VTKConvertor
 from VTKModule.VTKReader import VTKReader
 import os
 import time
+import hashlib
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 
 
 class VTKUtils:
+    # Linear 3D cells sliced by get_numpy_section: tetra, voxel, hexahedron, wedge, pyramid
+    section_cell_types = (vtk.VTK_TETRA, vtk.VTK_VOXEL, vtk.VTK_HEXAHEDRON, vtk.VTK_WEDGE, vtk.VTK_PYRAMID)
 
     @classmethod
     def create_divider_plane(cls, clip_origin, normal):
@@ -68,30 +75,99 @@ class VTKUtils:
 
     @classmethod
     def get_polydata_cutter(cls, org_stl, pyvista_plane_stl):
-        # Create an implicit function from plane_pyvista1_stl
-        implicit_poly_data_distance = vtk.vtkImplicitPolyDataDistance()
-        implicit_poly_data_distance.SetInput(pyvista_plane_stl)
-
-        # Create a cutter to slice the dataset
+        # Analytic plane of the pyvista plane; the section is then limited to the plane's square extent
         cutter = vtk.vtkCutter()
-        cutter.SetCutFunction(implicit_poly_data_distance)
+        cutter.SetCutFunction(cls.get_analytic_plane(pyvista_plane_stl))
         cutter.SetInputData(org_stl)
         try:
             cutter.Update()
         except Exception as e:
             print(f"Warning: Connectivity failed! Error: {e}")
 
-        return cutter.GetOutput()
+        return cls.get_section_in_plane_extent(cutter.GetOutput(), pyvista_plane_stl)
+
+    @classmethod
+    def get_section_in_plane_extent(cls, section_polydata, pyvista_plane):
+        extent_extractor = vtk.vtkExtractPolyDataGeometry()
+        extent_extractor.SetInputData(section_polydata)
+        # Cut points lie on the plane up to the round-off of the edge interpolation; half the mean edge length
+        # of the section is far above that, and still thin next to the cells
+        thickness = 0.5 * cls.get_mean_edge_length(section_polydata)
+        extent_extractor.SetImplicitFunction(cls.get_plane_extent_box(pyvista_plane, thickness))
+        extent_extractor.ExtractInsideOn()
+        # Cells crossing the rectangle border are dropped, not kept whole
+        extent_extractor.ExtractBoundaryCellsOff()
+        try:
+            extent_extractor.Update()
+        except Exception as e:
+            print(f"Warning: Connectivity failed! Error: {e}")
+
+        return extent_extractor.GetOutput()
+
+    @classmethod
+    def get_mean_edge_length(cls, polydata):
+        offsets, connectivity = cls.get_polydata_cell_arrays(polydata)
+        if len(connectivity) == 0:
+            return 0.0
+        points = vtk_to_numpy(polydata.GetPoints().GetData()).astype(np.float64)
+        # Next point of every cell point, back to the first one at the end of the cell
+        next_points = np.arange(1, len(connectivity) + 1)
+        next_points[offsets[1:] - 1] = offsets[:-1]
+        return np.mean(np.linalg.norm(points[connectivity[next_points]] - points[connectivity], axis=1))
+
+    @classmethod
+    def get_plane_frame(cls, pyvista_plane):
+        """
+        Center, unit normal, in-plane unit axes (2 x 3) and half sizes of the rectangle of a pv.Plane.
+        The axes follow the plane source grid: first point to second point, then normal x first axis.
+        """
+        plane_points = vtk_to_numpy(pyvista_plane.GetPoints().GetData()).astype(np.float64)
+        center = np.array(pyvista_plane.GetCenter())
+        i_axis = plane_points[1] - plane_points[0]
+        i_axis /= np.linalg.norm(i_axis)
+        normal = np.cross(i_axis, plane_points[-1] - plane_points[0])
+        normal /= np.linalg.norm(normal)
+        axes = np.array([i_axis, np.cross(normal, i_axis)])
+        half_sizes = np.abs((plane_points - center) @ axes.T).max(axis=0)
+        return center, normal, axes, half_sizes
+
+    @classmethod
+    def get_analytic_plane(cls, pyvista_plane):
+        center, normal, _, _ = cls.get_plane_frame(pyvista_plane)
+        return cls.create_divider_plane(center, normal)
 
     @classmethod
-    def get_extracted_cells(cls, main_geometry, center, sphere_radius):
-        sphere = vtk.vtkSphere()
-        sphere.SetCenter(center)
-        sphere.SetRadius(sphere_radius)
+    def get_plane_extent_box(cls, pyvista_plane, thickness):
+        """Implicit box of the plane rectangle, thickness to each side of the plane, in the plane frame."""
+        center, normal, axes, half_sizes = cls.get_plane_frame(pyvista_plane)
+        box = vtk.vtkBox()
+        box.SetBounds(-half_sizes[0], half_sizes[0], -half_sizes[1], half_sizes[1], -thickness, thickness)
+
+        # World to plane frame: rows of the rotation are the plane axes
+        matrix = vtk.vtkMatrix4x4()
+        for row, axis in enumerate((axes[0], axes[1], normal)):
+            for column in range(3):
+                matrix.SetElement(row, column, axis[column])
+            matrix.SetElement(row, 3, -np.dot(axis, center))
+        transform = vtk.vtkTransform()
+        transform.SetMatrix(matrix)
+        box.SetTransform(transform)
+        return box
 
-        extractor = vtk.vtkExtractGeometry()
-        extractor.SetImplicitFunction(sphere)
-        if isinstance(main_geometry, vtk.vtkUnstructuredGrid):
+    @classmethod
+    def get_extracted_cells(cls, main_geometry, center, sphere_radius, cell_ids=None):
+        # cell_ids, the cells inside the sphere from a SpatialIndex, spare the test of every cell
+        if cell_ids is not None:
+            extractor = vtk.vtkExtractCells()
+            extractor.SetCellIds(np.ascontiguousarray(cell_ids, dtype=np.int64), len(cell_ids))
+        else:
+            sphere = vtk.vtkSphere()
+            sphere.SetCenter(center)
+            sphere.SetRadius(sphere_radius)
+
+            extractor = vtk.vtkExtractGeometry()
+            extractor.SetImplicitFunction(sphere)
+        if isinstance(main_geometry, vtk.vtkDataSet):
             extractor.SetInputData(main_geometry)
         else:
             extractor.SetInputData(main_geometry.GetOutput())
@@ -116,44 +192,18 @@ class VTKUtils:
 
     @classmethod
     def get_coords_and_connectivity(cls, polydata):
-        points = polydata.GetPoints()
+        """Point coordinates and the lines as offsets plus point ids: line i is ids[offsets[i]:offsets[i + 1]]."""
+        point_coords = np.asarray(vtk_to_numpy(polydata.GetPoints().GetData()), dtype=np.float64)
         lines = polydata.GetLines()
-        # Convert points to a numpy array
-        point_coords = np.array([points.GetPoint(i) for i in range(points.GetNumberOfPoints())])
-        # Extract the connectivity information
-        lines.InitTraversal()
-        idList = vtk.vtkIdList()
-        connectivity = []
-        while lines.GetNextCell(idList):
-            line = [idList.GetId(j) for j in range(idList.GetNumberOfIds())]
-            connectivity.append(line)
+        offsets = np.asarray(vtk_to_numpy(lines.GetOffsetsArray()), dtype=np.int64)
+        connectivity = np.asarray(vtk_to_numpy(lines.GetConnectivityArray()), dtype=np.int64)
 
-        return point_coords, connectivity
+        return point_coords, offsets, connectivity
 
     @classmethod
     def get_radius_list(cls, centerline_polydata):
-        pointData = centerline_polydata.GetPointData()
-        radiusArray = pointData.GetArray("MaximumInscribedSphereRadius")
-        numPoints = centerline_polydata.GetNumberOfPoints()
-        radius_list = []
-        for i in range(numPoints):
-            radius_list.append(radiusArray.GetValue(i))
-
-        return radius_list
-
-    @classmethod
-    def get_radius_for_coord(cls, centerline_polydata, target_coord):
-        point_coords, _ = cls.get_coords_and_connectivity(centerline_polydata)
-        target_coord = np.array(target_coord)
-
-        # Find the index of the target coordinate in the point coordinates array
-        index = np.where((point_coords == target_coord).all(axis=1))[0]
-
-        if len(index) > 0:
-            radius = cls.get_radius_list(centerline_polydata)
-            return radius[index[0]]
-        else:
-            raise ValueError("Coordinate not found in point data.")
+        # A view of the VTK array, valid while the polydata lives
+        return vtk_to_numpy(centerline_polydata.GetPointData().GetArray("MaximumInscribedSphereRadius"))
 
     @classmethod
     def apply_taubin_smoothing(cls, input_file, output_file, num_iterations=300, pass_band=0.1):
@@ -175,35 +225,28 @@ class VTKUtils:
         writer.Write()
 
     @classmethod
-    def get_radius_by_point_id(cls, centerline_polydata, point_id):
-        point_data = centerline_polydata.GetPointData()
-        radius_array = point_data.GetArray("MaximumInscribedSphereRadius")
-        if not radius_array:
-            raise ValueError("Radius array 'MaximumInscribedSphereRadius' not found in point data.")
-
-        return radius_array.GetValue(point_id)
-
-    @classmethod
-    def combine_stl_files(cls, surface_path, planes_dir, clipper_planes):
-        main_surface = VTKReader.read_stl_file(surface_path)
+    def combine_surfaces(cls, surfaces, clean=False):
+        # clean merges points and drops collapsed triangles, as reading the surfaces back from STL does
         append_filter = vtk.vtkAppendPolyData()
-        append_filter.AddInputData(main_surface.GetOutput())
-
-        for k in clipper_planes:
-            # Read each STL file
-            plane_file_path = f"{planes_dir}{k}.stl"
-            reader = vtk.vtkSTLReader()
-            reader.SetFileName(plane_file_path)
-            reader.Update()
-            # Add the geometry to the append filter
-            append_filter.AddInputData(reader.GetOutput())
+        for surface in surfaces:
+            append_filter.AddInputData(surface)
 
         try:
             append_filter.Update()
         except Exception as e:
             print(str(e))
             return
-        return append_filter.GetOutput()
+        if not clean:
+            return append_filter.GetOutput()
+
+        clean_filter = vtk.vtkCleanPolyData()
+        clean_filter.SetInputData(append_filter.GetOutput())
+        try:
+            clean_filter.Update()
+        except Exception as e:
+            print(str(e))
+            return
+        return clean_filter.GetOutput()
 
     @classmethod
     def get_surface_from_volume(cls, vtk_dataset):
@@ -319,46 +362,155 @@ class VTKUtils:
         return cell_sizes
 
     @classmethod
-    def calculate_flow_rate(cls, vtk_dataset):
-        surface_extractor = cls.get_surface_from_volume(vtk_dataset)
-        polydata_normals = cls.get_polydata_normals(surface_extractor)
-        cell_sizes = cls.get_cell_size(polydata_normals)
-
-        normal_polydata = polydata_normals.GetOutput()
-        normals_array = normal_polydata.GetPointData().GetNormals()
+    def get_polydata_cell_arrays(cls, polydata):
+        """Offsets and connectivity of all cells, in cell id order (verts, lines, polys, strips)."""
+        offsets = [np.zeros(1, dtype=np.int64)]
+        connectivity = []
+        for cell_array in (polydata.GetVerts(), polydata.GetLines(), polydata.GetPolys(), polydata.GetStrips()):
+            if cell_array.GetNumberOfCells() == 0:
+                continue
+            offsets.append(vtk_to_numpy(cell_array.GetOffsetsArray())[1:].astype(np.int64) +
+                           offsets[-1][-1])
+            connectivity.append(vtk_to_numpy(cell_array.GetConnectivityArray()))
+        if not connectivity:
+            return offsets[0], np.zeros(0, dtype=np.int64)
+        return np.concatenate(offsets), np.concatenate(connectivity)
 
-        for i in range(normals_array.GetNumberOfTuples()):
-            normal = normals_array.GetTuple(i)
-            if normal[2] < 0:
-                adjusted_normal = (-normal[0], -normal[1], -normal[2])
-                normals_array.SetTuple(i, adjusted_normal)
+    @classmethod
+    def get_cell_arrays(cls, dataset):
+        """Offsets and connectivity of a polydata or of an unstructured grid without polyhedra."""
+        if isinstance(dataset, vtk.vtkPolyData):
+            return cls.get_polydata_cell_arrays(dataset)
+        cells = dataset.GetCells()
+        return vtk_to_numpy(cells.GetOffsetsArray()), vtk_to_numpy(cells.GetConnectivityArray())
 
-        normal_polydata.GetPointData().SetNormals(normals_array)
-        areas = cell_sizes.GetOutput().GetCellData().GetArray("Area")
-        flow_array = normal_polydata.GetPointData().GetArray("flow")
+    @classmethod
+    def get_connected_region(cls, dataset, extraction_mode="largest", closest_point=None):
+        """
+        Cells of one connected region, cells being connected through shared points as in
+        vtkPolyDataConnectivityFilter. "largest" keeps the region with most cells (the first one on ties),
+        "closest" the region of the used point nearest closest_point. The regions are labelled with
+        scipy connected_components on the cell-point graph. A dataset that already is one region with no
+        unused points is returned as it is.
+        """
+        dataset = pv.wrap(dataset)
+        offsets, connectivity = cls.get_cell_arrays(dataset)
+        number_of_cells = len(offsets) - 1
+        number_of_points = dataset.GetNumberOfPoints()
+        if number_of_cells == 0:
+            return dataset
+
+        cell_ids = np.repeat(np.arange(number_of_cells), np.diff(offsets))
+        cell_point_graph = csr_matrix((np.ones(len(connectivity), dtype=np.int8),
+                                       (cell_ids, connectivity + number_of_cells)),
+                                      shape=(number_of_cells + number_of_points, number_of_cells + number_of_points))
+        _, labels = connected_components(cell_point_graph, directed=False)
+        cell_labels = labels[:number_of_cells]
+
+        if extraction_mode == "closest":
+            used_point_ids = np.unique(connectivity)
+            distances = np.linalg.norm(dataset.points[used_point_ids] - np.asarray(closest_point), axis=1)
+            region_label = labels[number_of_cells + used_point_ids[np.argmin(distances)]]
+        else:
+            region_labels, first_cells, region_sizes = np.unique(cell_labels, return_index=True,
+                                                                 return_counts=True)
+            region_label = region_labels[np.lexsort((first_cells, -region_sizes))[0]]
 
-        # Compute flow rate contributions
-        num_cells = normal_polydata.GetNumberOfCells()
-        flow_rate_contributions = np.zeros(num_cells)
-        for i in range(num_cells):
-            cell = normal_polydata.GetCell(i)
-            point_ids = cell.GetPointIds()
-            cell_area = areas.GetValue(i)
-            local_flow = np.zeros(3)
+        kept_cells = cell_labels == region_label
+        if kept_cells.all() and len(np.unique(connectivity)) == number_of_points:
+            return dataset
+        return cls.get_dataset_cells(dataset, np.flatnonzero(kept_cells))
 
-            # Average flow vectors at cell points
-            for pid in range(point_ids.GetNumberOfIds()):
-                local_flow += np.array(flow_array.GetTuple(point_ids.GetId(pid)))
+    @classmethod
+    def get_dataset_cells(cls, dataset, cell_ids):
+        """The given cells, in order, with only the points they use; point and cell data follow."""
+        if not isinstance(dataset, vtk.vtkPolyData):
+            extractor = vtk.vtkExtractCells()
+            extractor.SetInputData(dataset)
+            cell_ids = np.ascontiguousarray(cell_ids, dtype=np.int64)
+            extractor.SetCellIds(cell_ids, len(cell_ids))
+            extractor.Update()
+            return pv.wrap(extractor.GetOutput())
+
+        offsets, connectivity = cls.get_polydata_cell_arrays(dataset)
+        kept_cells = np.zeros(len(offsets) - 1, dtype=bool)
+        kept_cells[cell_ids] = True
+        kept_points = np.zeros(dataset.GetNumberOfPoints(), dtype=bool)
+        kept_points[connectivity[np.repeat(kept_cells, np.diff(offsets))]] = True
+        point_ids = np.flatnonzero(kept_points)
+        new_point_ids = np.cumsum(kept_points) - 1
+
+        output = vtk.vtkPolyData()
+        output_points = vtk.vtkPoints()
+        output_points.SetData(numpy_to_vtk(vtk_to_numpy(dataset.GetPoints().GetData())[point_ids], deep=True))
+        output.SetPoints(output_points)
+
+        # Cell ids run through verts, lines, polys and strips in this order
+        first_cell_id = 0
+        cell_arrays = (dataset.GetVerts(), dataset.GetLines(), dataset.GetPolys(), dataset.GetStrips())
+        setters = (output.SetVerts, output.SetLines, output.SetPolys, output.SetStrips)
+        for cell_array, setter in zip(cell_arrays, setters):
+            number_of_cells = cell_array.GetNumberOfCells()
+            if number_of_cells == 0:
+                continue
+            type_offsets = vtk_to_numpy(cell_array.GetOffsetsArray())
+            type_connectivity = vtk_to_numpy(cell_array.GetConnectivityArray())
+            type_kept_cells = kept_cells[first_cell_id:first_cell_id + number_of_cells]
+            first_cell_id += number_of_cells
+            kept_sizes = np.diff(type_offsets)[type_kept_cells]
+            kept_connectivity = new_point_ids[type_connectivity[np.repeat(type_kept_cells, np.diff(type_offsets))]]
+            output_cells = vtk.vtkCellArray()
+            output_cells.SetData(numpy_to_vtk(np.concatenate([[0], np.cumsum(kept_sizes)]).astype(np.int64),
+                                              deep=True, array_type=vtk.VTK_ID_TYPE),
+                                 numpy_to_vtk(kept_connectivity.astype(np.int64), deep=True,
+                                              array_type=vtk.VTK_ID_TYPE))
+            setter(output_cells)
+
+        for input_data, output_data, ids in ((dataset.GetPointData(), output.GetPointData(), point_ids),
+                                             (dataset.GetCellData(), output.GetCellData(), np.flatnonzero(kept_cells))):
+            for i in range(input_data.GetNumberOfArrays()):
+                input_array = input_data.GetArray(i)
+                if input_array is None:
+                    continue
+                output_array = numpy_to_vtk(np.ascontiguousarray(vtk_to_numpy(input_array)[ids]), deep=True,
+                                            array_type=input_array.GetDataType())
+                output_array.SetName(input_array.GetName())
+                output_data.AddArray(output_array)
+            for attribute in range(vtk.vtkDataSetAttributes.NUM_ATTRIBUTES):
+                active_array = input_data.GetAbstractAttribute(attribute)
+                if active_array is not None and output_data.HasArray(active_array.GetName()):
+                    output_data.SetActiveAttribute(active_array.GetName(), attribute)
+        return pv.wrap(output)
 
-            local_flow /= point_ids.GetNumberOfIds()
+    @classmethod
+    def get_flux(cls, offsets, connectivity, areas, normals, flow):
+        """
+        Sum over cells of area * (mean flow of the cell points . normal of the first cell point).
+        Normals pointing to -z are flipped first.
+        """
+        if len(offsets) < 2:
+            return 0.0
+        normals = np.asarray(normals, dtype=np.float64)
+        normals = np.where(normals[:, 2:3] < 0, -normals, normals)
+        point_counts = np.diff(offsets)
+        cell_flow = np.add.reduceat(np.asarray(flow, dtype=np.float64)[connectivity], offsets[:-1], axis=0)
+        cell_flow /= point_counts[:, None]
+        first_normals = normals[connectivity[offsets[:-1]]]
+        return float(np.sum(np.einsum('ij,ij->i', cell_flow, first_normals) * areas))
 
-            # Use the first point's normal as an approximation
-            normal_vector = np.array(normals_array.GetTuple(point_ids.GetId(0)))
-            flow_rate_contributions[i] = np.dot(local_flow, normal_vector) * cell_area
+    @classmethod
+    def get_section_flow_rate(cls, vtk_dataset):
+        """Flow rate, total area and number of cells of a section carrying a "flow" point array."""
+        surface_extractor = cls.get_surface_from_volume(vtk_dataset)
+        polydata_normals = cls.get_polydata_normals(surface_extractor)
+        cell_sizes = cls.get_cell_size(polydata_normals)
 
-        # Integrate flow rate over the surface
-        integrated_flow_rate = np.sum(flow_rate_contributions)
-        return integrated_flow_rate
+        normal_polydata = polydata_normals.GetOutput()
+        offsets, connectivity = cls.get_polydata_cell_arrays(normal_polydata)
+        areas = vtk_to_numpy(cell_sizes.GetOutput().GetCellData().GetArray("Area"))
+        normals = vtk_to_numpy(normal_polydata.GetPointData().GetNormals())
+        flow = vtk_to_numpy(normal_polydata.GetPointData().GetArray("flow"))
+        return cls.get_flux(offsets, connectivity, areas, normals, flow), float(np.sum(areas)), len(offsets) - 1
 
     @classmethod
     def get_scaled_volume(cls, imaging_volume, scale_factor=0.001):
@@ -428,4 +580,291 @@ class VTKUtils:
         cell_locator.SetDataSet(polydata)
         cell_locator.BuildLocator()
 
-        return cell_locator
\ No newline at end of file
+        return cell_locator
+
+    @classmethod
+    def get_mesh_fingerprint(cls, dataset):
+        """Hash of the point coordinates and cell connectivity; field arrays are not part of it."""
+        fingerprint = hashlib.sha1()
+        fingerprint.update(np.array([dataset.GetNumberOfPoints(), dataset.GetNumberOfCells()], dtype=np.int64))
+        fingerprint.update(np.ascontiguousarray(vtk_to_numpy(dataset.GetPoints().GetData())))
+        if isinstance(dataset, vtk.vtkUnstructuredGrid):
+            fingerprint.update(np.ascontiguousarray(vtk_to_numpy(dataset.GetCells().GetOffsetsArray())))
+            fingerprint.update(np.ascontiguousarray(vtk_to_numpy(dataset.GetCells().GetConnectivityArray())))
+            fingerprint.update(np.ascontiguousarray(vtk_to_numpy(dataset.GetCellTypesArray())))
+        elif isinstance(dataset, vtk.vtkPolyData):
+            for cell_array in cls.get_polydata_cell_arrays(dataset):
+                fingerprint.update(np.ascontiguousarray(cell_array))
+        return fingerprint.hexdigest()
+
+    @classmethod
+    def get_point_array(cls, dataset, array_name="flow"):
+        return vtk_to_numpy(dataset.GetPointData().GetArray(array_name))
+
+    @classmethod
+    def get_volume_with_flow(cls, volume_template, flow_data_np):
+        """Shallow copy of a fixed geometry with a new flow array; cells and points are shared."""
+        volume = volume_template.NewInstance()
+        volume.ShallowCopy(volume_template)
+        flow_array = numpy_to_vtk(np.ascontiguousarray(flow_data_np), deep=True)
+        flow_array.SetName("flow")
+        volume.GetPointData().AddArray(flow_array)
+        return volume
+
+    @classmethod
+    def get_cell_edges(cls, cell_type):
+        """Local point ids of the edges of a linear cell type, shape (number of edges, 2)."""
+        cell = vtk.vtkGenericCell()
+        cell.SetCellType(cell_type)
+        number_of_points = cell.GetNumberOfPoints()
+        cell.GetPointIds().SetNumberOfIds(number_of_points)
+        cell.GetPoints().SetNumberOfPoints(number_of_points)
+        for i in range(number_of_points):
+            cell.GetPointIds().SetId(i, i)
+        edges = []
+        for i in range(cell.GetNumberOfEdges()):
+            edge = cell.GetEdge(i)
+            edges.append([edge.GetPointId(0), edge.GetPointId(1)])
+        return np.array(edges, dtype=np.int64).reshape(-1, 2)
+
+    @classmethod
+    def get_numpy_section(cls, volume, center, sphere_radius, pyvista_plane, cell_ids=None):
+        """
+        Section of the volume cells inside the sphere by the plane, computed with NumPy in bulk, as
+        get_extracted_cells + get_polydata_cutter do with VTK. Each cut cell gives one convex polygon whose
+        points lie on its cut edges, split into fan triangles; point arrays are interpolated linearly
+        along those edges.
+        cell_ids, the cells inside the sphere from a SpatialIndex, replace the sphere test of the volume points.
+        Returns None when the volume has cells other than linear 3D ones.
+        """
+        if not VTKReader.has_linear_cell_arrays(volume):
+            return None
+        points = vtk_to_numpy(volume.GetPoints().GetData())
+        cells = volume.GetCells()
+        offsets = vtk_to_numpy(cells.GetOffsetsArray())
+        connectivity = vtk_to_numpy(cells.GetConnectivityArray())
+        cell_types = vtk_to_numpy(volume.GetCellTypesArray())
+
+        points_64 = points.astype(np.float64)
+        plane_center, plane_normal, plane_axes, _ = cls.get_plane_frame(pyvista_plane)
+        distances = (points_64 - plane_center) @ plane_normal
+
+        # Cut cells have every point strictly inside the sphere, as kept by vtkExtractGeometry, and points
+        # on both sides of the plane. Only cells whose first point is inside are visited; one pass over
+        # their connectivity counts both, as linear cells have fewer than 64 points
+        if cell_ids is None:
+            inside_points = np.sum((points_64 - np.asarray(center, dtype=np.float64)) ** 2, axis=1) - \
+                sphere_radius ** 2 < 0.0
+            candidate_cell_ids = np.flatnonzero(inside_points[connectivity[offsets[:-1]]])
+        else:
+            inside_points = np.ones(len(points), dtype=bool)
+            candidate_cell_ids = np.asarray(cell_ids, dtype=np.int64)
+        candidate_sizes = offsets[candidate_cell_ids + 1] - offsets[candidate_cell_ids]
+        candidate_offsets = np.concatenate([[0], np.cumsum(candidate_sizes)])
+        candidate_connectivity = connectivity[np.arange(candidate_offsets[-1]) - np.repeat(
+            candidate_offsets[:-1] - offsets[candidate_cell_ids], candidate_sizes)]
+        point_flags = inside_points.astype(np.int32) + 64 * (distances < 0.0)
+        flag_sums = np.add.reduceat(point_flags[candidate_connectivity], candidate_offsets[:-1]) \
+            if len(candidate_cell_ids) else np.zeros(0, dtype=np.int32)
+        negative_counts = flag_sums // 64
+        cut_cell_ids = candidate_cell_ids[(flag_sums % 64 == candidate_sizes) & (negative_counts > 0) &
+                                          (negative_counts < candidate_sizes)]
+        if not np.all(np.isin(cell_types[cut_cell_ids], cls.section_cell_types)):
+            return None
+        if len(cut_cell_ids) == 0:
+            return vtk.vtkPolyData()
+
+        cut_cell_types = cell_types[cut_cell_ids]
+        first_ids = []
+        second_ids = []
+        cut_cells_by_type = []
+        for cell_type in np.unique(cut_cell_types):
+            type_cell_ids = cut_cell_ids[cut_cell_types == cell_type]
+            edges = cls.get_cell_edges(int(cell_type))
+            cell_starts = offsets[type_cell_ids][:, None]
+            edge_first_ids = connectivity[cell_starts + edges[:, 0]]
+            edge_second_ids = connectivity[cell_starts + edges[:, 1]]
+            crossing = (distances[edge_first_ids] < 0.0) != (distances[edge_second_ids] < 0.0)
+            cut_cells_by_type.append(np.broadcast_to(type_cell_ids[:, None], crossing.shape)[crossing])
+            first_ids.append(edge_first_ids[crossing])
+            second_ids.append(edge_second_ids[crossing])
+        cut_cell_ids = np.concatenate(cut_cells_by_type)
+        first_ids = np.concatenate(first_ids)
+        second_ids = np.concatenate(second_ids)
+
+        t = -distances[first_ids] / (distances[second_ids] - distances[first_ids])
+        crossing_points = points_64[first_ids] + t[:, None] * (points_64[second_ids] - points_64[first_ids])
+
+        # A point shared by neighbouring cells is keyed by its edge, or by the volume point it falls on
+        key_first_ids = np.where(t == 1.0, second_ids, np.minimum(first_ids, second_ids))
+        key_second_ids = np.where(t == 0.0, first_ids, np.where(t == 1.0, second_ids,
+                                                                np.maximum(first_ids, second_ids)))
+        _, section_point_ids, section_ids = np.unique(key_first_ids * len(points) + key_second_ids,
+                                                      return_index=True, return_inverse=True)
+        section_ids = section_ids.ravel()
+
+        # Polygon points in angular order around the polygon centroid, duplicates removed
+        _, cell_rows, cell_sizes = np.unique(cut_cell_ids, return_inverse=True, return_counts=True)
+        cell_rows = cell_rows.ravel()
+        centroids = np.zeros((len(cell_sizes), 3))
+        np.add.at(centroids, cell_rows, crossing_points)
+        centroids /= cell_sizes[:, None]
+        local_points = (crossing_points - centroids[cell_rows]) @ plane_axes.T
+        angles = np.arctan2(local_points[:, 1], local_points[:, 0])
+        order = np.lexsort((section_ids, angles, cell_rows))
+        cell_rows = cell_rows[order]
+        section_ids = section_ids[order]
+        kept = np.ones(len(order), dtype=bool)
+        kept[1:] = (cell_rows[1:] != cell_rows[:-1]) | (section_ids[1:] != section_ids[:-1])
+        cell_rows = cell_rows[kept]
+        section_ids = section_ids[kept]
+        polygon_sizes = np.bincount(cell_rows, minlength=len(cell_sizes))
+        polygon_starts = np.concatenate([[0], np.cumsum(polygon_sizes)[:-1]])
+
+        # Fan triangles, since vtkCutter also outputs triangles and the flow rate averages per cell
+        triangle_counts = np.maximum(polygon_sizes - 2, 0)
+        triangle_polygons = np.repeat(np.arange(len(polygon_sizes)), triangle_counts)
+        fan_steps = np.arange(len(triangle_polygons)) - np.repeat(np.cumsum(triangle_counts) - triangle_counts,
+                                                                   triangle_counts)
+        triangle_starts = polygon_starts[triangle_polygons]
+        triangles = np.stack([section_ids[triangle_starts], section_ids[triangle_starts + fan_steps + 1],
+                              section_ids[triangle_starts + fan_steps + 2]], axis=1)
+
+        section = VTKConvertor.numpy_to_vtk_polygons(crossing_points[section_point_ids].astype(points.dtype),
+                                                    np.arange(0, 3 * len(triangles) + 1, 3), triangles.ravel())
+        point_data = volume.GetPointData()
+        section_t = t[section_point_ids][:, None]
+        for i in range(point_data.GetNumberOfArrays()):
+            volume_array = point_data.GetArray(i)
+            if volume_array is None:
+                continue
+            volume_data = vtk_to_numpy(volume_array)
+            first_data = volume_data[first_ids[section_point_ids]].astype(np.float64)
+            second_data = volume_data[second_ids[section_point_ids]].astype(np.float64)
+            if volume_data.ndim == 1:
+                section_data = first_data + section_t[:, 0] * (second_data - first_data)
+            else:
+                section_data = first_data + section_t * (second_data - first_data)
+            section_array = numpy_to_vtk(np.ascontiguousarray(section_data.astype(volume_data.dtype)), deep=True)
+            section_array.SetName(volume_array.GetName())
+            section.GetPointData().AddArray(section_array)
+        return section
+
+    @classmethod
+    def get_section_weights(cls, volume, section_points, center, sphere_radius, pyvista_plane, tolerance=1e-5,
+                            cell_ids=None):
+        """
+        Sparse (section points x volume points) matrix such that the section point data is
+        `weights @ volume_point_data`, for a section made by get_extracted_cells and get_polydata_cutter.
+        The cutter puts every section point on a cell edge whose end points have plane distances of
+        opposite signs, at t = -s_a / (s_b - s_a), and interpolates the point data with the same t.
+        cell_ids may give the cells inside the sphere, enlarged as below, from a SpatialIndex.
+        Returns None when the volume is not a linear unstructured grid or a section point is not found.
+        """
+        if not VTKReader.has_linear_cell_arrays(volume):
+            return None
+        points = vtk_to_numpy(volume.GetPoints().GetData()).astype(np.float64)
+        cells = volume.GetCells()
+        offsets = vtk_to_numpy(cells.GetOffsetsArray())
+        connectivity = vtk_to_numpy(cells.GetConnectivityArray())
+        cell_types = vtk_to_numpy(volume.GetCellTypesArray())
+
+        # Cells entirely inside the (slightly enlarged) sphere, as kept by vtkExtractGeometry
+        if cell_ids is None:
+            near_points = np.linalg.norm(points - np.asarray(center), axis=1) <= sphere_radius * (1.0 + 1e-6)
+            near_cells = np.logical_and.reduceat(near_points[connectivity], offsets[:-1])
+        else:
+            near_cells = np.zeros(len(cell_types), dtype=bool)
+            near_cells[cell_ids] = True
+
+        plane_center, plane_normal, _, _ = cls.get_plane_frame(pyvista_plane)
+        distances = (points - plane_center) @ plane_normal
+
+        first_ids = []
+        second_ids = []
+        for cell_type in np.unique(cell_types[near_cells]):
+            type_cell_ids = np.flatnonzero(near_cells & (cell_types == cell_type))
+            edges = cls.get_cell_edges(int(cell_type))
+            cell_starts = offsets[type_cell_ids][:, None]
+            first_ids.append(connectivity[cell_starts + edges[:, 0]].ravel())
+            second_ids.append(connectivity[cell_starts + edges[:, 1]].ravel())
+        if not first_ids:
+            return None
+        first_ids = np.concatenate(first_ids)
+        second_ids = np.concatenate(second_ids)
+        crossing = (distances[first_ids] < 0.0) != (distances[second_ids] < 0.0)
+        first_ids = first_ids[crossing]
+        second_ids = second_ids[crossing]
+        t = -distances[first_ids] / (distances[second_ids] - distances[first_ids])
+        crossing_points = points[first_ids] + t[:, None] * (points[second_ids] - points[first_ids])
+
+        distances_to_crossing, edge_ids = cKDTree(crossing_points).query(np.asarray(section_points, dtype=np.float64))
+        if np.any(distances_to_crossing > tolerance * sphere_radius):
+            return None
+
+        rows = np.arange(len(section_points))
+        t = t[edge_ids]
+        return csr_matrix((np.concatenate([1.0 - t, t]),
+                           (np.concatenate([rows, rows]),
+                            np.concatenate([first_ids[edge_ids], second_ids[edge_ids]]))),
+                          shape=(len(section_points), len(points)))
+
+    @classmethod
+    def get_interpolation_weights(cls, source_polydata, target, radius=0.001, sharpness=6, eccentricity=2):
+        """
+        Sparse (target points x source points) matrix of the kernel weights used by get_interpolator.
+        Target points without source points in the kernel radius take the closest source point, as the
+        closest-point null strategy does.
+        """
+        point_locator = vtk.vtkStaticPointLocator()
+        point_locator.SetDataSet(source_polydata)
+        point_locator.BuildLocator()
+
+        kernel = vtk.vtkEllipsoidalGaussianKernel()
+        kernel.SetRadius(radius)
+        kernel.SetSharpness(sharpness)
+        kernel.SetEccentricity(eccentricity)
+        kernel.Initialize(point_locator, source_polydata, source_polydata.GetPointData())
+
+        point_ids = vtk.vtkIdList()
+        weights = vtk.vtkDoubleArray()
+        rows = []
+        columns = []
+        values = []
+        for i in range(target.GetNumberOfPoints()):
+            point = target.GetPoint(i)
+            if kernel.ComputeBasis(point, point_ids, i) > 0:
+                number_of_weights = kernel.ComputeWeights(point, point_ids, weights)
+                columns.extend(point_ids.GetId(j) for j in range(number_of_weights))
+                values.extend(weights.GetValue(j) for j in range(number_of_weights))
+            else:
+                number_of_weights = 1
+                columns.append(point_locator.FindClosestPoint(point))
+                values.append(1.0)
+            rows.extend([i] * number_of_weights)
+
+        return csr_matrix((values, (rows, columns)),
+                          shape=(target.GetNumberOfPoints(), source_polydata.GetNumberOfPoints()))
+
+    @classmethod
+    def get_interpolated_dataset(cls, source_polydata, target, weights):
+        """Same output as get_interpolator, with the kernel weights given as a sparse matrix."""
+        output = target.NewInstance()
+        output.CopyStructure(target)
+        source_point_data = source_polydata.GetPointData()
+        for i in range(source_point_data.GetNumberOfArrays()):
+            source_array = source_point_data.GetArray(i)
+            if source_array is None:
+                continue
+            source_data = vtk_to_numpy(source_array)
+            # Integer arrays are promoted to float, as vtkPointInterpolator does
+            output_dtype = source_data.dtype if np.issubdtype(source_data.dtype, np.floating) else np.float32
+            interpolated_array = numpy_to_vtk(np.ascontiguousarray((weights @ source_data).astype(output_dtype)),
+                                              deep=True)
+            interpolated_array.SetName(source_array.GetName())
+            output.GetPointData().AddArray(interpolated_array)
+
+        output.GetPointData().PassData(target.GetPointData())
+        output.GetCellData().PassData(target.GetCellData())
+        output.GetFieldData().PassData(target.GetFieldData())
+        return output
@@ -1,56 +1,145 @@
 import vtk
 import os
+import shutil
+import numpy as np
 from vtkmodules.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 import pandas as pd
+from VTKModule.VTKReader import VTKReader
 
 
 class Writer:
+    # Named ASCII solids by default; binary STL files keep the solid name in their header only
+    binary_stl = False
+    stl_facet = " facet normal %.9g %.9g %.9g\n  outer loop\n   vertex %.9g %.9g %.9g\n   vertex %.9g %.9g %.9g\n" \
+                "   vertex %.9g %.9g %.9g\n  endloop\n endfacet\n"
+    stl_chunk_size = 10000
+    # Files are stored once, in storage_units, under a units.txt tag; the natural-scale copies OpenFOAM reads
+    # are an export of them, written only with natural_scale_export
+    unit_lengths = {"m": 1.0, "mm": 0.001}
+    storage_units = "mm"
+    natural_scale_units = "m"
+    natural_scale_export = True
+
     @classmethod
-    def write_stl(cls, surface, first_line_desc, last_line_desc, file_name_path):
-        try:
-            stlWriter = vtk.vtkSTLWriter()
-            # file_name_path.replace('/', '//')
-            stlWriter.SetFileName(file_name_path)
-            stlWriter.SetFileTypeToASCII()
-            if isinstance(surface, vtk.vtkSTLReader):
-                stlWriter.SetInputData(surface.GetOutput())
-            else:
-                stlWriter.SetInputData(surface)
-
-            stlWriter.Write()
-        except Exception as e:
-            error_message = str(e)
-            print(error_message)
+    def set_binary_stl(cls, binary_stl):
+        cls.binary_stl = binary_stl
+
+    @classmethod
+    def set_natural_scale_export(cls, natural_scale_export):
+        cls.natural_scale_export = natural_scale_export
+
+    @classmethod
+    def write_units_tag(cls, directory, units):
+        """Tags the files stored under directory with their units, for VTKReader.read_units."""
+        if VTKReader.read_units(directory + "units.txt") == units:
             return
-        with open(file_name_path, 'r') as file:
-            lines = file.readlines()
+        os.makedirs(directory, exist_ok=True)
+        with open(directory + "units.txt", 'w') as file:
+            file.write(units + "\n")
+        VTKReader.units_tags[directory] = units
 
-        lines[0] = first_line_desc
-        lines[-1] = last_line_desc
-        with open(file_name_path, 'w') as file:
-            file.writelines(lines)
+    @classmethod
+    def get_natural_scale_factor(cls, pathName):
+        # From the units pathName is tagged with (storage_units when untagged) to natural_scale_units
+        units = VTKReader.read_units(pathName) or cls.storage_units
+        if units not in cls.unit_lengths:
+            raise ValueError(f"Unknown units {units} of {pathName}")
+        return cls.unit_lengths[units] / cls.unit_lengths[cls.natural_scale_units]
+
+    @classmethod
+    def write_stl(cls, surface, first_line_desc, last_line_desc, file_name_path, natural_scale=False):
+        # first_line_desc is 'solid <name>\n'; the matching 'endsolid <name>' line is written with it
+        cls.write_named_stl(surface, first_line_desc.strip()[len("solid"):].strip(), file_name_path, natural_scale)
 
     @classmethod
-    def write_natural_scale_surface(cls, input_file_path, scale_factor=0.001):
-        parts = input_file_path.split('\\')
+    def get_natural_scale_pathName(cls, pathName):
+        parts = pathName.split('\\')
         file_name = parts[-1]
         parts[-1] = ""
         parts = ['natural_scale' if part == 'imaging_scale' else part for part in parts]
         natural_scale_path = '\\'.join(parts)
-        if not os.path.exists(natural_scale_path):
+        if natural_scale_path and not os.path.exists(natural_scale_path):
             os.makedirs(natural_scale_path)
-        with open(input_file_path, 'r') as file:
-            lines = file.readlines()
+        return natural_scale_path + file_name
 
-        for i in range(len(lines)):
-            if lines[i].strip().startswith('vertex'):
-                parts = lines[i].strip().split()
-                x, y, z = float(parts[1]), float(parts[2]), float(parts[3])
-                x_scaled, y_scaled, z_scaled = x * scale_factor, y * scale_factor, z * scale_factor
-                lines[i] = f"vertex {x_scaled} {y_scaled} {z_scaled}\n"
+    @classmethod
+    def get_stl_triangles(cls, surface):
+        """Points and (n, 3) point ids of the triangles of a surface, polygons and strips split as needed."""
+        if isinstance(surface, vtk.vtkSTLReader):
+            surface = surface.GetOutput()
+        if surface.GetNumberOfPoints() == 0:
+            return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+
+        polys_offsets = vtk_to_numpy(surface.GetPolys().GetOffsetsArray())
+        if surface.GetNumberOfStrips() > 0 or np.any(np.diff(polys_offsets) != 3):
+            triangle_filter = vtk.vtkTriangleFilter()
+            triangle_filter.SetInputData(surface)
+            triangle_filter.PassVertsOff()
+            triangle_filter.PassLinesOff()
+            triangle_filter.Update()
+            surface = triangle_filter.GetOutput()
+        points = vtk_to_numpy(surface.GetPoints().GetData()).astype(np.float64)
+        return points, vtk_to_numpy(surface.GetPolys().GetConnectivityArray()).reshape(-1, 3)
 
-        with open(natural_scale_path + file_name, 'w') as file:
-            file.writelines(lines)
+    @classmethod
+    def write_stl_triangles(cls, points, triangles, solid_name, pathName, binary=False):
+        vertices = points[triangles]
+        normals = np.cross(vertices[:, 1] - vertices[:, 0], vertices[:, 2] - vertices[:, 0])
+        normal_lengths = np.linalg.norm(normals, axis=1)
+        normals /= np.where(normal_lengths > 0.0, normal_lengths, 1.0)[:, None]
+
+        if binary:
+            facets = np.zeros(len(triangles), dtype=[("normal", "<f4", 3), ("vertices", "<f4", (3, 3)),
+                                                     ("attribute", "<u2")])
+            facets["normal"] = normals
+            facets["vertices"] = vertices
+            with open(pathName, 'wb') as file:
+                file.write(solid_name.encode()[:80].ljust(80, b' '))
+                file.write(np.uint32(len(triangles)).tobytes())
+                facets.tofile(file)
+            return
+
+        values = np.concatenate([normals, vertices.reshape(-1, 9)], axis=1)
+        with open(pathName, 'w') as file:
+            file.write(f"solid {solid_name}\n")
+            for start in range(0, len(values), cls.stl_chunk_size):
+                chunk = values[start:start + cls.stl_chunk_size]
+                file.write((cls.stl_facet * len(chunk)) % tuple(chunk.ravel().tolist()))
+            file.write(f"endsolid {solid_name}\n")
+
+    @classmethod
+    def write_named_stl(cls, surface, solid_name, pathName, natural_scale=False, binary=None):
+        """
+        STL file of a surface with a named solid, formatted from the point and triangle arrays.
+        With natural_scale, the file is part of the natural-scale export, written in the same pass.
+        """
+        if binary is None:
+            binary = cls.binary_stl
+        try:
+            points, triangles = cls.get_stl_triangles(surface)
+            cls.write_stl_triangles(points, triangles, solid_name, pathName, binary)
+            if natural_scale:
+                cls.export_natural_scale_triangles(points, triangles, solid_name, pathName, binary)
+        except Exception as e:
+            print(str(e))
+
+    @classmethod
+    def export_natural_scale_triangles(cls, points, triangles, solid_name, pathName, binary):
+        if not cls.natural_scale_export:
+            return
+        cls.write_stl_triangles(points * cls.get_natural_scale_factor(pathName), triangles, solid_name,
+                                cls.get_natural_scale_pathName(pathName), binary)
+
+    @classmethod
+    def export_natural_scale_stl(cls, surface, solid_name, pathName, binary=None):
+        """Natural-scale export of the stored STL file pathName, from its surface in memory."""
+        if binary is None:
+            binary = cls.binary_stl
+        try:
+            points, triangles = cls.get_stl_triangles(surface)
+            cls.export_natural_scale_triangles(points, triangles, solid_name, pathName, binary)
+        except Exception as e:
+            print(str(e))
 
     @classmethod
     def write_xml_polydata(cls, centerline, vtp_file_path):
@@ -60,37 +149,18 @@ class Writer:
         centerline_writer.Write()
 
     @classmethod
-    def write_pyvista_plane(cls, plane, plane_explainer, plane_file_path):
+    def write_pyvista_plane(cls, plane, plane_explainer, plane_file_path, natural_scale=False):
         plane_file_path = f"{plane_file_path}{plane_explainer}_plane.stl"
-        plane.save(plane_file_path, binary=False)
-        with open(plane_file_path, 'r+') as file:
-            lines = file.readlines()
-            lines[0] = f'solid {plane_explainer}\n'
-            lines[-1] = f'endsolid {plane_explainer}\n'
-            file.seek(0)
-            file.writelines(lines)
-            file.truncate()
+        cls.write_named_stl(plane, plane_explainer, plane_file_path, natural_scale)
 
     @classmethod
-    def write_clipped_surface(cls, surface, clipped_path):
-        surface.save(clipped_path, binary=False)
-        with open(clipped_path, 'r') as file:
-            lines = file.readlines()
-        lines[0] = 'solid artery\n'
-        lines[-1] = 'endsolid artery\n'
-        with open(clipped_path, 'w') as file:
-            file.writelines(lines)
+    def write_clipped_surface(cls, surface, clipped_path, natural_scale=False):
+        cls.write_named_stl(surface, 'artery', clipped_path, natural_scale)
 
     @classmethod
-    def write_surface_intersection(cls, mesh, intersection_name_path, explainer):
-        connected_mesh = mesh.connectivity(extraction_mode='largest')
-        connected_mesh.save(intersection_name_path, binary=False)
-        with open(intersection_name_path, 'r') as file:
-            lines = file.readlines()
-        lines[0] = "solid " + explainer + '\n'
-        lines[-1] = "endsolid " + explainer + '\n'
-        with open(intersection_name_path, 'w') as file:
-            file.writelines(lines)
+    def write_surface_intersection(cls, mesh, intersection_name_path, explainer, natural_scale=False):
+        # The mesh is already one region (PlaneContainer.calculate_surface_intersection)
+        cls.write_named_stl(mesh, explainer, intersection_name_path, natural_scale)
 
     @classmethod
     def write_polydata(cls, centerline_polydata, centerline_pathName):
@@ -101,25 +171,94 @@ class Writer:
         writer.Write()
 
     @classmethod
-    def write_UnstructuredGrid(cls, unstructured_grid, pathName):
+    def write_UnstructuredGrid(cls, unstructured_grid, pathName, compression="zlib"):
+        # The extension selects the format: legacy .vtk, binary XML .vtu or raw .npz arrays
+        extension = os.path.splitext(pathName)[1].lower()
+        if extension == ".vtu":
+            cls.write_XMLUnstructuredGrid(unstructured_grid, pathName, compression)
+            return
+        if extension == ".npz" and VTKReader.has_linear_cell_arrays(unstructured_grid):
+            cls.write_npz_UnstructuredGrid(unstructured_grid, pathName)
+            return
+
         writer = vtk.vtkUnstructuredGridWriter()
         writer.SetFileName(pathName)
         writer.SetInputData(unstructured_grid)
         writer.Write()
 
     @classmethod
-    def write_natural_scale_volume(cls, pathName, scale_factor=0.001):
-        parts = pathName.split('\\')
-        file_name = parts[-1]
-        parts[-1] = ""
-        parts = ['natural_scale' if part == 'imaging_scale' else part for part in parts]
-        natural_scale_path = '\\'.join(parts)
-        if not os.path.exists(natural_scale_path):
-            os.makedirs(natural_scale_path)
+    def write_XMLUnstructuredGrid(cls, unstructured_grid, pathName, compression="zlib"):
+        writer = vtk.vtkXMLUnstructuredGridWriter()
+        writer.SetFileName(pathName)
+        writer.SetInputData(unstructured_grid)
+        writer.SetDataModeToAppended()
+        writer.EncodeAppendedDataOff()
+        if compression == "lz4":
+            writer.SetCompressorTypeToLZ4()
+        elif compression == "none":
+            writer.SetCompressorTypeToNone()
+        else:
+            writer.SetCompressorTypeToZLib()
+        writer.Write()
+
+    @classmethod
+    def write_npz_UnstructuredGrid(cls, unstructured_grid, pathName):
+        cells = unstructured_grid.GetCells()
+        arrays = {"points": vtk_to_numpy(unstructured_grid.GetPoints().GetData()),
+                  "offsets": vtk_to_numpy(cells.GetOffsetsArray()),
+                  "connectivity": vtk_to_numpy(cells.GetConnectivityArray()),
+                  "cell_types": vtk_to_numpy(unstructured_grid.GetCellTypesArray())}
+        point_data = unstructured_grid.GetPointData()
+        for i in range(point_data.GetNumberOfArrays()):
+            point_array = point_data.GetArray(i)
+            if point_array is not None:
+                arrays["point_data_" + point_array.GetName()] = vtk_to_numpy(point_array)
+        with open(pathName, 'wb') as file:
+            np.savez(file, **arrays)
+
+    @classmethod
+    def write_raw_domain(cls, full_domain_output, raw_dir, fingerprint, source_stamp):
+        """
+        Points, flow and cell arrays of a full domain as .npy files, for VTKReader.read_raw_domain, with the
+        source_stamp of the converted file. An existing conversion of another source_stamp is replaced.
+        """
+        cells = full_domain_output.GetCells()
+        arrays = {"points": vtk_to_numpy(full_domain_output.GetPoints().GetData()),
+                  "flow": vtk_to_numpy(full_domain_output.GetPointData().GetArray("flow")),
+                  "offsets": vtk_to_numpy(cells.GetOffsetsArray()),
+                  "connectivity": vtk_to_numpy(cells.GetConnectivityArray()),
+                  "cell_types": vtk_to_numpy(full_domain_output.GetCellTypesArray())}
+
+        # Written aside and renamed, the fingerprint last, so a partial conversion is never read
+        temp_dir = raw_dir.rstrip('\\/') + f".{os.getpid()}.tmp"
+        os.makedirs(temp_dir, exist_ok=True)
+        for array_name in arrays:
+            np.save(os.path.join(temp_dir, array_name + ".npy"), arrays[array_name])
+        with open(os.path.join(temp_dir, "source.txt"), 'w') as file:
+            file.write(source_stamp)
+        with open(os.path.join(temp_dir, "fingerprint.txt"), 'w') as file:
+            file.write(fingerprint)
+        if os.path.isdir(raw_dir) and VTKReader.read_raw_source_stamp(raw_dir) != source_stamp:
+            shutil.rmtree(raw_dir, ignore_errors=True)
+        try:
+            os.replace(temp_dir, raw_dir.rstrip('\\/'))
+        except OSError:
+            # Converted meanwhile by another worker
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
-        reader = vtk.vtkDataSetReader()
-        reader.SetFileName(pathName)
-        reader.Update()
+    @classmethod
+    def export_natural_scale_volume(cls, pathName, compression="zlib"):
+        """Natural-scale export of a stored volume, written only with natural_scale_export."""
+        if cls.natural_scale_export:
+            cls.write_natural_scale_volume(pathName, compression=compression)
+
+    @classmethod
+    def write_natural_scale_volume(cls, pathName, scale_factor=None, compression="zlib"):
+        natural_scale_pathName = cls.get_natural_scale_pathName(pathName)
+        if scale_factor is None:
+            scale_factor = cls.get_natural_scale_factor(pathName)
+
+        reader = VTKReader.read_vtk_dataset(pathName)
 
         original_flow_array = reader.GetOutput().GetPointData().GetArray("flow")
         if original_flow_array is not None:
@@ -141,21 +280,28 @@ class Writer:
             transformFilter.GetOutput().GetPointData().AddArray(new_flow_array)
             transformFilter.GetOutput().GetPointData().SetActiveScalars("flow")
 
+        if not VTKReader.get_file_format(pathName) == "legacy":
+            cls.write_UnstructuredGrid(transformFilter.GetOutput(), natural_scale_pathName, compression)
+            return
+
         writer = vtk.vtkDataSetWriter()
         writer.SetInputData(transformFilter.GetOutput())
-        writer.SetFileName(natural_scale_path + file_name)
+        writer.SetFileName(natural_scale_pathName)
         writer.Write()
 
     @classmethod
-    def write_bounds_text(cls, clipped_path, bounds_criteria_parameter):
-        vtk_clipped_reader = vtk.vtkSTLReader()
-        vtk_clipped_reader.SetFileName(clipped_path)
-        vtk_clipped_reader.Update()
-
-        bounds = vtk_clipped_reader.GetOutput().GetBounds()
+    def write_bounds_text(cls, clipped_path, bounds_criteria_parameter, clipped_surface=None):
+        # clipped_surface, when in memory, spares parsing the file just written
+        if clipped_surface is None:
+            vtk_clipped_reader = vtk.vtkSTLReader()
+            vtk_clipped_reader.SetFileName(clipped_path)
+            vtk_clipped_reader.Update()
+            clipped_surface = vtk_clipped_reader.GetOutput()
+
+        bounds = clipped_surface.GetBounds()
         min_x, max_x, min_y, max_y, min_z, max_z = bounds
 
-        scale_factor = 0.001
+        scale_factor = cls.get_natural_scale_factor(clipped_path)
         parts = clipped_path.split('\\')
         parts[-1] = 'bounds.txt'
         parts = ['natural_scale' if part == 'imaging_scale' else part for part in parts]
@@ -175,7 +321,7 @@ class Writer:
         y = point.get_y()
         z = point.get_z()
 
-        scale_factor = 0.001
+        scale_factor = cls.get_natural_scale_factor(dir)
         parts = dir.split('\\')
         # parts[-1] = 'bifurcation_point.txt'
         parts = ['natural_scale' if part == 'imaging_scale' else part for part in parts]
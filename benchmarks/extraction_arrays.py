@@ -0,0 +1,92 @@
+"""
+Benchmark and equivalence check of VTKReader.get_extraction_arrays against the cell by cell
+VTKReader.filter_cells_by_point_ids, on a synthetic mixed tetra/hex grid.
+Run from the project directory: python -m benchmarks.extraction_arrays [--cells-per-side 68]
+"""
+import argparse
+import time
+import numpy as np
+import vtk
+from vtkmodules.util.numpy_support import vtk_to_numpy
+from VTKModule.VTKReader import VTKReader as vtkRdr
+from VTKModule.VTKConvertor import VTKConvertor as vtkCnvrt
+
+# Hexahedron corners of each tetra, split along the 0-6 diagonal
+hex_tetras = np.array([[0, 1, 2, 6], [0, 2, 3, 6], [0, 3, 7, 6], [0, 7, 4, 6], [0, 4, 5, 6], [0, 5, 1, 6]])
+
+
+def create_mixed_grid(cells_per_side, zero_flow_fraction=0.1, seed=0):
+    """Block of cells_per_side^3 hexahedra, the lower half in x split into 6 tetras each, with a flow array."""
+    n = cells_per_side
+    rng = np.random.default_rng(seed)
+    axis = np.arange(n + 1, dtype=np.float64)
+    points = np.stack(np.meshgrid(axis, axis, axis, indexing='ij'), axis=-1).reshape(-1, 3)
+    points += rng.normal(scale=0.05, size=points.shape)
+
+    i, j, k = [index.ravel() for index in np.meshgrid(np.arange(n), np.arange(n), np.arange(n), indexing='ij')]
+    point_id = lambda di, dj, dk: ((i + di) * (n + 1) + (j + dj)) * (n + 1) + (k + dk)
+    hexahedra = np.stack([point_id(0, 0, 0), point_id(1, 0, 0), point_id(1, 1, 0), point_id(0, 1, 0),
+                          point_id(0, 0, 1), point_id(1, 0, 1), point_id(1, 1, 1), point_id(0, 1, 1)], axis=1)
+
+    split = i < n // 2
+    tetras = hexahedra[split][:, hex_tetras].reshape(-1, 4)
+    hexahedra = hexahedra[~split]
+    connectivity = np.concatenate((tetras.ravel(), hexahedra.ravel()))
+    offsets = np.concatenate(([0], np.cumsum(np.concatenate((np.full(len(tetras), 4), np.full(len(hexahedra), 8))))))
+    cell_types = np.concatenate((np.full(len(tetras), vtk.VTK_TETRA), np.full(len(hexahedra), vtk.VTK_HEXAHEDRON)))
+
+    flow = rng.normal(size=points.shape)
+    flow[rng.random(len(points)) < zero_flow_fraction] = 0.0
+    grid = vtkCnvrt.numpy_to_vtk_unstructured_grid(points, offsets, connectivity, cell_types)
+    return grid, flow
+
+
+def get_grid_arrays(grid):
+    cells = grid.GetCells()
+    return (vtk_to_numpy(grid.GetPoints().GetData()), vtk_to_numpy(cells.GetOffsetsArray()),
+            vtk_to_numpy(cells.GetConnectivityArray()), vtk_to_numpy(grid.GetCellTypesArray()))
+
+
+def check_identical(name, array, reference):
+    # Same values, shape and bytes once brought to the reference dtype
+    identical = array.shape == reference.shape and \
+        np.asarray(array, dtype=reference.dtype).tobytes() == reference.tobytes()
+    print(f"  {name:<13}{'identical' if identical else 'DIFFERENT'}")
+    return identical
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cells-per-side", type=int, default=68,
+                        help="hexahedra per side of the block; 68 gives 1.1M cells")
+    args = parser.parse_args()
+
+    grid, flow = create_mixed_grid(args.cells_per_side)
+    kept_point_ids = vtkRdr.get_flow_point_ids_from_array(flow)
+    print(f"Grid: {grid.GetNumberOfCells()} cells ({grid.GetNumberOfPoints()} points), "
+          f"{len(kept_point_ids)} points with flow")
+
+    start = time.perf_counter()
+    _, kept_cell_ids, offsets, connectivity, cell_types = vtkRdr.get_extraction_arrays(grid, kept_point_ids)
+    original_points = vtk_to_numpy(grid.GetPoints().GetData())
+    extracted = vtkCnvrt.numpy_to_vtk_unstructured_grid(original_points[kept_point_ids], offsets, connectivity,
+                                                        cell_types)
+    vectorized_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = vtkRdr.filter_cells_by_point_ids(grid, kept_point_ids)
+    reference_time = time.perf_counter() - start
+
+    print(f"get_extraction_arrays:     {vectorized_time:8.3f} s ({len(kept_cell_ids)} cells kept)")
+    print(f"filter_cells_by_point_ids: {reference_time:8.3f} s ({reference.GetNumberOfCells()} cells kept)")
+    print(f"Speed-up: {reference_time / vectorized_time:.0f}x")
+
+    identical = [check_identical(name, array, reference_array) for name, array, reference_array in
+                 zip(("points", "offsets", "connectivity", "cell types"), get_grid_arrays(extracted),
+                     get_grid_arrays(reference))]
+    if not all(identical):
+        raise SystemExit("get_extraction_arrays differs from filter_cells_by_point_ids")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Micro-benchmark and tolerance check of VTKUtils.get_section_flow_rate / get_flux against the cell by cell
+flux loop it replaced (calculate_flow_rate), on synthetic sections of 1k to 100k cells.
+Run from the project directory: python -m benchmarks.section_flow_rate
+"""
+import argparse
+import time
+import numpy as np
+import pyvista as pv
+from vtkmodules.util.numpy_support import vtk_to_numpy
+from VTKModule.VTKUtils import VTKUtils as vtkUtl
+
+# Triangulated plane resolutions giving about 1k, 10k and 100k cells
+plane_resolutions = (22, 71, 224)
+# Sections facing +z, tilted ones whose normals mostly face -z and wavy ones whose normals change z sign; the
+# normals are auto-oriented, so the share flipped by get_flux is printed for each
+section_directions = {"up": (0.0, 0.0, 1.0), "tilted": (-1.0, -1.0, -1.0), "wavy": (1.0, 0.0, 0.05)}
+
+
+def calculate_flow_rate(vtk_dataset):
+    """The removed cell by cell loop, kept here as the reference."""
+    surface_extractor = vtkUtl.get_surface_from_volume(vtk_dataset)
+    polydata_normals = vtkUtl.get_polydata_normals(surface_extractor)
+    cell_sizes = vtkUtl.get_cell_size(polydata_normals)
+
+    normal_polydata = polydata_normals.GetOutput()
+    normals_array = normal_polydata.GetPointData().GetNormals()
+
+    for i in range(normals_array.GetNumberOfTuples()):
+        normal = normals_array.GetTuple(i)
+        if normal[2] < 0:
+            adjusted_normal = (-normal[0], -normal[1], -normal[2])
+            normals_array.SetTuple(i, adjusted_normal)
+
+    normal_polydata.GetPointData().SetNormals(normals_array)
+    areas = cell_sizes.GetOutput().GetCellData().GetArray("Area")
+    flow_array = normal_polydata.GetPointData().GetArray("flow")
+
+    num_cells = normal_polydata.GetNumberOfCells()
+    flow_rate_contributions = np.zeros(num_cells)
+    for i in range(num_cells):
+        cell = normal_polydata.GetCell(i)
+        point_ids = cell.GetPointIds()
+        cell_area = areas.GetValue(i)
+        local_flow = np.zeros(3)
+
+        for pid in range(point_ids.GetNumberOfIds()):
+            local_flow += np.array(flow_array.GetTuple(point_ids.GetId(pid)))
+
+        local_flow /= point_ids.GetNumberOfIds()
+
+        normal_vector = np.array(normals_array.GetTuple(point_ids.GetId(0)))
+        flow_rate_contributions[i] = np.dot(local_flow, normal_vector) * cell_area
+
+    return np.sum(flow_rate_contributions)
+
+
+def create_section(resolution, direction, seed=0):
+    """Perturbed triangulated plane with a random flow array, as an unstructured grid like the cut sections."""
+    rng = np.random.default_rng(seed)
+    section = pv.Plane(direction=direction, i_resolution=resolution, j_resolution=resolution).triangulate()
+    section.points += 0.01 * rng.random(section.points.shape) * np.asarray(direction)
+    if direction == section_directions["wavy"]:
+        section.points[:, 0] += 0.05 * np.sin(8.0 * section.points[:, 2])
+    section.point_data["flow"] = rng.normal(size=(section.n_points, 3)) + np.asarray(direction)
+    return section.cast_to_unstructured_grid()
+
+
+def get_flux_arrays(section):
+    polydata_normals = vtkUtl.get_polydata_normals(vtkUtl.get_surface_from_volume(section))
+    cell_sizes = vtkUtl.get_cell_size(polydata_normals)
+    normal_polydata = polydata_normals.GetOutput()
+    offsets, connectivity = vtkUtl.get_polydata_cell_arrays(normal_polydata)
+    return (offsets, connectivity, vtk_to_numpy(cell_sizes.GetOutput().GetCellData().GetArray("Area")),
+            vtk_to_numpy(normal_polydata.GetPointData().GetNormals()),
+            vtk_to_numpy(normal_polydata.GetPointData().GetArray("flow")))
+
+
+def get_time(function, *args, repeats=5):
+    # Best of repeats, in milliseconds
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    return result, min(times) * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tolerance", type=float, default=1e-12, help="largest relative difference accepted")
+    args = parser.parse_args()
+
+    print(f"{'cells':>7} {'section':>8} {'flipped':>8} {'loop ms':>9} {'section ms':>11} {'get_flux ms':>12} "
+          f"{'rel. diff':>10}")
+    worst_difference = 0.0
+    for resolution in plane_resolutions:
+        for direction_name, direction in section_directions.items():
+            section = create_section(resolution, direction)
+            reference, loop_time = get_time(calculate_flow_rate, section, repeats=1)
+            (flow_rate, _, number_of_cells), section_time = get_time(vtkUtl.get_section_flow_rate, section)
+            flux_arrays = get_flux_arrays(section)
+            flipped = np.mean(flux_arrays[3][:, 2] < 0)
+            _, flux_time = get_time(vtkUtl.get_flux, *flux_arrays)
+            difference = abs(flow_rate - reference) / max(abs(reference), np.finfo(np.float64).tiny)
+            worst_difference = max(worst_difference, difference)
+            print(f"{number_of_cells:>7} {direction_name:>8} {flipped:>8.0%} {loop_time:>9.1f} {section_time:>11.2f} "
+                  f"{flux_time:>12.3f} {difference:>10.1e}")
+
+    if worst_difference > args.tolerance:
+        raise SystemExit(f"get_section_flow_rate differs from the loop by {worst_difference:.1e}")
+    print(f"All flow rates within {args.tolerance:.0e} of the loop")
+
+
+if __name__ == "__main__":
+    main()